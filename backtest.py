@@ -0,0 +1,338 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Replay offline tín hiệu trong sheet (cùng định dạng CSV) trên file OHLCV local, tính toàn bộ bằng ma trận NumPy:
+# mỗi tín hiệu là 1 hàng, mỗi cột là 1 nến sau lúc vào lệnh ➝ TP/SL/thanh lý/hết giờ tìm bằng argmax, không lặp theo nến
+# Ví dụ:
+#   python backtest.py --sheet signals.csv --ohlcv data/ --out outcomes.csv
+#   python backtest.py --sheet signals.csv --ohlcv data/ --sweep-tp 0.02,0.04,0.06 --sweep-sl 0.01,0.02 --sweep-leverage 2,4,8
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    stream=sys.stdout
+)
+
+SHEET_UTC_OFFSET_HOURS = float(os.environ.get("SHEET_UTC_OFFSET_HOURS", "7"))
+SHEET_COLUMNS = ["symbol", "signal", "entry_price", "sl", "tp", "created_at", "interval"]
+
+# Tham số đang chạy thật trong main.py
+DEFAULT_PARAMS = {
+    "tp_pct": 0.04,             # LONG +4% / SHORT -4%
+    "sl_pct": 0.02,             # LONG -2% / SHORT +2%
+    "leverage": 4,
+    "margin": 30.0,             # USDT vốn mỗi lệnh
+    "fee": 0.0005,              # phí taker mỗi chiều
+    "mmr": 0.005,               # tỉ lệ ký quỹ duy trì (ước lượng giá thanh lý isolated)
+}
+CHUNK_CELLS = 4_000_000         # số ô (tín hiệu x nến) mỗi khối ma trận (giới hạn bộ nhớ)
+
+
+def load_sheet(path, utc_offset_hours=SHEET_UTC_OFFSET_HOURS):
+    raw = pd.read_csv(path, dtype="string", header=0, names=SHEET_COLUMNS, usecols=range(7))
+    df = raw.apply(lambda col: col.str.strip())
+    df["symbol"] = df["symbol"].str.upper()
+    df["signal"] = df["signal"].str.upper()
+    df["interval"] = pd.to_numeric(df["interval"], errors="coerce")
+    df["created_at"] = pd.to_datetime(df["created_at"], format="%Y-%m-%d %H:%M:%S", errors="coerce") \
+        - pd.Timedelta(hours=utc_offset_hours)
+    valid = df["signal"].isin(["LONG", "SHORT"]) & df["created_at"].notna() & df["interval"].notna()
+    if (~valid).any():
+        logging.warning(f"⚠️ Bỏ {int((~valid).sum())} dòng sheet hỏng / tín hiệu không hợp lệ")
+    df = df[valid].reset_index(drop=True)
+    df["direction"] = np.where(df["signal"] == "LONG", 1, -1)
+    return df
+
+
+def _ohlcv_path(directory, symbol):
+    for name in [symbol, f"{symbol}-SWAP", symbol.replace("-", ""), symbol.replace("-", "_")]:
+        path = os.path.join(directory, f"{name}.csv")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load_ohlcv(directory, symbols):
+    # File {SYMBOL}.csv: ts (ms / giây / ISO), open, high, low, close[, volume]
+    candles = {}
+    for symbol in symbols:
+        path = _ohlcv_path(directory, symbol)
+        if not path:
+            logging.warning(f"⚠️ Không có dữ liệu OHLCV cho {symbol}")
+            continue
+        df = pd.read_csv(path)
+        df.columns = [c.strip().lower() for c in df.columns]
+        ts = df[df.columns[0]]
+        if pd.api.types.is_numeric_dtype(ts):
+            ts = pd.to_datetime(ts, unit="ms" if ts.max() > 1e11 else "s")
+        else:
+            ts = pd.to_datetime(ts, utc=True).dt.tz_localize(None)
+        frame = pd.DataFrame({
+            "ts": ts.values.astype("datetime64[ns]").astype(np.int64),
+            "open": df["open"].astype(float), "high": df["high"].astype(float),
+            "low": df["low"].astype(float), "close": df["close"].astype(float),
+        }).sort_values("ts").drop_duplicates("ts").reset_index(drop=True)
+        candles[symbol] = {col: frame[col].to_numpy() for col in frame.columns}
+    return candles
+
+
+def prepare(signals, candles, max_hold_minutes=7 * 24 * 60, entry_delay_seconds=30):
+    # Chỉ tính sẵn nến vào lệnh của mọi tín hiệu (vector n phần tử) ➝ chạy lại với tham số khác không phải tìm lại;
+    # ma trận nến (tín hiệu x nến) dựng theo từng khối trong simulate, không giữ cả ma trận n x H trong bộ nhớ
+    n = len(signals)
+    entry_idx = np.full(n, -1)
+    symbol_code = np.full(n, -1)
+    entry_price = np.full(n, np.nan)
+    entry_ts = np.full(n, -1, dtype=np.int64)
+    created = signals["created_at"].values.astype("datetime64[ns]").astype(np.int64)
+    entry_after = created + int(entry_delay_seconds * 1e9)
+    expires = created + (signals["interval"].to_numpy() * 60e9).astype(np.int64)
+    hold_ns = int(max_hold_minutes * 60e9)
+
+    symbols, width = [], 1
+    for symbol, rows in signals.groupby("symbol").indices.items():
+        data = candles.get(symbol)
+        if data is None:
+            continue
+        ts = data["ts"]
+        idx = np.searchsorted(ts, entry_after[rows], side="left")
+        in_data = idx < len(ts)
+        # Nến vào lệnh phải nằm trong hạn interval của tín hiệu
+        in_time = in_data & (ts[np.minimum(idx, len(ts) - 1)] <= expires[rows])
+        rows, start = rows[in_time], idx[in_time]
+        if not len(rows):
+            continue
+        entry_idx[rows] = start
+        symbol_code[rows] = len(symbols)
+        entry_price[rows] = data["open"][start]
+        entry_ts[rows] = ts[start]
+        ends = np.searchsorted(ts, ts[start] + hold_ns, side="right")
+        width = max(width, int((ends - start).max()))
+        symbols.append(symbol)
+
+    status = np.where(entry_idx >= 0, "open", "expired")
+    status[~signals["symbol"].isin(list(candles)).to_numpy()] = "no_data"
+    logging.info(f"📦 Chuẩn bị {n} tín hiệu x {width} nến ({int((entry_idx >= 0).sum())} vào được lệnh)")
+    return {
+        "signals": signals.reset_index(drop=True),
+        "direction": signals["direction"].to_numpy(),
+        "entry_idx": entry_idx,
+        "entry_price": entry_price,
+        "entry_ts": entry_ts,
+        "symbol_code": symbol_code,
+        "symbols": symbols,
+        # Chỉ giữ nến của instrument có tín hiệu vào được lệnh (mảng 1 chiều, nhỏ hơn nhiều so với ma trận cửa sổ)
+        "candles": {symbol: {col: candles[symbol][col] for col in ["ts", "high", "low", "close"]} for symbol in symbols},
+        "hold_ns": hold_ns,
+        "width": width,
+        "status": status,
+    }
+
+
+def _windows(prepared, rows):
+    # Cửa sổ nến của 1 khối tín hiệu: float32 cho giá, ts = -1 / giá NaN khi hết dữ liệu hoặc quá max_hold
+    width = prepared["width"]
+    high = np.full((len(rows), width), np.nan, dtype=np.float32)
+    low = np.full((len(rows), width), np.nan, dtype=np.float32)
+    close = np.full((len(rows), width), np.nan, dtype=np.float32)
+    ts_matrix = np.full((len(rows), width), -1, dtype=np.int64)
+    codes = prepared["symbol_code"][rows]
+    for code in np.unique(codes[codes >= 0]):
+        data = prepared["candles"][prepared["symbols"][code]]
+        sel = np.flatnonzero(codes == code)
+        start = prepared["entry_idx"][rows][sel]
+        cols = start[:, None] + np.arange(width)[None, :]
+        valid = (cols < len(data["ts"]))
+        cols = np.minimum(cols, len(data["ts"]) - 1)
+        valid &= data["ts"][cols] <= (data["ts"][start] + prepared["hold_ns"])[:, None]
+        high[sel] = np.where(valid, data["high"][cols], np.nan)
+        low[sel] = np.where(valid, data["low"][cols], np.nan)
+        close[sel] = np.where(valid, data["close"][cols], np.nan)
+        ts_matrix[sel] = np.where(valid, data["ts"][cols], -1)
+    return high, low, close, ts_matrix
+
+
+def _first_hit(mask):
+    # Chỉ số nến đầu tiên thoả mask, width nếu không có
+    hit = mask.any(axis=1)
+    return np.where(hit, mask.argmax(axis=1), mask.shape[1])
+
+
+def simulate(prepared, tp_pct=DEFAULT_PARAMS["tp_pct"], sl_pct=DEFAULT_PARAMS["sl_pct"],
+             leverage=DEFAULT_PARAMS["leverage"], margin=DEFAULT_PARAMS["margin"],
+             fee=DEFAULT_PARAMS["fee"], mmr=DEFAULT_PARAMS["mmr"], skip_open_positions=True):
+    direction = prepared["direction"]
+    entry = prepared["entry_price"]
+    n, width = len(direction), prepared["width"]
+    exit_price = np.full(n, np.nan)
+    exit_ts = np.full(n, -1, dtype=np.int64)
+    outcome = prepared["status"].astype(object).copy()
+
+    chunk_rows = max(1, CHUNK_CELLS // width)
+    for start in range(0, n, chunk_rows):
+        sl_rows = slice(start, min(n, start + chunk_rows))
+        high, low, close, ts_matrix = _windows(prepared, np.arange(sl_rows.start, sl_rows.stop))
+        d = direction[sl_rows][:, None]
+        e = entry[sl_rows][:, None]
+        tp_px = e * (1 + d * tp_pct)
+        sl_px = e * (1 - d * sl_pct)
+        liq_px = e * (1 - d * (1 / leverage - mmr))
+        # LONG: TP khi high >= tp, SL khi low <= sl; SHORT ngược lại (so sánh với NaN luôn False)
+        favorable = np.where(d > 0, high, -low)
+        adverse = np.where(d > 0, low, -high)
+        tp_i = _first_hit(favorable >= d * tp_px)
+        sl_i = _first_hit(adverse <= d * sl_px)
+        liq_i = _first_hit(adverse <= d * liq_px)
+        # Cùng 1 nến chạm cả TP và SL ➝ coi như SL trước (bảo thủ); thanh lý nếu tới trước SL
+        stop_i = np.minimum(sl_i, liq_i)
+        stop_is_liq = liq_i < sl_i
+        stopped = (stop_i < width) & (stop_i <= tp_i)
+        last_i = np.isfinite(close).sum(axis=1) - 1
+
+        chunk_outcome = np.select(
+            [stopped, tp_i < width],
+            [np.where(stop_is_liq, "liquidated", "sl"), "tp"],
+            "timeout",
+        )
+        chunk_exit_idx = np.select([stopped, tp_i < width], [stop_i, tp_i], last_i)
+        chunk_exit_price = np.select(
+            [stopped & stop_is_liq, stopped, tp_i < width],
+            [liq_px[:, 0], sl_px[:, 0], tp_px[:, 0]],
+            close[np.arange(len(last_i)), np.maximum(last_i, 0)],
+        )
+        opened = outcome[sl_rows] == "open"
+        outcome[sl_rows] = np.where(opened, chunk_outcome, outcome[sl_rows])
+        exit_price[sl_rows] = np.where(opened, chunk_exit_price, np.nan)
+        exit_ts[sl_rows] = ts_matrix[np.arange(len(last_i)), np.clip(chunk_exit_idx, 0, width - 1)]
+
+    entered = np.isin(outcome, ["tp", "sl", "liquidated", "timeout"])
+    exit_ts = np.where(entered, exit_ts, -1)
+
+    if skip_open_positions:
+        # Bot không vào thêm khi đã có vị thế cùng chiều trên instrument đó (duyệt O(n) theo tín hiệu, không theo nến)
+        signals = prepared["signals"]
+        order = np.argsort(prepared["entry_ts"], kind="stable")
+        busy_until = {}
+        for i in order:
+            if not entered[i]:
+                continue
+            key = (signals.at[i, "symbol"], direction[i])
+            if busy_until.get(key, -1) >= prepared["entry_ts"][i]:
+                outcome[i] = "skipped_open_position"
+                entered[i] = False
+                continue
+            busy_until[key] = exit_ts[i]
+
+    qty = np.where(entered, margin * leverage / entry, 0.0)
+    gross = np.where(entered, qty * (exit_price - entry) * direction, 0.0)
+    # Thanh lý: mất toàn bộ ký quỹ isolated
+    gross = np.where(outcome == "liquidated", -margin, gross)
+    fees = np.where(entered, fee * qty * (entry + np.nan_to_num(exit_price)), 0.0)
+    pnl = gross - fees
+
+    result = prepared["signals"][["symbol", "signal", "created_at"]].copy()
+    result["outcome"] = outcome
+    result["entry_time"] = pd.to_datetime(np.where(entered, prepared["entry_ts"], -1)).where(entered)
+    result["entry_price"] = np.where(entered, entry, np.nan)
+    result["exit_time"] = pd.to_datetime(exit_ts).where(entered)
+    result["exit_price"] = np.where(entered, exit_price, np.nan)
+    result["fees"] = fees
+    result["pnl"] = pnl
+    result["roi"] = np.where(entered, pnl / margin, 0.0)
+    return result
+
+
+def summarize(outcomes):
+    traded = outcomes[outcomes["outcome"].isin(["tp", "sl", "liquidated", "timeout"])].sort_values("exit_time")
+    equity = traded["pnl"].cumsum()
+    drawdown = (equity.cummax().clip(lower=0) - equity).max() if len(equity) else 0.0
+    wins = traded["pnl"] > 0
+    gains, losses = traded.loc[wins, "pnl"].sum(), -traded.loc[~wins, "pnl"].sum()
+    return {
+        "signals": len(outcomes),
+        "trades": len(traded),
+        "outcomes": outcomes["outcome"].value_counts().to_dict(),
+        "total_pnl": round(float(traded["pnl"].sum()), 4),
+        "avg_pnl": round(float(traded["pnl"].mean()), 4) if len(traded) else 0.0,
+        "win_rate": round(float(wins.mean()), 4) if len(traded) else 0.0,
+        "profit_factor": round(float(gains / losses), 4) if losses > 0 else None,
+        "max_drawdown": round(float(drawdown), 4),
+        "fees": round(float(traded["fees"].sum()), 4),
+    }
+
+
+# --- Quét tham số song song: mỗi process nhận dữ liệu đã chuẩn bị (vector + nến 1 chiều, không có ma trận cửa sổ) 1 lần qua initializer ---
+_worker_prepared = None
+
+
+def _init_worker(prepared):
+    global _worker_prepared
+    _worker_prepared = prepared
+
+
+def _run_params(params):
+    summary = summarize(simulate(_worker_prepared, **params))
+    summary.pop("outcomes")
+    return {**params, **summary}
+
+
+def sweep(prepared, grid, base_params=None, workers=None):
+    base_params = {k: v for k, v in (base_params or {}).items() if k not in grid}
+    keys = list(grid)
+    combos = [{**base_params, **dict(zip(keys, values))} for values in itertools.product(*grid.values())]
+    logging.info(f"🧪 Quét {len(combos)} bộ tham số trên {workers or os.cpu_count()} process")
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(prepared,)) as pool:
+        results = list(pool.map(_run_params, combos, chunksize=max(1, len(combos) // (4 * (workers or os.cpu_count() or 1)))))
+    return pd.DataFrame(results).sort_values("total_pnl", ascending=False).reset_index(drop=True)
+
+
+def _floats(value):
+    return [float(v) for v in value.split(",") if v]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest / replay tín hiệu sheet trên dữ liệu OHLCV local")
+    parser.add_argument("--sheet", required=True, help="file CSV cùng định dạng Google Sheet")
+    parser.add_argument("--ohlcv", required=True, help="thư mục chứa {SYMBOL}.csv (ts, open, high, low, close)")
+    parser.add_argument("--tp", type=float, default=DEFAULT_PARAMS["tp_pct"])
+    parser.add_argument("--sl", type=float, default=DEFAULT_PARAMS["sl_pct"])
+    parser.add_argument("--leverage", type=float, default=DEFAULT_PARAMS["leverage"])
+    parser.add_argument("--margin", type=float, default=DEFAULT_PARAMS["margin"])
+    parser.add_argument("--fee", type=float, default=DEFAULT_PARAMS["fee"])
+    parser.add_argument("--max-hold-minutes", type=float, default=7 * 24 * 60, help="đóng theo giá close sau thời gian này")
+    parser.add_argument("--entry-delay", type=float, default=30, help="độ trễ từ created_at tới lúc vào lệnh (giây)")
+    parser.add_argument("--sweep-tp", type=_floats)
+    parser.add_argument("--sweep-sl", type=_floats)
+    parser.add_argument("--sweep-leverage", type=_floats)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--out", help="ghi kết quả từng tín hiệu (hoặc bảng sweep) ra CSV")
+    args = parser.parse_args()
+
+    signals = load_sheet(args.sheet)
+    candles = load_ohlcv(args.ohlcv, signals["symbol"].unique())
+    prepared = prepare(signals, candles, args.max_hold_minutes, args.entry_delay)
+    params = {"tp_pct": args.tp, "sl_pct": args.sl, "leverage": args.leverage, "margin": args.margin, "fee": args.fee}
+
+    grid = {
+        key: values for key, values in
+        [("tp_pct", args.sweep_tp), ("sl_pct", args.sweep_sl), ("leverage", args.sweep_leverage)]
+        if values
+    }
+    if grid:
+        table = sweep(prepared, grid, params, args.workers)
+        print(table.to_string(index=False))
+        if args.out:
+            table.to_csv(args.out, index=False)
+    else:
+        outcomes = simulate(prepared, **params)
+        print(json.dumps(summarize(outcomes), ensure_ascii=False, indent=2))
+        if args.out:
+            outcomes.to_csv(args.out, index=False)
@@ -0,0 +1,194 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+from aiohttp import web
+
+import okx_stub
+
+# Benchmark end-to-end không cần OKX / Google Sheet thật: chạy okx_stub trong process, trỏ main.py vào stub
+# rồi đo run_bot() (sheet N dòng) và auto_tp_sl_watcher (dọn TP/SL mồ côi sau khi đóng vị thế)
+# Ví dụ: python benchmark.py --sizes 10,100,1000 --watcher ws --latency 0.02 --out bench_results.jsonl
+
+
+def start_stub(app, host="127.0.0.1"):
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, host, 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True, name="okx-stub").start()
+    return f"http://{host}:{port}"
+
+
+def make_rows(instruments, size, utc_offset_hours):
+    # created_at theo giờ của sheet (UTC+7 mặc định), vừa tạo xong nên chưa quá hạn
+    created_at = (datetime.utcnow() + timedelta(hours=utc_offset_hours)).strftime("%Y-%m-%d %H:%M:%S")
+    rows = [["symbol", "signal", "entry_price", "sl", "tp", "created_at", "interval"]]
+    for i in range(size):
+        inst = instruments[i % len(instruments)]
+        rows.append([inst["uly"], "LONG" if i % 2 == 0 else "SHORT", str(inst["_px"]), "2%", "4%", created_at, "60"])
+    return rows
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ""
+
+
+def wait_for(predicate, timeout, interval=0.01):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(interval)
+    return None
+
+
+def run_size(bot, base_url, instruments, size, args, workdir):
+    session = requests.Session()
+    session.post(f"{base_url}/stub/reset").raise_for_status()
+    session.post(f"{base_url}/stub/sheet", data=okx_stub.rows_to_csv(make_rows(instruments, size, bot.SHEET_UTC_OFFSET_HOURS))).raise_for_status()
+
+    # Mỗi kích thước chạy với ledger / snapshot sạch
+    bot.signal_ledger = bot.SignalLedger(os.path.join(workdir, f"signals_{size}.db"))
+    bot.order_journal = bot.OrderJournal(os.path.join(workdir, f"journal_{size}.db"))
+    bot.sheet_poller = bot.SheetPoller()
+    bot.position_snapshot.fetched_at = 0
+    bot.leverage_cache.state.clear()
+    bot.execution_contexts.contexts.clear()
+    bot.leverage_cache.load(inst["instId"] for inst in instruments[:size])
+    session.post(f"{base_url}/stub/reset").raise_for_status()
+
+    # --prewarm: như khi cấu hình WATCH_LIST ➝ đòn bẩy / ticker / template dựng sẵn trước khi tín hiệu tới
+    prewarm = None
+    if args.prewarm:
+        prewarm_started_at = time.time()
+        bot.execution_contexts.warm(inst["instId"] for inst in instruments[:size])
+        wait_for(lambda: all(bot.ticker_snapshot.fresh(inst["instId"]) for inst in instruments[:size]), timeout=10)
+        prewarm = time.time() - prewarm_started_at
+        session.post(f"{base_url}/stub/reset?keep_leverage=1").raise_for_status()
+
+    started_at = time.time()
+    bot.run_bot()
+    elapsed = time.time() - started_at
+    stats = session.get(f"{base_url}/stub/stats").json()
+    calls = sum(stats["calls"].values())
+
+    # ✅ Đóng 10% vị thế ngoài bot ➝ đo thời gian tới khi watcher huỷ hết TP/SL mồ côi
+    open_inst_ids = sorted({inst["instId"] for inst in instruments[:size]})
+    to_close = open_inst_ids[:max(1, size // 10)]
+    closed = session.post(f"{base_url}/stub/close", json={"instIds": to_close}).json()["data"]
+    closed_at = time.time()
+    cleaned = wait_for(
+        lambda: not set(closed) & set(session.get(f"{base_url}/stub/stats").json()["orphans"]),
+        timeout=args.cleanup_timeout,
+    )
+    cleanup = time.time() - closed_at if cleaned else None
+    after = session.get(f"{base_url}/stub/stats").json()
+
+    return {
+        "size": size,
+        "watcher": args.watcher,
+        "entry_mode": bot.ENTRY_MODE,
+        "batch_orders": bot.BATCH_ORDERS,
+        "prewarm_s": round(prewarm, 3) if prewarm is not None else None,
+        "wall_s": round(elapsed, 3),
+        "ms_per_signal": round(elapsed * 1000 / size, 2),
+        "orders": stats["orders"],
+        "positions": stats["positions"],
+        "rest_calls": calls,
+        "calls_per_signal": round(calls / size, 2),
+        "calls_by_path": stats["calls"],
+        "rate_limited": sum(stats["rate_limited"].values()),
+        "closed": len(closed),
+        "orphan_cleanup_s": round(cleanup, 3) if cleanup is not None else None,
+        "cleanup_calls": sum(after["calls"].values()) - calls,
+    }
+
+
+def print_table(results):
+    header = f"{'size':>6} {'wall_s':>8} {'ms/sig':>8} {'calls/sig':>10} {'429':>5} {'orders':>7} {'orphans':>8} {'cleanup_s':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        cleanup = f"{r['orphan_cleanup_s']:.3f}" if r["orphan_cleanup_s"] is not None else "timeout"
+        print(
+            f"{r['size']:>6} {r['wall_s']:>8.3f} {r['ms_per_signal']:>8.2f} {r['calls_per_signal']:>10.2f} "
+            f"{r['rate_limited']:>5} {r['orders']:>7} {r['closed']:>8} {cleanup:>10}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark run_bot + watcher TP/SL trên OKX giả lập")
+    parser.add_argument("--sizes", default="10,100,1000", help="số dòng tín hiệu mỗi lượt, cách nhau bởi dấu phẩy")
+    parser.add_argument("--watcher", choices=["poll", "ws"], default="ws")
+    parser.add_argument("--latency", type=float, default=0.0, help="độ trễ mỗi request REST của stub (giây)")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-scale", type=float, default=1.0, help="nhân hạn mức OKX của stub (0 = tắt)")
+    parser.add_argument("--fill-delay", type=float, default=0.0)
+    parser.add_argument("--cleanup-timeout", type=float, default=60.0)
+    parser.add_argument("--prewarm", action="store_true", help="pre-warm mọi instrument của sheet trước khi đo (như WATCH_LIST)")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--out", help="ghi thêm kết quả (JSONL) để so sánh giữa các commit")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    instruments = okx_stub.make_instruments(max(sizes))
+    app = okx_stub.create_app(
+        instruments=instruments, latency=args.latency, jitter=args.jitter,
+        rate_scale=args.rate_scale, fill_delay=args.fill_delay, seed=1,
+    )
+    base_url = start_stub(app)
+    workdir = tempfile.mkdtemp(prefix="okx-bench-")
+
+    # ✅ Cấu hình main.py trước khi import (đọc biến môi trường lúc import)
+    os.environ.update({
+        "OKX_REST_URL": base_url,
+        "OKX_WS_PRIVATE_URL": base_url.replace("http", "ws") + "/ws/v5/private",
+        "OKX_WS_PUBLIC_URL": base_url.replace("http", "ws") + "/ws/v5/public",
+        "SPREADSHEET_URL": f"{base_url}/sheet/edit#gid=0",
+        "OKX_API_KEY": "bench", "OKX_API_SECRET": "bench", "OKX_API_PASSPHRASE": "bench",
+        "INSTRUMENT_CACHE_FILE": os.path.join(workdir, "instruments_cache.json"),
+        "SIGNAL_LEDGER_DB": os.path.join(workdir, "signals.db"),
+        "ORDER_JOURNAL_DB": os.path.join(workdir, "journal.db"),
+        "METRICS_FILE": os.path.join(workdir, "metrics.jsonl"),
+        "METRICS_PORT": "0",
+        "WATCHER_MODE": args.watcher,
+        # --prewarm đo cả giá WS tickers subscribe sẵn (mặc định chỉ bật khi TICKER_SOURCE=ws)
+        "PREWARM_TICKERS": "1" if args.prewarm else "0",
+        # Quét toàn bộ định kỳ không chen vào số request của run_bot
+        "WATCHER_FULL_RESYNC_SECONDS": "3600",
+    })
+    if args.watcher == "ws":
+        # ws: watcher chỉ chạy khi có sự kiện; poll giữ chu kỳ scheduler thật để đo đúng thời gian dọn
+        os.environ.update({"WATCHER_INTERVAL": "3600", "WATCHER_MIN_INTERVAL": "3600", "WS_RECONCILE_SECONDS": "3600"})
+    import main as bot
+
+    logging.getLogger().setLevel(args.log_level)
+    bot.instrument_catalog.ensure_fresh()
+    watcher = threading.Thread(target=bot.auto_tp_sl_watcher, daemon=True, name="watcher")
+    watcher.start()
+    if args.watcher == "ws":
+        wait_for(lambda: app["state"].clients, timeout=10)
+    time.sleep(0.5)     # vòng kiểm tra / đối soát đầu tiên của watcher
+
+    results = [run_size(bot, base_url, instruments, size, args, workdir) for size in sizes]
+    print_table(results)
+    if args.out:
+        revision = git_revision()
+        with open(args.out, "a", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps({"ts": time.time(), "revision": revision, **result}) + "\n")
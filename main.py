@@ -3,62 +3,1266 @@ import os
 import csv
 import logging
 import requests
-from datetime import timedelta, datetime
+from datetime import datetime
 import ccxt
 import threading
 import time
 import sys
 import json
 import math
+import heapq
+import random
 import pandas as pd
+import asyncio
+import aiohttp
+import base64
+import hashlib
+import hmac
+import sqlite3
+import queue
+import atexit
+from decimal import Decimal, InvalidOperation, ROUND_DOWN, ROUND_HALF_UP
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 # Logging setup
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")                        # json | text
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_RATE_PER_KEY = float(os.environ.get("LOG_RATE_PER_KEY", "20"))      # dòng / giây cho mỗi mẫu message (0 = không giới hạn)
+LOG_DEBUG_SAMPLE = float(os.environ.get("LOG_DEBUG_SAMPLE", "1"))        # tỉ lệ giữ lại log DEBUG
 
-logging.basicConfig(
-    level=logging.DEBUG,  # thay vì DEBUG/INFO
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    stream=sys.stdout
-)
+
+# ✅ Log dạng JSON lines (1 dòng / bản ghi), format chỉ chạy ở thread ghi log
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.processName != "MainProcess":
+            entry["process"] = record.processName       # shard của runner.py
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# ✅ Lấy mẫu DEBUG + giới hạn tốc độ theo mẫu message (record.msg chưa format), WARNING trở lên luôn giữ
+class LogRateLimitFilter(logging.Filter):
+    def __init__(self, rate=LOG_RATE_PER_KEY, debug_sample=LOG_DEBUG_SAMPLE):
+        super().__init__()
+        self.rate = rate
+        self.debug_sample = debug_sample
+        self.buckets = {}           # key -> [tokens, updated_at, số dòng đã bỏ]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if record.levelno <= logging.DEBUG and self.debug_sample < 1 and random.random() >= self.debug_sample:
+            return False
+        if self.rate <= 0:
+            return True
+        key = (record.levelno, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.rate, now, 0]
+            bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+# ✅ Thread giao dịch chỉ đẩy record vào queue (không format, không chờ stdout), queue đầy thì bỏ
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, queue_size=LOG_QUEUE_SIZE):
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        stream_handler.setFormatter(JsonLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    log_queue = queue.Queue(maxsize=queue_size)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(LogRateLimitFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
 # Đọc biến môi trường
 SPREADSHEET_URL = os.environ.get("SPREADSHEET_URL")
 OKX_API_KEY = os.environ.get("OKX_API_KEY")
 OKX_API_SECRET = os.environ.get("OKX_API_SECRET")
 OKX_API_PASSPHRASE = os.environ.get("OKX_API_PASSPHRASE")
+OKX_REST_URL = os.environ.get("OKX_REST_URL", "https://www.okx.com")
+INSTRUMENT_CACHE_FILE = os.environ.get("INSTRUMENT_CACHE_FILE", "instruments_cache.json")
+INSTRUMENT_TTL = int(os.environ.get("INSTRUMENT_TTL", "3600"))
+POSITION_MAX_AGE = float(os.environ.get("POSITION_MAX_AGE", "5"))
+OKX_WS_PRIVATE_URL = os.environ.get("OKX_WS_PRIVATE_URL", "wss://ws.okx.com:8443/ws/v5/private")
+OKX_WS_PUBLIC_URL = os.environ.get("OKX_WS_PUBLIC_URL", "wss://ws.okx.com:8443/ws/v5/public")
+TICKER_SOURCE = os.environ.get("TICKER_SOURCE", "rest")          # rest | ws
+TICKER_MAX_AGE = float(os.environ.get("TICKER_MAX_AGE", "5"))
+TICKER_SHARED_FILE = os.environ.get("TICKER_SHARED_FILE", "")      # snapshot giá do process khác (runner.py) ghi ra
+WATCH_LIST = [s.strip().upper() for s in os.environ.get("WATCH_LIST", "").split(",") if s.strip()]   # BTC-USDT,ETH-USDT: pre-warm ngay lúc khởi động
+# Subscribe WS tickers cho instrument đã pre-warm; mặc định theo TICKER_SOURCE (rest thì không mở WS public)
+PREWARM_TICKERS = os.environ.get("PREWARM_TICKERS", "1" if TICKER_SOURCE == "ws" else "0") == "1"
+WATCHER_MODE = os.environ.get("WATCHER_MODE", "poll")          # poll | ws
+WS_RECONCILE_SECONDS = int(os.environ.get("WS_RECONCILE_SECONDS", "300"))
+WATCHER_INTERVAL = float(os.environ.get("WATCHER_INTERVAL", "180"))      # giây giữa 2 vòng kiểm tra khi không có gì thay đổi
+WATCHER_MIN_INTERVAL = float(os.environ.get("WATCHER_MIN_INTERVAL", "10"))
+CONFIRM_TIMEOUT = float(os.environ.get("CONFIRM_TIMEOUT", "15"))         # hạn chờ xác nhận vị thế / TP-SL
+CONFIRM_BASE_DELAY = float(os.environ.get("CONFIRM_BASE_DELAY", "0.25"))
+CONFIRM_MAX_DELAY = float(os.environ.get("CONFIRM_MAX_DELAY", "2"))
+TP_SL_ORD_TYPES = ["trigger", "conditional,oco"]
+ENTRY_MODE = os.environ.get("ENTRY_MODE", "attach")          # attach | oco | trigger
+BATCH_ORDERS = os.environ.get("BATCH_ORDERS", "1") == "1"
+BATCH_ORDER_SIZE = 20
+# sCode khi TP/SL gắn kèm không hợp lệ (sai tham số / giá TP-SL sai phía so với giá hiện tại)
+ATTACH_REJECT_S_CODES = {"51000", "51277", "51278", "51279", "51280"}
+CANCEL_BATCH_SIZE = 10
+CANCEL_WORKERS = int(os.environ.get("CANCEL_WORKERS", "4"))
+EXEC_WORKERS = int(os.environ.get("EXEC_WORKERS", "4"))
+RATE_TRADE = float(os.environ.get("RATE_TRADE", "25"))       # request / giây
+RATE_ACCOUNT = float(os.environ.get("RATE_ACCOUNT", "5"))
+RATE_PUBLIC = float(os.environ.get("RATE_PUBLIC", "10"))
+SHEET_POLL_SECONDS = float(os.environ.get("SHEET_POLL_SECONDS", "30"))
+SIGNAL_LEDGER_DB = os.environ.get("SIGNAL_LEDGER_DB", "signals.db")
+ORDER_JOURNAL_DB = os.environ.get("ORDER_JOURNAL_DB", "journal.db")
+WATCH_NEAR_INTERVAL = float(os.environ.get("WATCH_NEAR_INTERVAL", "2"))       # instrument sát TP/SL: kiểm tra mỗi vài giây
+WATCH_SAFETY = float(os.environ.get("WATCH_SAFETY", "0.1"))                    # phần thời gian dự kiến chạm trigger dùng làm chu kỳ
+WATCH_DEFAULT_VOL = float(os.environ.get("WATCH_DEFAULT_VOL", "0.0001"))       # biến động / sqrt(giây) khi chưa đủ mẫu giá
+WATCHER_REQUEST_BUDGET = float(os.environ.get("WATCHER_REQUEST_BUDGET", "1"))  # request / giây tối đa cho watcher
+WATCHER_FULL_RESYNC_SECONDS = float(os.environ.get("WATCHER_FULL_RESYNC_SECONDS", "1800"))   # quét toàn bộ algo định kỳ
+SHEET_UTC_OFFSET_HOURS = float(os.environ.get("SHEET_UTC_OFFSET_HOURS", "7"))
+SHEET_COLUMNS = ["symbol", "signal", "entry_price", "sl", "tp", "created_at", "interval"]
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))            # 0 = tắt endpoint /metrics
+METRICS_FILE = os.environ.get("METRICS_FILE", "metrics.jsonl")         # rỗng = không ghi JSONL
+CANCEL_RETRY_S_CODES = {"50001", "50004", "50011", "50013", "50026"}   # sàn bận / timeout / rate limit
+CANCEL_DONE_S_CODES = {"51400"}    # lệnh đã bị huỷ hoặc đã kích hoạt
+
+
+# ✅ Metrics: histogram thời gian từng stage / endpoint REST, đếm lỗi, thời gian chờ rate limit và trace từng tín hiệu
+METRIC_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+COUNT_BUCKETS = [1, 2, 3, 5, 8, 13, 21, 34]
+
+
+class Metrics:
+    def __init__(self, path=METRICS_FILE, buckets=METRIC_BUCKETS):
+        self.path = path
+        self.buckets = buckets
+        self.histograms = {}        # (name, labels) -> [count theo bucket..., sum, count]
+        self.bucket_sets = {"bot_signal_rest_calls": COUNT_BUCKETS}
+        self.counters = {}          # (name, labels) -> value
+        self.gauges = {}            # (name, labels) -> value
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.bucket_sets.get(name, self.buckets)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * len(buckets) + [0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if value is None:
+                self.gauges.pop(key, None)
+            else:
+                self.gauges[key] = value
+
+    # --- Trace theo tín hiệu (gắn vào thread đang xử lý) ---
+    def start_trace(self, row_hash, symbol=""):
+        return {"row_hash": row_hash, "symbol": symbol, "started_at": time.time(),
+                "calls": 0, "rate_wait": 0.0, "errors": 0, "stages": {}}
+
+    def trace(self):
+        return getattr(self._local, "trace", None)
+
+    def bind(self, trace):
+        metrics = self
+
+        class _Bind:
+            def __enter__(self):
+                self.previous = metrics.trace()
+                metrics._local.trace = trace
+                return trace
+
+            def __exit__(self, *exc):
+                metrics._local.trace = self.previous
+
+        return _Bind()
+
+    def mark(self, event, at=None):
+        trace = self.trace()
+        if trace is not None and f"{event}_at" not in trace:
+            trace[f"{event}_at"] = at or time.time()
+
+    def stage(self, name):
+        metrics = self
+
+        class _Stage:
+            def __enter__(self):
+                self.started_at = time.monotonic()
+
+            def __exit__(self, exc_type, *exc):
+                elapsed = time.monotonic() - self.started_at
+                metrics.observe("bot_stage_seconds", elapsed, stage=name)
+                if exc_type is not None:
+                    metrics.inc("bot_stage_errors_total", stage=name)
+                trace = metrics.trace()
+                if trace is not None:
+                    trace["stages"][name] = round(trace["stages"].get(name, 0) + elapsed, 4)
+
+        return _Stage()
+
+    def add_stage(self, trace, name, elapsed, calls=0, rate_wait=0.0, errors=0):
+        # Request dùng chung cho nhiều tín hiệu (batch-orders) ➝ ghi thời gian + số request vào trace của từng tín hiệu
+        if trace is None:
+            return
+        with self._lock:
+            trace["stages"][name] = round(trace["stages"].get(name, 0) + elapsed, 4)
+            trace["calls"] += calls
+            trace["rate_wait"] += rate_wait
+            trace["errors"] += errors
+
+    def record_rest(self, path, group, waited, elapsed, error=None):
+        self.observe("okx_rest_seconds", elapsed, path=path)
+        if waited > 0:
+            self.observe("okx_rate_limit_wait_seconds", waited, group=group)
+        if error:
+            self.inc("okx_rest_errors_total", path=path, error=error)
+        trace = self.trace()
+        if trace is not None:
+            # 1 trace có thể gắn vào nhiều thread cùng lúc (batch huỷ TP/SL song song)
+            with self._lock:
+                trace["calls"] += 1
+                trace["rate_wait"] += waited
+                trace["errors"] += 1 if error else 0
+
+    def finish_trace(self, trace, status):
+        record = {
+            "type": "signal",
+            "ts": time.time(),
+            "row_hash": trace["row_hash"],
+            "symbol": trace["symbol"],
+            "status": status,
+            "rest_calls": trace["calls"],
+            "rest_errors": trace["errors"],
+            "rate_wait_s": round(trace["rate_wait"], 4),
+            "processing_s": round(time.time() - trace["started_at"], 4),
+            "stages": trace["stages"],
+        }
+        self.observe("bot_signal_rest_calls", trace["calls"])
+        self.inc("bot_signals_total", status=status)
+        signal_at = trace.get("signal_at")
+        for event in ["fill", "stop"]:
+            if signal_at and f"{event}_at" in trace:
+                latency = trace[f"{event}_at"] - signal_at
+                record[f"signal_to_{event}_s"] = round(latency, 3)
+                self.observe(f"bot_signal_to_{event}_seconds", latency)
+        if "fill_at" in trace and "stop_at" in trace:
+            record["fill_to_stop_s"] = round(trace["stop_at"] - trace["fill_at"], 3)
+        self.write(record)
+        return record
+
+    def write(self, record):
+        if not self.path:
+            return
+        try:
+            with self._file_lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logging.warning(f"⚠️ Không ghi được metrics vào {self.path}: {e}")
+
+    # --- Xuất dạng text của Prometheus ---
+    def render(self):
+        def _labels(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        with self._lock:
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        lines, typed = [], set()
+        for (name, labels), value in sorted(gauges.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} gauge")
+                typed.add(name)
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), hist in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in zip(self.bucket_sets.get(name, self.buckets), hist):
+                lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {hist[-1]}")
+            lines.append(f"{name}_sum{_labels(labels)} {hist[-2]:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {hist[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host=METRICS_HOST, port=METRICS_PORT):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+        logging.info(f"📊 Metrics tại http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+
+metrics = Metrics()
+
+# ✅ Token bucket đơn giản để giữ số request trong hạn mức của OKX
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate                  # token nạp lại mỗi giây
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+# ✅ Hạn mức theo nhóm endpoint (trade / account / public) thay vì chỉ dựa vào enableRateLimit toàn cục của ccxt
+rate_buckets = {
+    "trade": TokenBucket(rate=RATE_TRADE, capacity=RATE_TRADE * 2),
+    "account": TokenBucket(rate=RATE_ACCOUNT, capacity=RATE_ACCOUNT * 2),
+    "public": TokenBucket(rate=RATE_PUBLIC, capacity=RATE_PUBLIC * 2),
+}
+# Hạn mức riêng của mọi endpoint bot gọi, theo tài liệu OKX (số request / 2 giây; batch-orders tính theo số lệnh)
+endpoint_buckets = {
+    "trade/order": TokenBucket(rate=30, capacity=60),
+    "trade/batch-orders": TokenBucket(rate=150, capacity=300),
+    "trade/order-algo": TokenBucket(rate=10, capacity=20),
+    "trade/cancel-algos": TokenBucket(rate=10, capacity=20),
+    "trade/orders-algo-pending": TokenBucket(rate=10, capacity=20),
+    "account/positions": TokenBucket(rate=5, capacity=10),
+    "account/leverage-info": TokenBucket(rate=10, capacity=20),
+    "account/set-leverage": TokenBucket(rate=10, capacity=20),
+    "market/tickers": TokenBucket(rate=10, capacity=20),
+    "market/ticker": TokenBucket(rate=10, capacity=20),
+    "public/instruments": TokenBucket(rate=10, capacity=20),
+}
+
+
+def _rate_group(path):
+    if path.startswith("trade/"):
+        return "trade"
+    if path.startswith(("account/", "asset/", "users/")):
+        return "account"
+    return "public"
+
+
+def acquire_rate_limit(path, cost=1):
+    waited = rate_buckets[_rate_group(path)].acquire()
+    bucket = endpoint_buckets.get(path)
+    if bucket:
+        waited += bucket.acquire(cost)
+    return waited
+
+
+class OkxExchange(ccxt.okx):
+    # Mọi request REST (unified + implicit) đều đi qua fetch2 ➝ chặn theo bucket của endpoint
+    def fetch2(self, path, api='public', method='GET', params={}, headers=None, body=None, config={}):
+        # batch-orders: OKX tính hạn mức theo số lệnh trong batch
+        waited = acquire_rate_limit(path, len(params) if path == "trade/batch-orders" and isinstance(params, list) else 1)
+        started_at, error = time.monotonic(), None
+        try:
+            return super().fetch2(path, api, method, params, headers, body, config)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            metrics.record_rest(path, _rate_group(path), waited, time.monotonic() - started_at, error)
 
-# Khởi tạo OKX
-exchange = ccxt.okx({
+
+# Session HTTP dùng chung (giữ kết nối) cho Google Sheet và API public của OKX
+http_session = requests.Session()
+
+# Khởi tạo OKX (hạn mức do OkxExchange giữ theo từng endpoint, tắt throttle tuần tự của ccxt)
+exchange = OkxExchange({
     'apiKey': OKX_API_KEY,
     'secret': OKX_API_SECRET,
     'password': OKX_API_PASSPHRASE,
-    'enableRateLimit': True,
+    'enableRateLimit': False,
+    'urls': {
+        'api': {'rest': OKX_REST_URL}
+    },
     'options': {
         'defaultType': 'swap'
     }
 })
 
+
+# ✅ Danh mục instrument SWAP: tải 1 lần, làm mới theo TTL, lưu xuống đĩa để khởi động lại không cần mạng
+def _instrument_entry(item):
+    inst_id = item.get("instId", "")                   # BTC-USDT-SWAP
+    sheet_symbol = item.get("uly") or inst_id.rsplit("-", 1)[0]   # BTC-USDT
+    base, _, quote = sheet_symbol.partition("-")
+    settle = item.get("settleCcy", "")
+    return {
+        "instId": inst_id,
+        "symbol": sheet_symbol,
+        "ccxt_symbol": f"{base}/{quote}:{settle}",    # BTC/USDT:USDT
+        "settleCcy": settle,
+        "ctType": item.get("ctType") or None,
+        "state": item.get("state", ""),
+        # Quy cách hợp đồng (lotSz, minSz, ctVal, tickSz, maxMktSz) chỉ đọc qua SizingTable (Decimal) từ info
+        "info": item,
+    }
+
+
+def _decimal(value):
+    # Quy cách hợp đồng lấy nguyên chuỗi từ OKX ("0.1", "0.0001") ➝ Decimal chính xác, rỗng / lỗi = 0
+    try:
+        number = Decimal(str(value)) if value not in (None, "") else Decimal(0)
+    except (InvalidOperation, ValueError):
+        return Decimal(0)
+    return number if number.is_finite() and number > 0 else Decimal(0)
+
+
+# ✅ Bảng quy cách hợp đồng dựng sẵn mỗi lần làm mới catalog: khối lượng theo lotSz / ctVal / minSz / maxMktSz, giá theo tickSz
+class SizingTable:
+    TP_SL_RATIOS = {
+        # chiều vị thế -> (TP, SL, chiều lệnh đóng): LONG +4% / -2%, SHORT -4% / +2%
+        "long": (Decimal("1.04"), Decimal("0.98"), "sell"),
+        "short": (Decimal("0.96"), Decimal("1.02"), "buy"),
+    }
+
+    def __init__(self, instruments=()):
+        self.specs = {}
+        for inst in instruments:
+            info = inst.get("info", {})
+            lot, ct_val = _decimal(info.get("lotSz")), _decimal(info.get("ctVal"))
+            if not lot or not ct_val:
+                continue
+            self.specs[inst["instId"]] = {
+                "lotSz": lot,
+                "ctVal": ct_val,
+                "minSz": _decimal(info.get("minSz")) or lot,
+                "maxMktSz": _decimal(info.get("maxMktSz")),        # 0 = không giới hạn
+                "tickSz": _decimal(info.get("tickSz")),
+            }
+
+    @staticmethod
+    def _quantize(value, step, rounding):
+        return (value / step).to_integral_value(rounding) * step
+
+    def contracts(self, inst_id, notional, price):
+        # Số hợp đồng = notional / (giá x ctVal), làm tròn xuống bội số lotSz (không vượt vốn), chặn maxMktSz
+        spec = self.specs.get(inst_id)
+        if spec is None:
+            return None, "no_contract_spec"
+        price = _decimal(price)
+        if not price:
+            return None, "no_price"
+        sz = self._quantize(_decimal(notional) / (price * spec["ctVal"]), spec["lotSz"], ROUND_DOWN)
+        if spec["maxMktSz"] and sz > spec["maxMktSz"]:
+            sz = self._quantize(spec["maxMktSz"], spec["lotSz"], ROUND_DOWN)
+        if sz < spec["minSz"]:
+            return None, "below_min_size"
+        return sz, None
+
+    def round_size(self, inst_id, size):
+        # Size vị thế từ sàn (float) ➝ bội số lotSz gần nhất, nhỏ hơn minSz thì không đặt được lệnh
+        spec = self.specs.get(inst_id)
+        size = _decimal(size)
+        if spec is None or not size:
+            return None
+        size = self._quantize(size, spec["lotSz"], ROUND_HALF_UP)
+        return size if size >= spec["minSz"] else None
+
+    def round_price(self, inst_id, price):
+        spec = self.specs.get(inst_id)
+        price = _decimal(price)
+        if spec is None or not spec["tickSz"]:
+            return price
+        return self._quantize(price, spec["tickSz"], ROUND_HALF_UP)
+
+    def tp_sl(self, inst_id, side_check, ref_price):
+        tp_ratio, sl_ratio, opposite_side = self.TP_SL_RATIOS[side_check]
+        ref_price = _decimal(ref_price)
+        return (
+            self.round_price(inst_id, ref_price * tp_ratio),
+            self.round_price(inst_id, ref_price * sl_ratio),
+            opposite_side,
+        )
+
+    def size_batch(self, orders):
+        # orders: [(instId, chiều vị thế, giá tham chiếu, notional USDT)] ➝ mỗi lệnh {"sz", "tp", "sl", "reason"}
+        results = []
+        for inst_id, side_check, ref_price, notional in orders:
+            sz, reason = self.contracts(inst_id, notional, ref_price)
+            if reason:
+                results.append({"sz": None, "tp": None, "sl": None, "reason": reason})
+                continue
+            tp_price, sl_price, _ = self.tp_sl(inst_id, side_check, ref_price)
+            results.append({"sz": sz, "tp": tp_price, "sl": sl_price, "reason": None})
+        return results
+
+
+class InstrumentCatalog:
+    def __init__(self, cache_file=INSTRUMENT_CACHE_FILE, ttl=INSTRUMENT_TTL, retry_after=60):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.loaded_at = 0
+        self.next_refresh = 0
+        self.instruments = []
+        self.by_key = {}
+        self.sizing = SizingTable()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._frame = None
+        self._frame_loaded_at = None
+
+    def _fetch(self):
+        url = f"{OKX_REST_URL}/api/v5/public/instruments?instType=SWAP"
+        acquire_rate_limit("public/instruments")
+        response = http_session.get(url, timeout=10)
+        response.raise_for_status()
+        return response.json().get("data", [])
+
+    def _index(self, raw, loaded_at):
+        instruments = [_instrument_entry(item) for item in raw if item.get("instId")]
+        by_key = {}
+        for inst in instruments:
+            # ✅ Tra cứu O(1) theo cả 3 kiểu tên: BTC-USDT, BTC-USDT-SWAP, BTC/USDT:USDT
+            by_key[inst["symbol"].upper()] = inst
+            by_key[inst["instId"].upper()] = inst
+            by_key[inst["ccxt_symbol"].upper()] = inst
+        # Gán 1 lần để các thread đang đọc luôn thấy bản đầy đủ
+        self.instruments, self.by_key, self.sizing = instruments, by_key, SizingTable(instruments)
+        self.loaded_at = loaded_at
+        self.next_refresh = loaded_at + self.ttl
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            self._index(cached.get("data", []), float(cached.get("loaded_at", 0)))
+            logging.info(f"📦 Đã nạp {len(self.instruments)} instrument từ cache {self.cache_file}")
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logging.warning(f"⚠️ Không đọc được cache instrument {self.cache_file}: {e}")
+            return False
+
+    def _save_cache(self, raw, loaded_at):
+        tmp_file = f"{self.cache_file}.tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump({"loaded_at": loaded_at, "data": raw}, f)
+            os.replace(tmp_file, self.cache_file)
+        except Exception as e:
+            logging.warning(f"⚠️ Không ghi được cache instrument {self.cache_file}: {e}")
+
+    def refresh(self):
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        try:
+            raw = self._fetch()
+        except Exception as e:
+            logging.error(f"❌ Không thể fetch danh sách instrument SWAP từ OKX: {e}")
+            # Giữ dữ liệu cũ, thử lại sau retry_after giây
+            self.next_refresh = time.time() + self.retry_after
+            return False
+        loaded_at = time.time()
+        self._index(raw, loaded_at)
+        self._save_cache(raw, loaded_at)
+        logging.info(f"✅ Đã làm mới {len(self.instruments)} instrument SWAP")
+        return True
+
+    def ensure_fresh(self):
+        if self.instruments and time.time() < self.next_refresh:
+            return
+        with self._lock:
+            # Kiểm tra lại trong lock: thread khác có thể vừa làm mới xong lúc đang chờ
+            if not self.instruments:
+                self.load_cache()
+            if time.time() < self.next_refresh:
+                return
+            # Process khác (runner.py) đã làm mới file cache ➝ đọc lại từ đĩa thay vì gọi sàn
+            if not (self.load_cache() and time.time() < self.next_refresh):
+                self._refresh()
+
+    def get(self, key):
+        self.ensure_fresh()
+        return self.by_key.get(key.strip().upper())
+
+    def frame(self):
+        # Bảng tra cứu dạng DataFrame (index = mọi tên symbol) để join cả sheet 1 lần
+        by_key, loaded_at = self.by_key, self.loaded_at
+        if self._frame is None or self._frame_loaded_at != loaded_at:
+            self._frame = pd.DataFrame.from_dict(
+                {
+                    key: {"instId": inst["instId"], "settleCcy": inst["settleCcy"], "ctType": inst["ctType"]}
+                    for key, inst in by_key.items()
+                },
+                orient="index",
+                columns=["instId", "settleCcy", "ctType"],
+            )
+            self._frame_loaded_at = loaded_at
+        return self._frame
+
+    def start_background_refresh(self):
+        if self._thread:
+            return self._thread
+
+        def _loop():
+            while True:
+                try:
+                    self.ensure_fresh()
+                except Exception as e:
+                    logging.error(f"❌ Lỗi làm mới instrument catalog: {e}")
+                time.sleep(max(1, min(self.ttl, self.next_refresh - time.time())))
+
+        self._thread = threading.Thread(target=_loop, daemon=True)
+        self._thread.start()
+        return self._thread
+
+
+instrument_catalog = InstrumentCatalog()
+
+
+# ✅ Snapshot vị thế dùng chung cho run_bot và watcher: mỗi cửa sổ max_age chỉ gọi fetch_positions 1 lần
+def _position_size(pos):
+    size = pos.get("contracts")
+    if size is None:
+        size = pos.get("info", {}).get("pos") or 0
+    return abs(float(size or 0))
+
+
+def _position_key(pos):
+    info = pos.get("info", {})
+    pos_side = (info.get("posSide") or "").lower()
+    if pos_side not in ["long", "short"]:
+        pos_side = (pos.get("side") or "").lower()       # net mode ➝ lấy chiều từ ccxt
+    margin_mode = (info.get("mgnMode") or pos.get("marginMode") or "").lower()
+    return (info.get("instId", ""), pos_side, margin_mode)
+
+
+def _open_sizes(positions):
+    open_sizes = {}
+    for pos in positions:
+        size = _position_size(pos)
+        if size > 0:
+            inst_id = pos.get("info", {}).get("instId", "")
+            open_sizes[inst_id] = open_sizes.get(inst_id, 0) + size
+    return open_sizes
+
+
+# Khoá vị thế theo field gốc của OKX (posSide giữ nguyên "net"): sự kiện đóng vị thế net có pos = 0, không suy ra chiều được
+def _raw_position_key(info):
+    return (info.get("instId", ""), (info.get("posSide") or "").lower(), (info.get("mgnMode") or "").lower())
+
+
+class PositionSnapshot:
+    def __init__(self, exchange, max_age=POSITION_MAX_AGE):
+        self.exchange = exchange
+        self.max_age = max_age
+        self.version = 0
+        self.fetched_at = 0
+        self.positions = []
+        self.index = {}
+        self._lock = threading.Lock()
+
+    def _apply(self, positions, fetched_at):
+        index = {}
+        for pos in positions:
+            index[_position_key(pos)] = pos
+        self.positions, self.index = positions, index
+        self.fetched_at = fetched_at
+        self.version += 1
+
+    def get(self, force=False, max_age=None, newer_than=None):
+        return self.get_timed(force=force, max_age=max_age, newer_than=newer_than)[0]
+
+    def get_timed(self, force=False, max_age=None, newer_than=None):
+        requested_at = time.time()
+        max_age = self.max_age if max_age is None else max_age
+        if force:
+            newer_than = requested_at
+        with self._lock:
+            # force/newer_than: chỉ fetch lại nếu chưa có thread nào làm mới sau mốc thời gian đó
+            if newer_than is not None:
+                stale = self.fetched_at < newer_than
+            else:
+                stale = requested_at - self.fetched_at > max_age
+            if stale:
+                # fetched_at = lúc gửi request ➝ lệnh vào sau mốc này có thể chưa có trong snapshot
+                started_at = time.time()
+                positions = self.exchange.fetch_positions()
+                self._apply(positions, started_at)
+                logging.debug("[POSITIONS] ↪ v%s: %s vị thế", self.version, len(positions))
+            return self.positions, self.fetched_at
+
+    def find(self, inst_id, pos_side, margin_mode="isolated", force=False):
+        self.get(force=force)
+        pos = self.index.get((inst_id, pos_side.lower(), margin_mode.lower()))
+        if pos and _position_size(pos) > 0:
+            return pos
+        return None
+
+    def open_inst_ids(self, force=False, newer_than=None):
+        return set(_open_sizes(self.get(force=force, newer_than=newer_than)))
+
+
+position_snapshot = PositionSnapshot(exchange)
+
+# ✅ Snapshot giá toàn sàn SWAP: 1 request /market/tickers cho cả batch (hoặc cập nhật liên tục qua WS tickers)
+class TickerSnapshot:
+    def __init__(self, exchange, max_age=TICKER_MAX_AGE, shared_file=TICKER_SHARED_FILE):
+        self.exchange = exchange
+        self.max_age = max_age
+        self.shared_file = shared_file
+        self.quotes = {}            # instId -> {"last", "ask", "bid", "ts", "received_at"}
+        self.fetched_at = 0
+        self.stream = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _quote(raw, received_at):
+        return {
+            "last": float(raw.get("last") or 0),
+            "ask": float(raw.get("askPx") or 0),
+            "bid": float(raw.get("bidPx") or 0),
+            "ts": int(raw.get("ts") or 0),
+            "received_at": received_at,
+        }
+
+    def refresh(self):
+        if self.shared_file and self._load_shared():
+            return
+        data = self.exchange.public_get_market_tickers({"instType": "SWAP"}).get("data", [])
+        received_at = time.time()
+        self.quotes.update({raw["instId"]: self._quote(raw, received_at) for raw in data if raw.get("instId")})
+        self.fetched_at = received_at
+        logging.debug("[TICKERS] ↪ %s giá SWAP", len(data))
+
+    def _refresh_one(self, inst_id):
+        data = self.exchange.public_get_market_ticker({"instId": inst_id}).get("data", [])
+        received_at = time.time()
+        self.quotes.update({raw["instId"]: self._quote(raw, received_at) for raw in data if raw.get("instId")})
+
+    def _load_shared(self):
+        # Snapshot chung còn mới ➝ dùng luôn, quá cũ / lỗi thì tự gọi REST
+        try:
+            with open(self.shared_file, "r", encoding="utf-8") as f:
+                shared = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logging.warning(f"⚠️ Không đọc được snapshot giá chung {self.shared_file}: {e}")
+            return False
+        fetched_at = float(shared.get("fetched_at", 0))
+        if time.time() - fetched_at > self.max_age:
+            return False
+        self.quotes.update(shared.get("quotes", {}))
+        self.fetched_at = fetched_at
+        logging.debug("[TICKERS] ↪ %s giá SWAP từ %s", len(shared.get("quotes", {})), self.shared_file)
+        return True
+
+    def publish(self, path):
+        # Ghi snapshot ra file (tmp + rename) cho các process khác đọc; mỗi giá giữ received_at riêng để bên đọc tự xét độ mới
+        quotes = dict(self.quotes)
+        fetched_at = max((q["received_at"] for q in quotes.values()), default=self.fetched_at)
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"fetched_at": fetched_at, "quotes": quotes}, f)
+        os.replace(tmp_file, path)
+        return len(quotes)
+
+    def ensure_fresh(self, max_age=None):
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            if time.time() - self.fetched_at > max_age:
+                self.refresh()
+
+    def fresh(self, inst_id, max_age=None):
+        max_age = self.max_age if max_age is None else max_age
+        quote = self.quotes.get(inst_id)
+        return quote is not None and time.time() - quote["received_at"] <= max_age
+
+    def get(self, inst_id, max_age=None):
+        max_age = self.max_age if max_age is None else max_age
+        quote = self.quotes.get(inst_id)
+        if quote is None or time.time() - quote["received_at"] > max_age:
+            self.ensure_fresh(max_age)
+            quote = self.quotes.get(inst_id)
+        if quote is None or time.time() - quote["received_at"] > max_age:
+            # Snapshot (file chung / WS) mới nhưng riêng instId này không được cập nhật ➝ hỏi REST đúng 1 instrument
+            self._refresh_one(inst_id)
+            quote = self.quotes.get(inst_id)
+            if quote is None or time.time() - quote["received_at"] > max_age:
+                return None
+        return quote
+
+    async def _on_ws(self, channel, data):
+        received_at = time.time()
+        for raw in data:
+            self.quotes[raw.get("instId")] = self._quote(raw, received_at)
+
+    def start_stream(self, inst_ids, url=OKX_WS_PUBLIC_URL):
+        channels = [{"channel": "tickers", "instId": inst_id} for inst_id in inst_ids]
+        if self.stream:
+            self.stream.subscribe(channels)
+            return self.stream
+        self.stream = OkxStream(url, channels, on_message=self._on_ws)
+        self.stream.start()
+        return self.stream
+
+
+ticker_snapshot = TickerSnapshot(exchange)
+
+# ✅ Cache đòn bẩy / chế độ margin: chỉ gọi set-leverage khi (instId, mgnMode, posSide, lever) thay đổi
+class LeverageCache:
+    def __init__(self, exchange):
+        self.exchange = exchange
+        self.state = {}             # (instId, mgnMode, posSide) -> lever
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def load(self, inst_ids, margin_mode="isolated"):
+        inst_ids = list(inst_ids)
+        loaded = 0
+        # leverage-info nhận tối đa 20 instId / request
+        for i in range(0, len(inst_ids), 20):
+            chunk = inst_ids[i:i + 20]
+            try:
+                data = self.exchange.private_get_account_leverage_info({
+                    "instId": ",".join(chunk),
+                    "mgnMode": margin_mode,
+                }).get("data", [])
+            except Exception as e:
+                logging.warning(f"⚠️ Không lấy được leverage-info cho {len(chunk)} instrument: {e}")
+                continue
+            with self._lock:
+                for item in data:
+                    key = (item.get("instId"), item.get("mgnMode", margin_mode), item.get("posSide") or "net")
+                    self.state[key] = float(item.get("lever") or 0)
+            loaded += len(data)
+        logging.info(f"⚙️ Đã nạp {loaded} cấu hình đòn bẩy ({margin_mode})")
+        return loaded
+
+    def ensure(self, inst_id, lever, margin_mode="isolated", pos_side="net"):
+        key = (inst_id, margin_mode, pos_side)
+        with self._lock:
+            if self.state.get(key) == float(lever):
+                self.hits += 1
+                return False
+            self.misses += 1
+        self.exchange.private_post_account_set_leverage({
+            "instId": inst_id,
+            "lever": str(lever),
+            "mgnMode": margin_mode,
+            "posSide": pos_side,
+        })
+        with self._lock:
+            self.state[key] = float(lever)
+        return True
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.state)}
+
+
+leverage_cache = LeverageCache(exchange)
+
+
+# ✅ Context thực thi dựng sẵn theo instrument (pre-warm): instrument đã tra, đòn bẩy đã đặt, ticker đã subscribe,
+# template lệnh sẵn sàng ➝ lúc tín hiệu tới hạn chỉ còn request vào lệnh
+def _order_template(inst_id, margin_mode="isolated"):
+    return {"instId": inst_id, "tdMode": margin_mode, "ordType": "market", "ccy": "USDT"}
+
+
+class ExecutionContexts:
+    def __init__(self, exchange, catalog, leverage, tickers, lever=4, margin_mode="isolated", subscribe_tickers=PREWARM_TICKERS):
+        self.exchange = exchange
+        self.catalog = catalog
+        self.leverage = leverage
+        self.tickers = tickers
+        self.lever = lever
+        self.margin_mode = margin_mode
+        self.subscribe_tickers = subscribe_tickers
+        self.contexts = {}          # instId -> {"inst", "lever", "template", "warmed_at"}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _load_markets(self):
+        # fetch_positions (ccxt) cần markets ➝ nạp 1 lần ở đây thay vì trong lần fetch vị thế đầu tiên của tín hiệu
+        if self.exchange.markets:
+            return
+        try:
+            self.exchange.load_markets()
+        except Exception as e:
+            logging.warning(f"⚠️ Không nạp được markets ccxt khi pre-warm: {e}")
+
+    def _resolve(self, symbols):
+        insts, seen = [], set()
+        for symbol in symbols:
+            inst = self.catalog.get(symbol) if symbol else None
+            if inst is None or inst["settleCcy"] != "USDT" or inst["ctType"] not in ["linear", None]:
+                continue
+            if inst["instId"] in seen or inst["instId"] in self.contexts:
+                continue
+            seen.add(inst["instId"])
+            insts.append(inst)
+        return insts
+
+    def _warm_one(self, inst):
+        inst_id = inst["instId"]
+        try:
+            self.leverage.ensure(inst_id, self.lever, self.margin_mode)
+        except Exception as e:
+            logging.warning(f"⚠️ Pre-warm {inst_id}: không đặt được đòn bẩy {self.lever}x: {e}")
+            return None
+        context = {
+            "inst": inst,
+            "lever": self.lever,
+            "template": _order_template(inst_id, self.margin_mode),
+            "warmed_at": time.time(),
+        }
+        with self._lock:
+            self.contexts[inst_id] = context
+        return context
+
+    def warm(self, symbols):
+        # symbols: tên trên sheet / instId; instrument đã có context thì bỏ qua
+        self._load_markets()
+        insts = self._resolve(symbols)
+        if not insts:
+            return 0
+        if self.subscribe_tickers:
+            self.tickers.start_stream([inst["instId"] for inst in insts])
+        # set-leverage chạy song song, token bucket nhóm account giữ tốc độ
+        with ThreadPoolExecutor(max_workers=max(1, EXEC_WORKERS), thread_name_prefix="prewarm") as pool:
+            warmed = sum(1 for context in pool.map(self._warm_one, insts) if context)
+        logging.info(f"🔥 Pre-warm {warmed}/{len(insts)} instrument")
+        return warmed
+
+    def get(self, inst_id):
+        context = self.contexts.get(inst_id)
+        with self._lock:
+            if context is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        # Catalog vừa làm mới ➝ lấy bản instrument mới (quy cách có thể đổi), đòn bẩy / template giữ nguyên
+        latest = self.catalog.by_key.get(inst_id.upper())
+        if latest is not None and latest is not context["inst"]:
+            context["inst"] = latest
+        return context
+
+    def stats(self):
+        return {"contexts": len(self.contexts), "hits": self.hits, "misses": self.misses}
+
+
+execution_contexts = ExecutionContexts(exchange, instrument_catalog, leverage_cache, ticker_snapshot)
+
+
+# ✅ Xác nhận lệnh / vị thế / TP-SL: chờ theo deadline, xong ngay khi thấy (stream báo hoặc backoff có jitter), ghi lại thời gian chờ
+class ConfirmationHub:
+    def __init__(self, base_delay=CONFIRM_BASE_DELAY, max_delay=CONFIRM_MAX_DELAY, history=500):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.history = history
+        self.waiters = {}           # (kind, instId) -> set(Event)
+        self.listeners = []         # Event được set với mọi thông báo (watcher)
+        self.observers = []         # callback(kind, instId) với mọi thông báo
+        self.durations = {}         # kind -> [(giây, ok, số lần kiểm tra)]
+        self._lock = threading.Lock()
+
+    def notify(self, kind, inst_id):
+        with self._lock:
+            events = list(self.waiters.get((kind, inst_id), ())) + self.listeners
+            observers = list(self.observers)
+        for observer in observers:
+            observer(kind, inst_id)
+        for event in events:
+            event.set()
+
+    def listen(self):
+        event = threading.Event()
+        with self._lock:
+            self.listeners.append(event)
+        return event
+
+    def observe(self, callback):
+        with self._lock:
+            self.observers.append(callback)
+
+    def wait(self, kind, inst_id, check, timeout=CONFIRM_TIMEOUT):
+        started_at = time.monotonic()
+        deadline = started_at + timeout
+        event = threading.Event()
+        key = (kind, inst_id)
+        with self._lock:
+            self.waiters.setdefault(key, set()).add(event)
+        result, attempt = None, 0
+        try:
+            while True:
+                event.clear()
+                attempt += 1
+                try:
+                    result = check()
+                except Exception as e:
+                    logging.warning(f"[CONFIRM] ❌ Lỗi kiểm tra {kind} {inst_id} lần {attempt}: {e}")
+                if result:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                event.wait(min(delay, remaining))
+        finally:
+            with self._lock:
+                self.waiters[key].discard(event)
+                if not self.waiters[key]:
+                    del self.waiters[key]
+        self._record(kind, time.monotonic() - started_at, bool(result), attempt)
+        if result:
+            logging.debug("[CONFIRM] ✅ %s %s sau %.0f ms / %s lần", kind, inst_id, (time.monotonic() - started_at) * 1000, attempt)
+        else:
+            logging.warning(f"[CONFIRM] ⏱ Hết hạn chờ {kind} {inst_id} ({timeout}s, {attempt} lần)")
+        return result
+
+    def _record(self, kind, seconds, ok, attempts):
+        with self._lock:
+            samples = self.durations.setdefault(kind, [])
+            samples.append((seconds, ok, attempts))
+            del samples[:-self.history]
+
+    def stats(self):
+        with self._lock:
+            durations = {kind: list(samples) for kind, samples in self.durations.items()}
+        report = {}
+        for kind, samples in durations.items():
+            seconds = sorted(s for s, _, _ in samples)
+            report[kind] = {
+                "count": len(samples),
+                "ok": sum(1 for _, ok, _ in samples if ok),
+                "p50_ms": round(seconds[len(seconds) // 2] * 1000),
+                "max_ms": round(seconds[-1] * 1000),
+                "avg_attempts": round(sum(a for _, _, a in samples) / len(samples), 2),
+            }
+        return report
+
+
+confirmations = ConfirmationHub()
+
+
+_cancel_pool = ThreadPoolExecutor(max_workers=CANCEL_WORKERS, thread_name_prefix="cancel-algos")
+
+
+def _batch_error_data(e):
+    # ccxt ném lỗi khi cả batch thất bại (code=1), body vẫn có sCode từng lệnh
+    try:
+        return json.loads(str(e).split(" ", 1)[1]).get("data", [])
+    except Exception:
+        return []
+
+
+def _error_s_codes(e):
+    # Mã lỗi OKX trong body của lỗi ccxt: code tổng + sCode từng lệnh
+    try:
+        body = json.loads(str(e).split(" ", 1)[1])
+    except Exception:
+        return set()
+    return {str(body.get("code"))} | {str(item.get("sCode")) for item in body.get("data", [])}
+
+
+def _cancel_batch(exchange, batch, trace=None):
+    results = []
+    try:
+        # Chạy trên thread của _cancel_pool ➝ gắn lại trace của bên gọi để request huỷ được tính vào hạn mức / metrics
+        with metrics.bind(trace):
+            response = exchange.private_post_trade_cancel_algos(batch)
+        by_id = {item.get("algoId"): item for item in response.get("data", [])}
+        retry_all = False
+    except Exception as e:
+        logging.warning(f"❌ Lỗi huỷ batch {len(batch)} TP/SL: {e}")
+        by_id = {item.get("algoId"): item for item in _batch_error_data(e)}
+        retry_all = isinstance(e, ccxt.NetworkError)   # timeout / rate limit / sàn bận ➝ thử lại
+        for item in batch:
+            by_id.setdefault(item["algoId"], {"sCode": "-1", "sMsg": str(e)})
+    for item in batch:
+        res = by_id.get(item["algoId"], {})
+        s_code = str(res.get("sCode", "0"))
+        results.append({
+            "algoId": item["algoId"],
+            "instId": item["instId"],
+            "ok": s_code == "0" or s_code in CANCEL_DONE_S_CODES,
+            "sCode": s_code,
+            "sMsg": res.get("sMsg", ""),
+            "retry": s_code in CANCEL_RETRY_S_CODES or (retry_all and s_code == "-1"),
+        })
+    return results
+
+
+def cancel_algos(exchange, algos):
+    payload = []
+    seen = set()
+    for algo in algos:
+        algo_id, inst_id = algo.get("algoId"), algo.get("instId")
+        if not algo_id or not inst_id or algo_id in seen:
+            continue
+        seen.add(algo_id)
+        payload.append({"algoId": algo_id, "instId": inst_id})
+
+    report = {"cancelled": [], "failed": [], "retry": []}
+    if not payload:
+        return report
+
+    # ✅ Gom thành batch 10 lệnh đúng định dạng [{algoId, instId}] và gửi song song (hạn mức do OkxExchange giữ)
+    batches = [payload[i:i + CANCEL_BATCH_SIZE] for i in range(0, len(payload), CANCEL_BATCH_SIZE)]
+    with metrics.stage("cancel"):
+        trace = metrics.trace()
+        futures = [_cancel_pool.submit(_cancel_batch, exchange, batch, trace) for batch in batches]
+        for future in futures:
+            for res in future.result():
+                if res["ok"]:
+                    report["cancelled"].append(res)
+                elif res["retry"]:
+                    report["retry"].append(res)
+                else:
+                    report["failed"].append(res)
+
+    logging.info(
+        f"🧹 Huỷ TP/SL: {len(report['cancelled'])} thành công, {len(report['failed'])} lỗi, "
+        f"{len(report['retry'])} cần thử lại ({len(batches)} batch)"
+    )
+    for res in report["failed"] + report["retry"]:
+        logging.warning(f"❌ Lỗi huỷ TP/SL {res['algoId']} ({res['instId']}): {res['sCode']} {res['sMsg']}")
+    return report
+
 def auto_tp_sl_watcher():
+    if WATCHER_MODE == "ws":
+        logging.info("⚡ Watcher TP/SL chạy theo WebSocket (positions + orders-algo)")
+        TpSlStreamWatcher(exchange).run_forever()
+        return
+    # Có mồ côi / lỗi ➝ kiểm tra lại sớm, vòng yên ắng thì giãn dần về WATCHER_INTERVAL; vị thế/TP-SL thay đổi thì dậy ngay
+    wakeup = watch_scheduler.wakeup
+    interval = WATCHER_MIN_INTERVAL
+    last_full_resync = 0
     while True:
         try:
-            logging.info("🔁 Đang kiểm tra TP/SL tự động...")
-            cancel_tp_sl_if_position_closed(exchange)
-            cancel_sibling_algo_if_triggered(exchange)
+            if time.time() - last_full_resync >= WATCHER_FULL_RESYNC_SECONDS:
+                logging.info("🔁 Đang kiểm tra toàn bộ TP/SL...")
+                # Gom toàn bộ TP/SL mồ côi của cả vòng rồi huỷ theo batch 1 lần
+                orphans = cancel_tp_sl_if_position_closed(exchange, cancel=False)
+                orphans += cancel_sibling_algo_if_triggered(exchange, cancel=False)
+                report = cancel_algos(exchange, orphans) if orphans else None
+                watch_scheduler.sync(fetch_pending_tp_sl(exchange), position_snapshot.get())
+                last_full_resync = time.time()
+            else:
+                # Giữa các lần quét toàn bộ: chỉ kiểm tra instrument tới hạn theo scheduler + instrument "dirty" theo journal
+                report = watch_scheduler.run_due(exchange)
+            busy = bool(report and report["retry"])
         except Exception as e:
             logging.error(f"❌ Lỗi trong vòng kiểm tra auto TP/SL: {e}")
-        time.sleep(180)
+            busy = True
+        interval = WATCHER_MIN_INTERVAL if busy else min(WATCHER_INTERVAL, interval * 2)
+        wakeup.wait(min(interval * random.uniform(0.8, 1.0), watch_scheduler.next_due_in()))
+        wakeup.clear()
         
-def cancel_tp_sl_if_position_closed(exchange):
+def cancel_tp_sl_if_position_closed(exchange, snapshot=None, cancel=True):
+    snapshot = snapshot or position_snapshot
+    orphans = []
     try:
-        positions = exchange.fetch_positions()
+        positions = snapshot.get()
         for pos in positions:
-            logging.debug(f"[POSITION] ↪ symbol={pos.get('symbol')} | instId={pos.get('info', {}).get('instId')}")
+            logging.debug("[POSITION] ↪ symbol=%s | instId=%s", pos.get("symbol"), pos.get("info", {}).get("instId"))
 
         for pos in positions:
-            size = float(pos.get("size") or 0)
+            size = _position_size(pos)
             margin_mode = pos.get("marginMode", "")
             instId = pos.get("info", {}).get("instId", "")
 
-            logging.debug(
-                f"[CHECK] ↪ instId={instId} | size={size} | margin={margin_mode}"
-            )
+            logging.debug("[CHECK] ↪ instId=%s | size=%s | margin=%s", instId, size, margin_mode)
 
             if size == 0 and margin_mode in ["isolated", "cross"]:
                 if not instId:
@@ -68,27 +1272,15 @@ def cancel_tp_sl_if_position_closed(exchange):
                 logging.info(f"📉 Đã đóng vị thế {instId} ➝ kiểm tra lệnh TP/SL")
 
                 try:
-                    # Fetch all algo orders thuộc instId đó
-                    result = exchange.private_get_trade_orders_pending({
-                        'instId': instId,
-                        'algoType': 'conditional'  # TP/SL trên OKX futures
-                    })
-                    orders = result.get("data", [])
+                    # Fetch TP/SL (trigger + OCO) thuộc instId đó
+                    orders = fetch_pending_tp_sl(exchange, instId)
 
                     if not orders:
                         logging.info(f"✅ Không còn lệnh TP/SL nào trên {instId}")
                         continue
 
                     for order in orders:
-                        algo_id = order.get("algoId")
-                        try:
-                            cancel_result = exchange.private_post_trade_cancel_algos({
-                                "algos": [algo_id]
-                            })
-                            logging.info(f"✅ Đã huỷ TP/SL: {algo_id}")
-                        except Exception as e:
-                            logging.warning(f"❌ Lỗi huỷ TP/SL {algo_id}: {e}")
-                            continue
+                        orphans.append({"algoId": order.get("algoId"), "instId": instId})
 
                 except Exception as e:
                     logging.error(f"❌ Lỗi kiểm tra TP/SL của {instId}: {e}")
@@ -97,22 +1289,22 @@ def cancel_tp_sl_if_position_closed(exchange):
     except Exception as e:
         logging.error(f"❌ Lỗi xử lý auto cancel TP/SL: {e}")
 
-def cancel_sibling_algo_if_triggered(exchange):
+    if cancel and orphans:
+        cancel_algos(exchange, orphans)
+    return orphans
+
+def cancel_sibling_algo_if_triggered(exchange, snapshot=None, cancel=True):
+    snapshot = snapshot or position_snapshot
+    orphans = []
     try:
-        # 🟢 Fetch toàn bộ lệnh TP/SL dạng conditional còn đang treo
-        all_algo_orders = exchange.private_get_trade_orders_algo_pending({
-            "instType": "SWAP",  # futures perpetual
-            "algoType": "conditional"
-        }).get("data", [])
+        # 🟢 Fetch toàn bộ lệnh TP/SL (trigger + OCO/conditional) còn đang treo
+        started_at = time.time()
+        all_algo_orders = fetch_pending_tp_sl(exchange)
         logging.info(f"📋 Đang kiểm tra {len(all_algo_orders)} lệnh TP/SL đang treo...")
 
         # 🟢 Lấy danh sách instId của các vị thế đang mở
-        open_positions = exchange.fetch_positions()
-        open_inst_ids = {
-            pos.get("info", {}).get("instId", "")
-            for pos in open_positions
-            if float(pos.get("size", 0)) > 0
-        }
+        # Snapshot vị thế phải mới hơn danh sách algo, tránh huỷ nhầm TP/SL của vị thế vừa mở
+        open_inst_ids = snapshot.open_inst_ids(newer_than=started_at)
 
         # 🔁 Duyệt từng lệnh đang treo
         for order in all_algo_orders:
@@ -124,415 +1316,1422 @@ def cancel_sibling_algo_if_triggered(exchange):
             # Nếu không còn vị thế của instId này thì huỷ
             if inst_id not in open_inst_ids:
                 logging.info(f"⚠️ instId={inst_id} không còn mở, huỷ lệnh {tp_or_sl} [{side}]...")
+                orphans.append({"algoId": algo_id, "instId": inst_id})
 
+    except Exception as e:
+        logging.error(f"❌ Lỗi xử lý auto cancel TP/SL: {e}")
+
+    if cancel and orphans:
+        cancel_algos(exchange, orphans)
+    return orphans
+
+
+def _unchecked_result(inst_id, e):
+    # Cùng dạng kết quả của cancel_algos: instrument không query được TP/SL đang treo
+    return {"algoId": "", "instId": inst_id, "ok": False, "sCode": "-1", "sMsg": str(e), "retry": True}
+
+
+# ✅ Đối soát tăng dần theo journal: 1 request vị thế, chỉ query / huỷ TP/SL của instrument đã đổi trạng thái
+def reconcile_dirty(exchange, journal=None, snapshot=None, max_age=None):
+    journal = journal or order_journal
+    snapshot = snapshot or position_snapshot
+    # max_age: dùng lại snapshot vừa lấy (scheduler), mặc định ép làm mới
+    positions, fetched_at = snapshot.get_timed(force=max_age is None, max_age=max_age)
+    open_sizes = _open_sizes(positions)
+    journal.sync_positions(open_sizes, fetched_at)
+    dirty = journal.dirty()
+    if not dirty:
+        return None
+
+    # Instrument có lệnh vào sau lúc lấy snapshot ➝ snapshot chưa thấy vị thế mới, để vòng sau xử lý
+    pending = journal.opened_since(fetched_at) & set(dirty)
+    orphans, still_open, unchecked = [], [], []
+    for inst_id, algo_ids in dirty.items():
+        if inst_id in pending:
+            continue
+        if inst_id in open_sizes:
+            # Khớp 1 phần / 1 lệnh TP-SL đã chạy nhưng vị thế còn ➝ giữ TP/SL, cập nhật journal
+            still_open.append(inst_id)
+            continue
+        if not algo_ids:
+            # Không biết algoId (TP/SL gắn kèm lệnh vào) ➝ query riêng instId này
+            try:
+                algo_ids = [a.get("algoId") for a in fetch_pending_tp_sl(exchange, inst_id)]
+            except Exception as e:
+                # Chưa biết còn TP/SL mồ côi hay không ➝ giữ dirty, báo retry để vòng sau kiểm tra lại
+                logging.error(f"❌ Lỗi kiểm tra TP/SL của {inst_id}: {e}")
+                unchecked.append(_unchecked_result(inst_id, e))
+                continue
+        orphans.extend({"algoId": algo_id, "instId": inst_id} for algo_id in algo_ids)
+    for inst_id in still_open:
+        journal.resolve(inst_id, closed=False)
+
+    report = cancel_algos(exchange, orphans) if orphans else {"cancelled": [], "failed": [], "retry": []}
+    report["retry"].extend(unchecked)
+    retry_inst_ids = {res["instId"] for res in report["retry"]}
+    for inst_id in dirty:
+        if inst_id not in open_sizes and inst_id not in retry_inst_ids and inst_id not in pending:
+            journal.resolve(inst_id)
+    logging.info(f"🔁 Đối soát journal: {len(dirty)} instrument dirty, huỷ {len(report['cancelled'])} TP/SL")
+    return report
+
+
+# ✅ Scheduler ưu tiên theo instrument: chỉ theo dõi instrument có TP/SL / vị thế,
+# chu kỳ kiểm tra co giãn theo khoảng cách giá tới trigger và biến động gần đây, trong hạn mức request chung
+class WatchScheduler:
+    def __init__(self, budget=WATCHER_REQUEST_BUDGET, near_interval=WATCH_NEAR_INTERVAL,
+                 far_interval=WATCHER_INTERVAL, safety=WATCH_SAFETY, default_vol=WATCH_DEFAULT_VOL, history=30):
+        self.budget = budget
+        self.capacity = max(5.0, budget * 30)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.near_interval = near_interval
+        self.far_interval = far_interval
+        self.safety = safety
+        self.default_vol = default_vol
+        self.history = history
+        self.heap = []              # (due_at, instId, generation)
+        self.entries = {}           # instId -> trạng thái theo dõi
+        self.wakeup = threading.Event()  # watcher chờ trên Event này ➝ instrument mới được track thì dậy ngay
+        self._lock = threading.Lock()
+
+    def _entry(self, inst_id):
+        entry = self.entries.get(inst_id)
+        if entry is None:
+            entry = self.entries[inst_id] = {
+                "triggers": set(), "interval": self.near_interval, "due_at": 0, "generation": 0,
+                "prices": [], "checks": [], "distance": None,
+            }
+        return entry
+
+    def _schedule(self, inst_id, entry, due_at):
+        entry["due_at"] = due_at
+        entry["generation"] += 1
+        heapq.heappush(self.heap, (due_at, inst_id, entry["generation"]))
+
+    def track(self, inst_id, triggers=()):
+        with self._lock:
+            entry = self._entry(inst_id)
+            entry["triggers"].update(float(px) for px in triggers if px)
+            # Instrument mới / vừa đặt TP-SL ➝ kiểm tra sớm để tính chu kỳ
+            if entry["generation"] == 0:
+                self._schedule(inst_id, entry, time.time() + self.near_interval)
+                self.wakeup.set()
+
+    def untrack(self, inst_id):
+        with self._lock:
+            self.entries.pop(inst_id, None)
+        metrics.gauge("watcher_poll_interval_seconds", None, instId=inst_id)
+
+    def wake(self, kind, inst_id):
+        with self._lock:
+            entry = self.entries.get(inst_id)
+            if entry is not None:
+                self._schedule(inst_id, entry, time.time())
+
+    def sync(self, algos, positions):
+        # Quét toàn bộ: theo dõi đúng tập instrument đang có TP/SL hoặc vị thế
+        triggers = {}
+        for algo in algos:
+            pxs = triggers.setdefault(algo.get("instId", ""), set())
+            for field in ["triggerPx", "tpTriggerPx", "slTriggerPx"]:
+                if algo.get(field):
+                    pxs.add(float(algo[field]))
+        for pos in positions:
+            if _position_size(pos) > 0:
+                triggers.setdefault(pos.get("info", {}).get("instId", ""), set())
+        triggers.pop("", None)
+        for inst_id in set(self.entries) - set(triggers):
+            self.untrack(inst_id)
+        with self._lock:
+            for inst_id, pxs in triggers.items():
+                self._entry(inst_id)["triggers"] = pxs
+        for inst_id in triggers:
+            self.track(inst_id)
+        logging.info(f"🗓 Scheduler theo dõi {len(self.entries)} instrument")
+
+    def _volatility(self, prices):
+        # Độ lệch chuẩn log-return trên mỗi sqrt(giây)
+        samples = []
+        for (t0, p0), (t1, p1) in zip(prices, prices[1:]):
+            if t1 > t0 and p0 > 0 and p1 > 0:
+                samples.append(math.log(p1 / p0) ** 2 / (t1 - t0))
+        if len(samples) < 2:
+            return self.default_vol
+        return max(math.sqrt(sum(samples) / len(samples)), self.default_vol / 10)
+
+    def _interval(self, entry):
+        if not entry["prices"] or not entry["triggers"]:
+            entry["distance"] = None
+            return self.far_interval
+        price = entry["prices"][-1][1]
+        distance = min(abs(price - px) for px in entry["triggers"]) / price
+        entry["distance"] = distance
+        # Thời gian dự kiến để giá đi hết khoảng cách (random walk) ~ (d / sigma)^2
+        eta = (distance / self._volatility(entry["prices"])) ** 2
+        return min(self.far_interval, max(self.near_interval, eta * self.safety))
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.budget)
+        self.updated_at = now
+
+    def next_due_in(self):
+        with self._lock:
+            self._refill()
+            wait_budget = 0 if self.tokens >= 1 else (1 - self.tokens) / self.budget
+            due_in = self.heap[0][0] - time.time() if self.heap else self.far_interval
+        return max(0.05, due_in, wait_budget)
+
+    def _pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due_at, inst_id, generation = heapq.heappop(self.heap)
+            entry = self.entries.get(inst_id)
+            if entry is not None and entry["generation"] == generation:
+                due.append(inst_id)
+        return due
+
+    def _sample_prices(self):
+        for inst_id, entry in self.entries.items():
+            quote = ticker_snapshot.quotes.get(inst_id)
+            if quote and quote["last"] > 0 and (not entry["prices"] or entry["prices"][-1][0] < quote["received_at"]):
+                entry["prices"].append((quote["received_at"], quote["last"]))
+                del entry["prices"][:-self.history]
+
+    def run_due(self, exchange, snapshot=None, journal=None):
+        snapshot = snapshot or position_snapshot
+        journal = journal or order_journal
+        with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                return None
+            due = self._pop_due(time.time())
+        if not due and not journal.dirty():
+            return None
+
+        trace = metrics.start_trace("watcher")
+        report, closed = None, []
+        with metrics.bind(trace):
+            # 1 snapshot vị thế + 1 snapshot giá dùng chung cho mọi instrument tới hạn
+            positions, fetched_at = snapshot.get_timed(force=True)
+            open_inst_ids = set(_open_sizes(positions))
+            if due:
                 try:
-                    response = exchange.private_post_trade_cancel_algos({
-                        "algoId": algo_id,
-                        "instId": inst_id
-                    })
-                    logging.info(f"✅ Huỷ thành công lệnh TP/SL: {algo_id} - {inst_id}")
+                    ticker_snapshot.ensure_fresh(self.near_interval)
                 except Exception as e:
-                    logging.error(f"❌ Lỗi huỷ TP/SL {algo_id}: {e}")
+                    logging.warning(f"⚠️ Scheduler không lấy được giá: {e}")
+            # Lệnh vào sau lúc lấy snapshot chưa có trong snapshot ➝ không coi là đã đóng
+            recent = journal.opened_since(fetched_at)
+            closed = [inst_id for inst_id in due if inst_id not in open_inst_ids and inst_id not in recent]
+            for inst_id in closed:
+                journal.mark_dirty(inst_id, "closed", before=fetched_at)
+            dirty = journal.dirty()
+            if dirty:
+                report = reconcile_dirty(exchange, journal, snapshot, max_age=self.near_interval)
+            # Instrument đóng nhưng không có trong journal (lệnh mở ngoài bot / trước khi có journal)
+            orphans, unchecked = [], []
+            for inst_id in closed:
+                if inst_id in dirty:
+                    continue
+                try:
+                    orphans.extend({"algoId": a.get("algoId"), "instId": inst_id} for a in fetch_pending_tp_sl(exchange, inst_id))
+                except Exception as e:
+                    logging.error(f"❌ Lỗi kiểm tra TP/SL của {inst_id}: {e}")
+                    unchecked.append(_unchecked_result(inst_id, e))
+            if orphans or unchecked:
+                extra = cancel_algos(exchange, orphans)
+                extra["retry"].extend(unchecked)
+                report = {k: (report or {}).get(k, []) + extra[k] for k in extra}
+        retry_inst_ids = {r["instId"] for r in (report or {}).get("retry", [])}
+
+        now = time.time()
+        with self._lock:
+            self.tokens -= trace["calls"]
+            self._sample_prices()
+            for inst_id in due:
+                entry = self.entries.get(inst_id)
+                if entry is None:
+                    continue
+                entry["checks"].append(now)
+                del entry["checks"][:-self.history]
+                metrics.inc("watcher_checks_total", instId=inst_id)
+                if inst_id in closed and inst_id not in retry_inst_ids:
+                    continue
+                entry["interval"] = self._interval(entry)
+                self._schedule(inst_id, entry, now + entry["interval"])
+                metrics.gauge("watcher_poll_interval_seconds", round(entry["interval"], 3), instId=inst_id)
+            depth = len(self.entries)
+        for inst_id in closed:
+            if inst_id not in retry_inst_ids:
+                self.untrack(inst_id)
+        metrics.gauge("watcher_queue_depth", depth)
+        metrics.gauge("watcher_budget_tokens", round(self.tokens, 2))
+        logging.debug("[SCHEDULER] ↪ kiểm tra %s instrument, %s đã đóng, %s request", len(due), len(closed), trace["calls"])
+        return report
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            instruments = {
+                inst_id: {
+                    "interval_s": round(entry["interval"], 2),
+                    "due_in_s": round(entry["due_at"] - now, 2),
+                    "distance": round(entry["distance"], 5) if entry["distance"] is not None else None,
+                    "polls_per_min": sum(1 for t in entry["checks"] if now - t <= 60),
+                }
+                for inst_id, entry in self.entries.items()
+            }
+            return {"queue_depth": len(self.entries), "budget_tokens": round(self.tokens, 2), "instruments": instruments}
+
+
+watch_scheduler = WatchScheduler()
+# Chỉ chế độ poll chạy run_due; chế độ ws không đăng ký để hàng đợi / heap của scheduler không phình mãi
+if WATCHER_MODE == "poll":
+    # Dùng chung Event với ConfirmationHub: vị thế/TP-SL thay đổi hoặc track() đều đánh thức watcher
+    watch_scheduler.wakeup = confirmations.listen()
+    confirmations.observe(watch_scheduler.wake)
+
+
+# ✅ WebSocket OKX (private/public): tự login, subscribe, ping và kết nối lại khi rớt
+def _ws_login_args(api_key, secret, passphrase):
+    timestamp = str(int(time.time()))
+    message = f"{timestamp}GET/users/self/verify"
+    sign = base64.b64encode(hmac.new(secret.encode(), message.encode(), hashlib.sha256).digest()).decode()
+    return [{"apiKey": api_key, "passphrase": passphrase, "timestamp": timestamp, "sign": sign}]
+
+
+class OkxStream:
+    def __init__(self, url, channels, on_message, on_connect=None, credentials=None, ping_interval=25):
+        self.url = url
+        self.channels = channels
+        self.on_message = on_message          # async def on_message(channel, data)
+        self.on_connect = on_connect          # async def on_connect()
+        self.credentials = credentials        # (api_key, secret, passphrase) cho kênh private
+        self.ping_interval = ping_interval
+        self.loop = None
+        self.ws = None
+        self.connected = threading.Event()
+        self._stopped = False
+
+    async def _ping(self, ws):
+        while not ws.closed:
+            await asyncio.sleep(self.ping_interval)
+            await ws.send_str("ping")
+
+    async def _session(self):
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(self.url) as ws:
+                if self.credentials:
+                    await ws.send_json({"op": "login", "args": _ws_login_args(*self.credentials)})
+                    reply = await ws.receive_json(timeout=10)
+                    if reply.get("event") != "login" or str(reply.get("code")) != "0":
+                        raise RuntimeError(f"login thất bại: {reply}")
+                await ws.send_json({"op": "subscribe", "args": self.channels})
+                self.ws = ws
+                self.connected.set()
+                logging.info(f"🔌 [WS] Đã kết nối {self.url} ({len(self.channels)} kênh)")
+                if self.on_connect:
+                    await self.on_connect()
+                ping_task = asyncio.create_task(self._ping(ws))
+                try:
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        if msg.data == "pong":
+                            continue
+                        payload = json.loads(msg.data)
+                        if payload.get("event") == "error":
+                            logging.error(f"❌ [WS] Lỗi từ server: {payload}")
+                        elif "data" in payload:
+                            await self.on_message(payload.get("arg", {}).get("channel"), payload["data"])
+                finally:
+                    ping_task.cancel()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        delay = 1
+        while not self._stopped:
+            try:
+                await self._session()
+                delay = 1
+            except Exception as e:
+                logging.error(f"❌ [WS] Mất kết nối {self.url}: {e}")
+            self.connected.clear()
+            if self._stopped:
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def subscribe(self, channels):
+        # Thêm kênh khi đang chạy (gọi được từ thread khác), tự subscribe lại khi reconnect
+        channels = [c for c in channels if c not in self.channels]
+        if not channels:
+            return
+        self.channels.extend(channels)
+        if self.loop and self.ws is not None and self.connected.is_set():
+            asyncio.run_coroutine_threadsafe(self.ws.send_json({"op": "subscribe", "args": channels}), self.loop)
+
+    def start(self):
+        thread = threading.Thread(target=lambda: asyncio.run(self.run()), daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped = True
+
+
+# ✅ Watcher TP/SL theo sự kiện: giữ trạng thái vị thế + algo trong RAM, REST chỉ dùng để đối soát định kỳ
+def fetch_pending_tp_sl(exchange, inst_id=None):
+    orders = []
+    for ord_type in TP_SL_ORD_TYPES:
+        params = {"instType": "SWAP", "ordType": ord_type}
+        if inst_id:
+            params["instId"] = inst_id
+        orders.extend(exchange.private_get_trade_orders_algo_pending(params).get("data", []))
+    return orders
+
+
+class TpSlStreamWatcher:
+    def __init__(self, exchange, snapshot=None, url=OKX_WS_PRIVATE_URL, reconcile_seconds=WS_RECONCILE_SECONDS):
+        self.exchange = exchange
+        self.snapshot = snapshot or position_snapshot
+        self.reconcile_seconds = reconcile_seconds
+        self.open_positions = {}    # (instId, posSide, mgnMode) -> dữ liệu vị thế
+        self.algos = {}             # algoId -> lệnh TP/SL đang treo
+        self.stream = OkxStream(
+            url,
+            channels=[
+                {"channel": "positions", "instType": "SWAP"},
+                {"channel": "orders-algo", "instType": "SWAP"},
+            ],
+            on_message=self.on_message,
+            on_connect=self.reconcile,
+            credentials=(exchange.apiKey, exchange.secret, exchange.password),
+        )
+
+    async def on_message(self, channel, data):
+        received_at = time.time()
+        if channel == "positions":
+            for raw in data:
+                self._on_position(raw, received_at)
+        elif channel == "orders-algo":
+            for raw in data:
+                self._on_algo(raw, received_at)
+
+    def _on_position(self, raw, received_at):
+        inst_id = raw.get("instId", "")
+        confirmations.notify("position", inst_id)
+        key = _raw_position_key(raw)
+        if float(raw.get("pos") or 0) != 0:
+            self.open_positions[key] = raw
+            return
+        self.open_positions.pop(key, None)
+        # Vẫn còn vị thế khác (chiều/chế độ margin khác) trên instId này thì giữ TP/SL
+        if any(k[0] == inst_id for k in self.open_positions):
+            return
+        order_journal.mark_dirty(inst_id, "closed")
+        orphans = [a for a in self.algos.values() if a.get("instId") == inst_id]
+        if orphans:
+            logging.info(f"📉 [WS] Vị thế {inst_id} đã đóng ➝ huỷ {len(orphans)} lệnh TP/SL")
+            self._cancel(orphans, received_at)
+
+    def _on_algo(self, raw, received_at):
+        algo_id = raw.get("algoId", "")
+        confirmations.notify("algo", raw.get("instId", ""))
+        state = raw.get("state", "")
+        if state in ["live", "partially_effective"]:
+            self.algos[algo_id] = raw
+            return
+        self.algos.pop(algo_id, None)
+        if state == "effective":
+            order_journal.mark_dirty(raw.get("instId", ""), "triggered")
+            # TP hoặc SL đã kích hoạt ➝ huỷ lệnh còn lại cùng instId, cùng chiều đóng
+            siblings = [
+                a for a in self.algos.values()
+                if a.get("instId") == raw.get("instId") and a.get("side") == raw.get("side")
+            ]
+            if siblings:
+                logging.info(f"🎯 [WS] {raw.get('instId')} đã kích hoạt {algo_id} ➝ huỷ {len(siblings)} lệnh còn lại")
+                self._cancel(siblings, received_at)
+
+    def _cancel(self, algos, received_at):
+        for algo in algos:
+            self.algos.pop(algo.get("algoId"), None)   # tránh huỷ trùng khi có sự kiện lặp
+        self.stream.loop.run_in_executor(None, self._cancel_blocking, algos, received_at)
+
+    def _cancel_blocking(self, algos, received_at):
+        report = cancel_algos(self.exchange, algos)
+        logging.info(f"✅ [WS] Đã huỷ {len(report['cancelled'])}/{len(algos)} TP/SL sau {(time.time() - received_at) * 1000:.0f} ms")
+        # Lệnh lỗi tạm thời được trả lại state để vòng đối soát kế tiếp thử lại
+        for res in report["retry"]:
+            self.stream.loop.call_soon_threadsafe(self.algos.setdefault, res["algoId"], res)
+        retry_inst_ids = {res["instId"] for res in report["retry"]}
+        for inst_id in {a.get("instId") for a in algos} - retry_inst_ids:
+            order_journal.resolve(inst_id, closed=not any(k[0] == inst_id for k in self.open_positions))
+
+    def _fetch_state(self):
+        # Lấy algo trước rồi mới lấy vị thế, tránh coi TP/SL của vị thế vừa mở là mồ côi
+        algos = fetch_pending_tp_sl(self.exchange)
+        positions = self.snapshot.get(force=True)
+        return positions, algos
+
+    async def reconcile(self):
+        started_at = time.time()
+        try:
+            positions, algos = await asyncio.get_running_loop().run_in_executor(None, self._fetch_state)
+        except Exception as e:
+            logging.error(f"❌ [WS] Lỗi đối soát REST: {e}")
+            return
+        self.open_positions = {
+            _raw_position_key(pos.get("info", {})): pos.get("info", {})
+            for pos in positions
+            if _position_size(pos) > 0
+        }
+        self.algos = {a.get("algoId"): a for a in algos}
+        open_inst_ids = {k[0] for k in self.open_positions}
+        orphans = [a for a in self.algos.values() if a.get("instId") not in open_inst_ids]
+        logging.info(f"🔁 [WS] Đối soát: {len(self.open_positions)} vị thế, {len(self.algos)} TP/SL, {len(orphans)} mồ côi")
+        if orphans:
+            self._cancel(orphans, started_at)
+
+    async def _reconcile_loop(self):
+        while True:
+            await asyncio.sleep(self.reconcile_seconds)
+            if self.stream.connected.is_set():
+                await self.reconcile()
+
+    async def run(self):
+        reconcile_task = asyncio.create_task(self._reconcile_loop())
+        try:
+            await self.stream.run()
+        finally:
+            reconcile_task.cancel()
+
+    def run_forever(self):
+        asyncio.run(self.run())
+
+
+# ✅ Giá TP/SL đã làm tròn theo tickSz (SizingTable.tp_sl) ➝ chuỗi gửi sàn, không dạng số mũ
+def _attach_algo_params(tp_price, sl_price):
+    return {
+        "tpTriggerPx": format(tp_price, "f"),
+        "tpOrdPx": "-1",
+        "tpTriggerPxType": "last",
+        "slTriggerPx": format(sl_price, "f"),
+        "slOrdPx": "-1",
+        "slTriggerPxType": "last",
+    }
+
+
+def _sheet_csv_url(url=None):
+    return (url or SPREADSHEET_URL).replace("/edit#gid=", "/export?format=csv&gid=")
 
-    except Exception as e:
-        logging.error(f"❌ Lỗi xử lý auto cancel TP/SL: {e}")
 
 def fetch_sheet():
     try:
-        csv_url = SPREADSHEET_URL.replace("/edit#gid=", "/export?format=csv&gid=")
-        res = requests.get(csv_url)
+        with metrics.stage("fetch_sheet"):
+            res = http_session.get(_sheet_csv_url(), timeout=15)
         res.raise_for_status()
         return list(csv.reader(res.content.decode("utf-8").splitlines()))
     except Exception as e:
         logging.error(f"❌ Không thể tải Google Sheet: {e}")
         return []
 
-def run_bot():
-    now = datetime.utcnow()
-    rows = fetch_sheet()
-    if not rows:
-        return
-    rows = rows[1:]
 
-    for row in rows:
+# ✅ Poll sheet có điều kiện (ETag / If-Modified-Since / hash nội dung): không đổi thì trả None
+class SheetPoller:
+    def __init__(self, session=None, url=None):
+        self.session = session or http_session
+        self.url = url
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+        self.rows = None            # nội dung lần đọc gần nhất: sheet không đổi vẫn chạy lại được dòng "retry"
+        # Tình trạng lần poll gần nhất (runner.py báo health theo từng sheet)
+        self.polled_at = 0
+        self.last_ok_at = 0
+        self.last_error = None
+
+    def poll(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        self.polled_at = time.time()
         try:
-            logging.info(f"🔍 Kiểm tra dòng: {row}")
-            if len(row) < 7:
-                logging.warning("⚠️ Dòng thiếu dữ liệu")
-                continue
+            with metrics.stage("fetch_sheet"):
+                res = self.session.get(self.url or _sheet_csv_url(), headers=headers, timeout=15)
+            if res.status_code == 304:
+                self.last_ok_at, self.last_error = time.time(), None
+                return None
+            res.raise_for_status()
+        except Exception as e:
+            logging.error(f"❌ Không thể tải Google Sheet: {e}")
+            self.last_error = str(e)
+            return None
+        self.last_ok_at, self.last_error = time.time(), None
+        self.etag = res.headers.get("ETag") or self.etag
+        self.last_modified = res.headers.get("Last-Modified") or self.last_modified
+        content_hash = hashlib.sha256(res.content).hexdigest()
+        if content_hash == self.content_hash:
+            return None
+        self.content_hash = content_hash
+        self.rows = list(csv.reader(res.content.decode("utf-8").splitlines()))
+        return self.rows
 
-            symbol, signal, entry_price, sl_str, tp_str, created_at_str, interval = row
-            entry_price = float(entry_price)
-            sl = float(sl_str.strip('%')) / 100
-            tp = float(tp_str.strip('%')) / 100
-            interval = int(interval)
-            created_at = datetime.strptime(created_at_str.strip(), "%Y-%m-%d %H:%M:%S") - timedelta(hours=7)
-            elapsed_minutes = (now - created_at).total_seconds() / 60
-            if elapsed_minutes > interval:
-                logging.info(f"⏱ Lệnh quá hạn: {symbol}")
-                continue
 
-            if signal not in ["LONG", "SHORT"]:
-                logging.warning("⚠️ Tín hiệu không hợp lệ")
-                continue
+def signal_hash(row):
+    normalized = "|".join(cell.strip() for cell in row)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
 
-            side = "buy" if signal == "LONG" else "sell"
-            pos_side = "long" if signal == "LONG" else "SHORT"
-            
-            # Tính khối lượng dựa trên 30 USDT vốn thật và đòn bẩy x5
-            usdt_limit = 30
-            leverage = 4
-            ticker = exchange.fetch_ticker(symbol)
-            ask_price = float(ticker.get('ask') or 0)          
-            
-            if ask_price <= 0:
-                logging.error(f"⚠️ Không lấy được giá hợp lệ cho {symbol}")
-                continue
 
-            # ✅ Lấy lotSize từ exchange.markets
-            symbol_check = symbol.replace("-", "/").upper()
-            market = exchange.markets.get(symbol_check)
-            lot_size = market['limits']['amount']['min'] or 0.001
-            
-            # ✅ Tính và làm tròn về đúng bội số
-            raw_amount = (usdt_limit * leverage) / ask_price
-            coin_amount = round(raw_amount / lot_size) * lot_size
-            coin_amount = float(f"{coin_amount:.6f}")  # đảm bảo định dạng
-
-            # ✅ Chuẩn hóa SYMBOL và SIDE từ đầu vào
-            symbol_for_order = market['id']
-            side_input = side.lower()
-            side_check = 'long' if side_input == 'buy' else 'short' if side_input == 'sell' else None
-            
-            if side_check is None:
-                logging.error(f"❌ SIDE không hợp lệ: {side}")
-                continue
-            
-            # ✅ Fetch tất cả vị thế hiện tại
-            try:
-                all_positions = exchange.fetch_positions()
-            except Exception as e:
-                logging.error(f"❌ Không thể fetch vị thế: {e}")
-                return
+# ✅ Ledger SQLite các tín hiệu đã xử lý: khởi động lại không bắn lại lệnh cũ
+class SignalLedger:
+    def __init__(self, path=SIGNAL_LEDGER_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS signals ("
+            " row_hash TEXT PRIMARY KEY, symbol TEXT, signal TEXT, created_at TEXT,"
+            " status TEXT, first_seen REAL, updated_at REAL)"
+        )
+        self.conn.commit()
+        self.known = {r[0] for r in self.conn.execute("SELECT row_hash FROM signals")}
 
-            has_position_open = False
-            for pos in all_positions:
-                pos_symbol = pos.get('symbol', '').split(":")[0].upper()        # Ví dụ BTC/USDT:USDT => BTC/USDT
-                side_open = pos.get('side') or pos.get('posSide', '')
-                side_open = side_open.lower()                         # long / short
-                margin_mode = pos.get('marginMode', '')                         # isolated / cross
-            
-                if (
-                    pos_symbol == symbol_check and
-                    side_open == side_check and
-                    margin_mode == 'isolated'
-                ):
-                    logging.warning(f"⚠️ ĐÃ CÓ VỊ THẾ {side_check.upper()} mở với {symbol_check} => KHÔNG đặt thêm lệnh")
-                    has_position_open = True
-                    break # không cần kiểm tra thêm
-            # ✅ Đã có vị thế bỏ qua coin này
-            if has_position_open:
+    def seen(self, row_hash):
+        return row_hash in self.known
+
+    def claim(self, row_hash, row):
+        # Ghi "pending" trước khi xử lý: nếu bot chết giữa chừng cũng không bắn lại
+        with self._lock:
+            if row_hash in self.known:
+                return False
+            now = time.time()
+            cells = list(row) + [""] * 7
+            self.conn.execute(
+                "INSERT OR IGNORE INTO signals VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+                (row_hash, cells[0].strip(), cells[1].strip(), cells[5].strip(), now, now)
+            )
+            self.conn.commit()
+            self.known.add(row_hash)
+            return True
+
+    def finish(self, row_hash, status):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE signals SET status = ?, updated_at = ? WHERE row_hash = ?",
+                (status, time.time(), row_hash)
+            )
+            self.conn.commit()
+
+    def record_many(self, entries):
+        # Ghi hàng loạt các dòng bị loại (row_hash, row, status) trong 1 transaction
+        now = time.time()
+        values = []
+        for row_hash, row, status in entries:
+            if row_hash in self.known:
                 continue
+            cells = list(row) + [""] * 7
+            values.append((row_hash, cells[0].strip(), cells[1].strip(), cells[5].strip(), status, now, now))
+        if not values:
+            return 0
+        with self._lock:
+            self.conn.executemany("INSERT OR IGNORE INTO signals VALUES (?, ?, ?, ?, ?, ?, ?)", values)
+            self.conn.commit()
+            self.known.update(v[0] for v in values)
+        return len(values)
+
+    def release(self, row_hash):
+        with self._lock:
+            self.conn.execute("DELETE FROM signals WHERE row_hash = ?", (row_hash,))
+            self.conn.commit()
+            self.known.discard(row_hash)
+
+
+# ✅ Journal SQLite (WAL) lệnh vào + algoId TP/SL bot đã đặt: watcher chỉ đối soát instrument "dirty"
+class OrderJournal:
+    def __init__(self, path=ORDER_JOURNAL_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " ord_id TEXT PRIMARY KEY, row_hash TEXT, inst_id TEXT, side TEXT, sz REAL,"
+            " entry_mode TEXT, state TEXT, reason TEXT, created_at REAL, updated_at REAL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS algos ("
+            " algo_id TEXT PRIMARY KEY, ord_id TEXT, inst_id TEXT, kind TEXT, state TEXT, updated_at REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_state ON entries (state, inst_id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS algos_inst ON algos (inst_id, state)")
+        self.conn.commit()
+
+    def record_entry(self, ord_id, inst_id, side, sz, entry_mode, row_hash=""):
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, 'open', '', ?, ?)",
+                (str(ord_id), row_hash, inst_id, side, float(sz), entry_mode, now, now)
+            )
+            self.conn.commit()
+
+    def record_algos(self, ord_id, inst_id, algos):
+        # algos: [(algoId, kind)] với kind = oco | tp | sl
+        now = time.time()
+        values = [(algo_id, str(ord_id), inst_id, kind, now) for algo_id, kind in algos if algo_id]
+        if not values:
+            return
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO algos VALUES (?, ?, ?, ?, 'live', ?)", values)
+            self.conn.commit()
+
+    def mark_dirty(self, inst_id, reason, before=None):
+        # before: chỉ đánh dấu lệnh ghi trước mốc này (thời điểm lấy snapshot vị thế)
+        query = "UPDATE entries SET state = 'dirty', reason = ?, updated_at = ? WHERE inst_id = ? AND state = 'open'"
+        params = [reason, time.time(), inst_id]
+        if before is not None:
+            query += " AND created_at < ?"
+            params.append(before)
+        with self._lock:
+            self.conn.execute(query, params)
+            self.conn.commit()
+
+    def opened_since(self, fetched_at):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT inst_id FROM entries WHERE state != 'closed' AND created_at >= ?", (fetched_at,)
+            ).fetchall()
+        return {r[0] for r in rows}
+
+    def sync_positions(self, open_sizes, fetched_at=None):
+        # Vị thế đã đóng ➝ dirty "closed", nhỏ hơn khối lượng đã vào ➝ dirty "partial"
+        # fetched_at: bỏ qua lệnh ghi sau lúc lấy snapshot (snapshot chưa thấy vị thế của lệnh đó)
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT inst_id, SUM(sz) FROM entries WHERE state = 'open' AND created_at < ? GROUP BY inst_id",
+                (fetched_at,)
+            ).fetchall()
+        for inst_id, sz in rows:
+            size = open_sizes.get(inst_id, 0)
+            if size <= 0:
+                self.mark_dirty(inst_id, "closed", before=fetched_at)
+            elif size < sz - 1e-9:
+                self.mark_dirty(inst_id, "partial", before=fetched_at)
+
+    def dirty(self):
+        with self._lock:
+            inst_ids = [r[0] for r in self.conn.execute("SELECT DISTINCT inst_id FROM entries WHERE state = 'dirty'")]
+            algos = self.conn.execute(
+                "SELECT inst_id, algo_id FROM algos WHERE state = 'live' AND inst_id IN "
+                "(SELECT inst_id FROM entries WHERE state = 'dirty')"
+            ).fetchall()
+        dirty = {inst_id: [] for inst_id in inst_ids}
+        for inst_id, algo_id in algos:
+            dirty[inst_id].append(algo_id)
+        return dirty
+
+    def resolve(self, inst_id, closed=True):
+        now = time.time()
+        with self._lock:
+            if closed:
+                self.conn.execute(
+                    "UPDATE entries SET state = 'closed', updated_at = ? WHERE inst_id = ? AND state != 'closed'",
+                    (now, inst_id)
+                )
+                self.conn.execute(
+                    "UPDATE algos SET state = 'cancelled', updated_at = ? WHERE inst_id = ? AND state = 'live'",
+                    (now, inst_id)
+                )
+            else:
+                self.conn.execute(
+                    "UPDATE entries SET state = 'open', updated_at = ? WHERE inst_id = ? AND state = 'dirty'",
+                    (now, inst_id)
+                )
+            self.conn.commit()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM entries GROUP BY state").fetchall())
+
+
+sheet_poller = SheetPoller()
+signal_ledger = SignalLedger()
+order_journal = OrderJournal()
+
+
+# ✅ Parse toàn bộ sheet thành DataFrame 1 lần, loại hàng loạt dòng hỏng/quá hạn/trùng/không có instrument
+def parse_signals(rows, now, catalog=None):
+    catalog = catalog or instrument_catalog
+    catalog.ensure_fresh()
+    df = pd.DataFrame(
+        [list(row[:7]) + [""] * (7 - len(row[:7])) for row in rows],
+        columns=SHEET_COLUMNS,
+        dtype="string",
+    )
+    df = df.apply(lambda col: col.str.strip())
+    df["row"] = rows
+    df["row_hash"] = [signal_hash(row) for row in rows]
+    df["short_row"] = [len(row) < 7 for row in rows]
+
+    df["symbol"] = df["symbol"].str.upper()
+    df["signal"] = df["signal"].str.upper()
+    df["entry_price"] = pd.to_numeric(df["entry_price"], errors="coerce")
+    df["sl_pct"] = pd.to_numeric(df["sl"].str.rstrip("%"), errors="coerce") / 100
+    df["tp_pct"] = pd.to_numeric(df["tp"].str.rstrip("%"), errors="coerce") / 100
+    df["interval"] = pd.to_numeric(df["interval"], errors="coerce")
+    # Giờ trên sheet lệch UTC SHEET_UTC_OFFSET_HOURS giờ
+    df["created_at"] = pd.to_datetime(df["created_at"], format="%Y-%m-%d %H:%M:%S", errors="coerce") \
+        - pd.Timedelta(hours=SHEET_UTC_OFFSET_HOURS)
+    df["expires_at"] = df["created_at"] + pd.to_timedelta(df["interval"], unit="m")
+    df = df.join(catalog.frame(), on="symbol")
+
+    reason = pd.Series(pd.NA, index=df.index, dtype="object")
+
+    def _reject(mask, label):
+        reason[mask.fillna(True).astype(bool) & reason.isna()] = label
+
+    numeric_missing = df[["entry_price", "sl_pct", "tp_pct", "interval"]].isna().any(axis=1)
+    _reject(df["short_row"] | numeric_missing | df["created_at"].isna(), "malformed")
+    _reject(~df["signal"].isin(["LONG", "SHORT"]), "invalid_signal")
+    _reject(df["expires_at"] < pd.Timestamp(now), "expired")
+    _reject(df["instId"].isna(), "unknown_instrument")
+    _reject((df["settleCcy"] != "USDT") | (df["ctType"].notna() & (df["ctType"] != "linear")), "unsupported_instrument")
+
+    # Cùng instrument + cùng chiều trong 1 lần đọc ➝ chỉ giữ tín hiệu mới nhất
+    alive = df[reason.isna()].sort_values("created_at", kind="stable")
+    duplicated = alive.duplicated(subset=["instId", "signal"], keep="last")
+    reason[duplicated[duplicated].index] = "duplicate"
+
+    df["reason"] = reason
+    signals = df[reason.isna()].drop(columns=["reason"])
+    rejects = df[reason.notna()]
+    return signals, rejects
+
+
+# sig: 1 dòng đã parse / kiểm tra trong parse_signals (giá, %, giờ tạo, hạn đã có kiểu) ➝ không parse lại từ chuỗi
+def prepare_signal(sig, now):
+    row = sig["row"]
+    logging.info(f"🔍 Kiểm tra dòng: {row}")
+    symbol, signal = row[0], sig["signal"]
+    metrics.mark("signal", at=sig["created_at"].timestamp())
+    # Dòng chờ sau batch có thể quá hạn khi tới lượt
+    if pd.Timestamp(now) > sig["expires_at"]:
+        logging.info(f"⏱ Lệnh quá hạn: {symbol}")
+        return "expired", None
+    side = "buy" if signal == "LONG" else "sell"
+
+    # ✅ Tra instrument trong catalog (BTC-USDT ➝ BTC-USDT-SWAP / BTC/USDT:USDT), không load lại markets
+    symbol_raw = sig["symbol"]                     # Ví dụ: BTC-USDT
+    with metrics.stage("instrument"):
+        inst = instrument_catalog.get(symbol_raw)
+    if not inst:
+        logging.error(f"❌ Symbol {symbol_raw} không có trong danh sách SWAP của OKX! Bỏ qua...")
+        return "skipped", None
+
+    # ✅ Chỉ chấp nhận USDT-M Swap (Linear)
+    if inst["settleCcy"] != "USDT" or inst["ctType"] not in ["linear", None]:
+        logging.error(f"❌ Symbol {inst['instId']} không phải USDT-M (ctType={inst['ctType']}, settle={inst['settleCcy']})! Bỏ qua...")
+        return "skipped", None
+    symbol_ccxt = inst["ccxt_symbol"]              # BTC/USDT:USDT
+    logging.info(f"✅ Symbol {symbol_ccxt} là USDT-M SWAP ➜ Cho phép đặt lệnh")
+
+    # Tính khối lượng dựa trên 30 USDT vốn thật và đòn bẩy x4 (số hợp đồng tính trong size_entries)
+    usdt_limit = 30
+    leverage = 4
+    with metrics.stage("ticker"):
+        quote = ticker_snapshot.get(inst["instId"])
+    ask_price = quote["ask"] if quote else 0
+    
+    if ask_price <= 0:
+        logging.error(f"⚠️ Không lấy được giá hợp lệ cho {symbol}")
+        return "retry", None
+
+    symbol_check = symbol_raw.replace("-", "/")
+
+    # ✅ Chuẩn hóa SIDE từ đầu vào
+    side_input = side.lower()
+    side_check = 'long' if side_input == 'buy' else 'short' if side_input == 'sell' else None
+    
+    if side_check is None:
+        logging.error(f"❌ SIDE không hợp lệ: {side}")
+        return "invalid", None
+    
+    # ✅ Kiểm tra vị thế hiện tại từ snapshot dùng chung
+    symbol_instId = inst["instId"]
+    try:
+        with metrics.stage("positions"):
+            has_position_open = position_snapshot.find(symbol_instId, side_check, "isolated") is not None
+    except Exception as e:
+        logging.error(f"❌ Không thể fetch vị thế: {e}")
+        return "retry", None
+
+    # ✅ Đã có vị thế bỏ qua coin này
+    if has_position_open:
+        logging.warning(f"⚠️ ĐÃ CÓ VỊ THẾ {side_check.upper()} mở với {symbol_check} => KHÔNG đặt thêm lệnh")
+        return "skipped", None
+
+    # ✅ vào lệnh
+    # Đặt đòn bẩy 4x (context đã pre-warm thì đòn bẩy đã đặt sẵn, không gọi lại)
+    context = execution_contexts.get(symbol_instId)
+    if context is None or context["lever"] != leverage:
+        with metrics.stage("set_leverage"):
+            leverage_changed = leverage_cache.ensure(symbol_instId, leverage, "isolated")
+        if leverage_changed:
+            logging.info(f"⚙️ Đã đặt đòn bẩy {leverage}x cho {symbol}")
+
+    # ✅ Chuẩn bị tham số lệnh vào: template dựng sẵn (instId / tdMode / ordType) + tham số thêm (attachAlgoOrds)
+    entry_mode = ENTRY_MODE
+    order_params = {}
+
+    ctx = {
+        "row": row,
+        "row_hash": sig["row_hash"],
+        "symbol": symbol,
+        "symbol_raw": symbol_raw,
+        "symbol_instId": symbol_instId,
+        "inst": inst,
+        "side": side,
+        "side_check": side_check,
+        "ask_price": ask_price,
+        "notional": usdt_limit * leverage,
+        "entry_mode": entry_mode,
+        "template": context["template"] if context else _order_template(symbol_instId),
+        "order_params": order_params,
+    }
+    return "ready", ctx
+
+
+# ✅ Số hợp đồng + giá TP/SL cho cả batch trong 1 lần gọi (Decimal theo bảng quy cách), dòng không đủ minSz bị loại trước khi gửi sàn
+def size_entries(ctxs):
+    with metrics.stage("sizing"):
+        sized = instrument_catalog.sizing.size_batch([
+            (ctx["symbol_instId"], ctx["side_check"], ctx["ask_price"], ctx["notional"]) for ctx in ctxs
+        ])
+    ready = []
+    for ctx, res in zip(ctxs, sized):
+        if res["reason"]:
+            logging.error(f"❌ Không tính được khối lượng lệnh {ctx['symbol']} ({res['reason']}) ➝ bỏ qua")
+            ctx["sizing_error"] = res["reason"]
+            continue
+        ctx["sz"] = res["sz"]
+        if ctx["entry_mode"] == "attach":
+            # TP/SL gắn kèm lệnh vào ➝ vị thế mở ra là đã có stop, chỉ 1 request
+            ctx["tp_price"], ctx["sl_price"] = res["tp"], res["sl"]
+            ctx["order_params"]["attachAlgoOrds"] = [_attach_algo_params(res["tp"], res["sl"])]
+        ready.append(ctx)
+    return ready
+
+
+def submit_entry(ctx):
+    with metrics.stage("create_order"):
+        order = _submit_entry(ctx)
+    if order is not None:
+        metrics.mark("fill")
+    return order
+
+
+def _place_order(ctx):
+    # Chỉ 1 request /trade/order từ template dựng sẵn (không qua load_markets / chuẩn hoá lệnh của ccxt)
+    data = exchange.private_post_trade_order(_order_request(ctx)).get("data", [])
+    res = data[0] if data else {}
+    return {"id": res.get("ordId"), "clientOrderId": ctx["clOrdId"], "info": res}
+
+
+def _submit_entry(ctx):
+    symbol, side = ctx["symbol"], ctx["side"]
+    try:
+        return _place_order(ctx)
+    except (ccxt.InvalidOrder, ccxt.BadRequest) as e:
+        # Chỉ lỗi do attachAlgoOrds mới fallback OCO (sai lotSz 51121, vượt maxMktSz 51202... gửi lại cũng lỗi)
+        if ctx["entry_mode"] != "attach" or not _error_s_codes(e) & ATTACH_REJECT_S_CODES:
+            logging.error(f"❌ Lỗi khi gửi lệnh {symbol} | side={side}: {e}")
+            return None
+        # Sàn từ chối attachAlgoOrds ➝ vào lệnh thường rồi đặt 1 lệnh OCO
+        logging.warning(f"⚠️ Không gắn được TP/SL vào lệnh {symbol}, chuyển sang OCO: {e}")
+        _fallback_to_oco(ctx)
+        try:
+            return _place_order(ctx)
+        except Exception as e2:
+            logging.error(f"❌ Lỗi khi gửi lệnh fallback {symbol} | side={side}: {e2}")
+            return None
+    except Exception as e:
+        logging.error(f"❌ Lỗi khi gửi lệnh {symbol} | side={side}: {e}")
+        return None
+
+
+def _fallback_to_oco(ctx):
+    ctx["entry_mode"] = "oco"
+    ctx["order_params"].pop("attachAlgoOrds", None)
+
+
+def protect_position(ctx, order):
+    symbol, symbol_raw, inst = ctx["symbol"], ctx["symbol_raw"], ctx["inst"]
+    side, side_check = ctx["side"], ctx["side_check"]
+    symbol_instId, entry_mode = ctx["symbol_instId"], ctx["entry_mode"]
+    order_id = order.get("id")
+    order_journal.record_entry(order_id, symbol_instId, side, float(ctx["sz"]), entry_mode, ctx["row_hash"])
+
+    if entry_mode == "attach":
+        logging.info(f"✅ Đã vào lệnh {symbol} ({ctx['sz']} hợp đồng) kèm TP={ctx['tp_price']} / SL={ctx['sl_price']}: {order.get('id')}")
+        if WATCHER_MODE == "poll":
+            watch_scheduler.track(symbol_instId, (ctx["tp_price"], ctx["sl_price"]))
+        metrics.mark("stop")
+        return "placed"
+
+    # ✅ Chờ vị thế xuất hiện sau khi vào lệnh (ép làm mới snapshot, dậy sớm nếu stream báo vị thế thay đổi)
+    with metrics.stage("confirm_position"):
+        confirmations.wait(
+            "position", symbol_instId,
+            lambda: position_snapshot.find(symbol_instId, side_check, "isolated", force=True),
+        )
+    # ✅ Bắt đầu đặt SL/TP 
+    # --- Lấy market price ---
+    try:
+        with metrics.stage("ticker"):
+            quote = ticker_snapshot.get(symbol_instId)
+        if not quote:
+            raise ValueError(f"giá quá cũ (> {ticker_snapshot.max_age}s)")
+        market_price = quote["last"]
+        logging.debug("✅ [Market Price] Giá thị trường hiện tại của %s = %s", symbol, market_price)
+    except Exception as e:
+        logging.error(f"❌ [Market Price] Không lấy được giá hiện tại cho {symbol}: {e}")
+        return "placed"
+        
+    # --- Lấy size từ snapshot vị thế (vừa làm mới sau khi vào lệnh) ---
+    try:
+        positions = position_snapshot.get()
+        logging.debug("✅ [Positions] Đã fetch %s vị thế: %s", len(positions), positions)
+    except Exception as e:
+        logging.error(f"❌ [Positions] Không thể fetch vị thế: {e}")
+        return "placed"
+        
+    symbol_check = symbol.replace("-", "/").upper()
+    side_input = side.lower()
+    side_check = 'long' if side_input == 'buy' else 'short' if side_input == 'sell' else None
+    pos_size = None
+    
+    # đoạn xử lý SL/TP
+    for pos in positions:
+        logging.debug("[Position] Kiểm tra từng vị thế: %s", pos)
+    
+        pos_symbol = pos.get('symbol', '').upper().replace(':USDT', '')
+        pos_inst_id, pos_side, margin_mode = _position_key(pos)
+        current_size = _position_size(pos)
+    
+        logging.debug(
+            "[DEBUG MATCH] symbol_check=%s, side_check=%s vs pos_symbol=%s, pos_side=%s, margin_mode=%s, size=%s",
+            symbol_check, side_check, pos_symbol, pos_side, margin_mode, current_size,
+        )
+        if (
+            pos_inst_id == symbol_instId and
+            pos_side == side_check and
+            margin_mode == 'isolated' and
+            current_size > 0
+        ):
+            logging.info(f"✅ [Position] Tìm thấy vị thế phù hợp để đặt TP/SL cho {symbol_check}")
+            pos_size = current_size
+            break
+
+    if not pos_size:
+        logging.error(f"❌ [Position] Không tìm thấy vị thế {symbol_instId} {side_check} để đặt TP/SL")
+        return "placed"
+
+    # Làm tròn size về đúng bội số lotSz (Decimal, theo bảng quy cách của catalog)
+    sizing = instrument_catalog.sizing
+    adjusted_size = sizing.round_size(symbol_instId, pos_size)
+    if adjusted_size is None:
+        logging.error(f"❌ [Position] Size {pos_size} của {symbol_instId} không hợp lệ theo lotSz/minSz ➝ không đặt TP/SL")
+        return "placed"
+
+    # 📈 Tính giá TP/SL
+    if side_check not in ['long', 'short']:
+        logging.error(f"❌ SIDE không hợp lệ: {side_check}")
+        return "placed"
+    tp_price, sl_price, opposite_side = sizing.tp_sl(symbol_instId, side_check, market_price)
+    if WATCHER_MODE == "poll":
+        watch_scheduler.track(symbol_instId, (tp_price, sl_price))
+
+    # ✅ Đặt TP + SL bằng 1 lệnh OCO
+    if entry_mode == "oco":
+        try:
+            oco_order = exchange.private_post_trade_order_algo({
+                "instId": symbol_instId,
+                "tdMode": "isolated",
+                "side": opposite_side,
+                "ordType": "oco",
+                "sz": format(adjusted_size, "f"),
+                **_attach_algo_params(tp_price, sl_price),
+            })
+            logging.info(f"✅ OCO Order Response: {oco_order}")
+            order_journal.record_algos(order_id, symbol_instId, [(a.get("algoId"), "oco") for a in oco_order.get("data", [])])
+            metrics.mark("stop")
+        except Exception as e:
+            logging.error(f"❌ Lỗi đặt OCO TP/SL: {e}")
+        tp_price = None    # đã đặt bằng OCO, bỏ qua 2 lệnh trigger bên dưới
+    
+    # ✅ Đặt TP
+    # Đặt TP
+    if tp_price:
+        try:
+            tp_order = exchange.private_post_trade_order_algo({
+                "instId": symbol_instId,
+                "tdMode": "isolated",
+                "side": opposite_side,
+                "ordType": "trigger",
+                "triggerPx": format(tp_price, "f"),
+                "orderPx": "-1",
+                "triggerPxType": "last",  # BỔ SUNG DÒNG NÀY
+                "sz": format(adjusted_size, "f"),
+            })
+            logging.info(f"✅ TP Order Response: {tp_order}")
+            order_journal.record_algos(order_id, symbol_instId, [(a.get("algoId"), "tp") for a in tp_order.get("data", [])])
+        except Exception as e:
+            logging.error(f"❌ Lỗi đặt TP: {e}")
             
-            # ⚙️ Cấu hình load markets cho futures
-            exchange.options['defaultType'] = 'future'
-            exchange.load_markets()
-            market = exchange.markets.get(symbol_check)
-
-            # ✅ Hàm lấy danh sách symbol USDT-M Futures trực tiếp từ OKX
-            def fetch_okx_usdt_futures_symbols():
-                url = "https://www.okx.com/api/v5/public/instruments?instType=SWAP"  # hoặc FUTURES nếu bạn muốn FUTURES thay vì perpetual
-                try:
-                    response = requests.get(url)
-                    response.raise_for_status()
-                    data = response.json()
-                    instruments = data.get("data", [])
-                    symbols = []
-            
-                    for item in instruments:
-                        # Chỉ chọn USDT-M (linear), bỏ qua COIN-M
-                        if item.get("settleCcy") == "USDT" and item.get("ctType") in ["linear", None]:
-                            inst_id = item["instId"]  # VD: BTC-USDT-SWAP
-                            symbols.append(inst_id)
-            
-                    return list(set(symbols))  # Loại trùng
-                except Exception as e:
-                    logging.error(f"❌ Không thể fetch Futures symbols từ OKX: {e}")
-                    return []
-            
-            # ✅ Lấy danh sách symbols từ API OKX (Futures)
-            futures_symbols_okx = fetch_okx_usdt_futures_symbols()
-            
-            # ✅ Duyệt từng dòng trong sheet
-            symbol_raw = row[0]                            # Ví dụ: BTC-USDT
-            symbol_check = f"{symbol_raw}-SWAP"  # BTC-USDT-SWAP
-            symbol_ccxt = f"{symbol_raw.replace("-", "/")}:USDT".upper()   # BTC/USDT:USDT
+    # ✅ Đặt SL
+    if tp_price:
+        try:
+            tp_order = exchange.private_post_trade_order_algo({
+                "instId": symbol_instId,
+                "tdMode": "isolated",
+                "side": opposite_side,
+                "ordType": "trigger",
+                "triggerPx": format(sl_price, "f"),
+                "orderPx": "-1",
+                "triggerPxType": "last",  # BỔ SUNG DÒNG NÀY
+                "sz": format(adjusted_size, "f"),
+            })
+            logging.info(f"✅ SL Order Response: {tp_order}")
+            order_journal.record_algos(order_id, symbol_instId, [(a.get("algoId"), "sl") for a in tp_order.get("data", [])])
+            metrics.mark("stop")
+        except Exception as e:
+            logging.error(f"❌ Lỗi đặt SL: {e}")
+
+    # Gọi hàm huỷ nếu vị thế đã đóng
+    # ✅ Chuẩn hoá thành COIN-USDT-SWAP
+    symbol_check = symbol_raw.strip().upper().replace("/", "-").replace(":USDT", "-") + "-SWAP"  # FXS-USDT-SWAP
+    # ✅ Duyệt vị thế hiện tại
+    try:
+        all_positions = position_snapshot.get()
+        for pos in all_positions:
+            pos_symbol_check = pos.get("symbol", "").upper().replace("/", "-").replace(":USDT", "") + "-SWAP"
+            contracts = _position_size(pos)
+            margin_mode = pos.get("marginMode", "").lower()
         
-            # ✅ Bước 1: check nếu symbol không nằm trong danh sách fetch từ API OKX
-            if symbol_check not in futures_symbols_okx:
-                continue
+            logging.debug("[CHECK] ↪ symbol_check=%s, pos_symbol_check=%s", symbol_check, pos_symbol_check)
+  
         
-            # ✅ Bước 2: Check trong exchange.markets xem symbol có tồn tại và đúng loại không
-            market = exchange.markets.get(symbol_ccxt)
+            if pos_symbol_check == symbol_check and contracts <= 0.0000001 and margin_mode in ["isolated", "cross"]:
+                logging.warning(f"⚠️ Vị thế {symbol_check} đã đóng → huỷ TP/SL nếu còn treo")
         
-            if not market:
-                logging.error(f"❌ Symbol {symbol_ccxt} không tồn tại trong exchange.markets!")
-                continue
+                symbol_instId = pos.get("instId")
+                if not symbol_instId:
+                    symbol_instId = symbol_check.replace("/", "-")
+                    if not symbol_instId.endswith("-SWAP"):
+                        symbol_instId += "-SWAP"
+        
+                # ✅ Chờ TP/SL đang treo theo instId (trigger + OCO)
+                orders_to_cancel = confirmations.wait(
+                    "algo", symbol_instId,
+                    lambda: fetch_pending_tp_sl(exchange, symbol_instId),
+                    timeout=5,
+                ) or []
         
-            # ✅ Bước 3: Check đúng loại USDT-M Futures/Swap (Linear)
-            market_type = market.get('type')
-            settle_coin = market.get('settle')
-                        
-            if settle_coin and settle_coin.lower() == 'usdt' and market_type in ['future', 'swap']:
-                logging.info(f"✅ Symbol {symbol_ccxt} là USDT-M {market_type.upper()} ➜ Cho phép đặt lệnh")
+                # ✅ Huỷ toàn bộ TP/SL theo batch
+                if orders_to_cancel:
+                    cancel_algos(exchange, [
+                        {"algoId": order.get("algoId"), "instId": symbol_instId}
+                        for order in orders_to_cancel
+                    ])
+                continue  # Qua symbol khác
+    except Exception as e:
+        logging.error(f"❌ Lỗi kiểm tra vị thế để huỷ TP/SL: {e}")
+    return "placed"
+
+
+def process_signal(sig, now):
+    order = None
+    try:
+        status, ctx = prepare_signal(sig, now)
+        if status != "ready":
+            return status
+        if not size_entries([ctx]):
+            return "skipped"
+        order = submit_entry(ctx)
+        if order is None:
+            return "error"
+        return protect_position(ctx, order)
+    except Exception as e:
+        logging.error(f"❌ Lỗi xử lý dòng: {e}")
+        # Lỗi mạng trước khi gửi lệnh ➝ cho phép thử lại ở vòng poll sau
+        if order is None and isinstance(e, ccxt.NetworkError):
+            return "retry"
+        return "error" if order is None else "placed"
+
+
+# ✅ Request vào lệnh = template của instrument + chiều / size / clOrdId (chữ đầu theo entry_mode: gửi lại sau fallback OCO không trùng clOrdId)
+def _order_request(ctx):
+    ctx["clOrdId"] = f"{ctx['entry_mode'][0]}{ctx['row_hash'][:31]}"
+    request = dict(ctx["template"], side=ctx["side"], sz=format(ctx["sz"], "f"), clOrdId=ctx["clOrdId"])
+    if "attachAlgoOrds" in ctx["order_params"]:
+        request["attachAlgoOrds"] = ctx["order_params"]["attachAlgoOrds"]
+    return request
+
+
+# ✅ Vào lệnh hàng loạt qua /trade/batch-orders (tối đa 20 lệnh / request), map kết quả về từng dòng theo clOrdId
+
+
+def submit_entries_batch(ctxs):
+    results = []
+    for i in range(0, len(ctxs), BATCH_ORDER_SIZE):
+        chunk = ctxs[i:i + BATCH_ORDER_SIZE]
+        payload = [_order_request(ctx) for ctx in chunk]
+        batch_trace = metrics.start_trace("batch-orders")
+        try:
+            with metrics.bind(batch_trace), metrics.stage("create_order"):
+                data = exchange.private_post_trade_batch_orders(payload).get("data", [])
+        except Exception as e:
+            logging.error(f"❌ Lỗi gửi batch {len(chunk)} lệnh: {e}")
+            data = _batch_error_data(e)
+        for ctx in chunk:
+            metrics.add_stage(
+                ctx.get("trace"), "create_order", batch_trace["stages"].get("create_order", 0),
+                calls=batch_trace["calls"], rate_wait=batch_trace["rate_wait"], errors=batch_trace["errors"],
+            )
+        by_cl_ord_id = {item.get("clOrdId"): item for item in data}
+        for ctx in chunk:
+            res = by_cl_ord_id.get(ctx["clOrdId"], {"sCode": "-1", "sMsg": "không có phản hồi"})
+            s_code = str(res.get("sCode"))
+            if s_code == "0":
+                ctx["filled_at"] = time.time()
+                results.append((ctx, {"id": res.get("ordId"), "clientOrderId": ctx["clOrdId"], "info": res}))
+            elif ctx["entry_mode"] == "attach" and s_code in ATTACH_REJECT_S_CODES:
+                # TP/SL gắn kèm bị từ chối ➝ gửi lại riêng lệnh này, TP/SL đặt bằng OCO
+                logging.warning(f"⚠️ Không gắn được TP/SL vào lệnh {ctx['symbol']} ({s_code}), chuyển sang OCO")
+                _fallback_to_oco(ctx)
+                with metrics.bind(ctx.get("trace")):
+                    results.append((ctx, submit_entry(ctx)))
             else:
-                logging.error(f"❌ Symbol {symbol_ccxt} không phải USDT-M Futures (type={market_type}, settle={settle_coin})! Bỏ qua...")
-                continue
-       
-            # ✅ vào lệnh
-            # Đặt đòn bẩy 4x
-            exchange.set_leverage(4, symbol=symbol_check)
-            logging.info(f"⚙️ Đã đặt đòn bẩy 4x cho {symbol}")
-
-            symbol_for_order = market['id']
-            # ✅ Vào lệnh — ưu tiên dùng symbol_for_order
-            # coin_amount
-            try:
-                order = exchange.create_market_order(
-                    symbol=symbol_for_order,
-                    side=side,
-                    amount=coin_amount,
-                    params={
-                        "tdMode": "isolated",
-                        "ccy": "USDT",
-                        "reduceOnly": False,
-                        "lever": "4"
-                    }
-                )
-            except Exception as e:
-                logging.warning(f"⚠️ Lỗi với symbol_for_order. {e}")
-                    
-                # ✅ Đợi và retry fetch vị thế sau khi vào lệnh
-                    max_retries = 5
-                    positions = []
-                    for i in range(max_retries):
-                        try:
-                            positions = exchange.fetch_positions()
-                            logging.debug(f"[Retry {i+1}] ✅ Fetch được {len(positions)} vị thế")
-                            if positions:
-                                break
-                        except Exception as e:
-                            logging.warning(f"[Retry {i+1}] ❌ Lỗi fetch vị thế: {e}")
-                        time.sleep(3)  # chờ rồi thử lại
-                except Exception as e2:
-                    logging.error(f"❌ Lỗi khi gửi lệnh fallback {symbol} | side={side}: {e2}")
-
-                    continue    
-            # ✅ Bắt đầu đặt SL/TP 
-            # --- Lấy market price ---
-            try:
-                ticker = exchange.fetch_ticker(symbol)
-                market_price = float(ticker['last'])
-                logging.debug(f"✅ [Market Price] Giá thị trường hiện tại của {symbol} = {market_price}")
-            except Exception as e:
-                logging.error(f"❌ [Market Price] Không lấy được giá hiện tại cho {symbol}: {e}")
-                return
-                
-            # --- Fetch vị thế để lấy size ---
+                logging.error(f"❌ Lỗi khi gửi lệnh {ctx['symbol']} | side={ctx['side']}: {s_code} {res.get('sMsg')}")
+                results.append((ctx, None))
+    logging.info(f"📦 Batch vào lệnh: {sum(1 for _, o in results if o)}/{len(ctxs)} thành công")
+    return results
+
+
+def run_batch(signals, now, ledger=None):
+    ledger = ledger or signal_ledger
+    # Mỗi instrument chỉ 1 tín hiệu trong batch, tín hiệu sau cùng instrument chạy tuần tự sau batch
+    first = ~signals["instId"].duplicated()
+    sigs, deferred = signals[first].to_dict("records"), signals[~first].to_dict("records")
+
+    def _prepare(sig):
+        row, row_hash = sig["row"], sig["row_hash"]
+        if not ledger.claim(row_hash, row):
+            return None
+        trace = metrics.start_trace(row_hash, row[0] if row else "")
+        with metrics.bind(trace):
             try:
-                positions = exchange.fetch_positions(params={"type": "swap"})
-                logging.debug(f"✅ [Positions] Đã fetch vị thế: {positions}")
+                status, ctx = prepare_signal(sig, now)
             except Exception as e:
-                logging.error(f"❌ [Positions] Không thể fetch vị thế: {e}")
-                continue
-                
-            symbol_check = symbol.replace("-", "/").upper()
-            side_input = side.lower()
-            side_check = 'long' if side_input == 'buy' else 'short' if side_input == 'sell' else None
-            size = 0
-            
-            # đoạn xử lý SL/TP
-            for pos in positions:
-                logging.debug(f"[Position] Kiểm tra từng vị thế: {pos}")
-            
-                pos_symbol = pos.get('symbol', '').upper().replace(':USDT', '')
-                pos_side = pos.get('posSide', '').lower()
-                margin_mode = pos.get('marginMode', '')
-                pos_size = pos.get('contracts') or pos.get('size') or pos.get('positionAmt') or pos.get('pos')
-            
-                logging.debug(
-                    f"🔍 So sánh: pos_symbol={pos_symbol}, pos_side={pos_side}, "
-                    f"mode={margin_mode}, size={pos_size} "
-                    f"với symbol_check={symbol_check}, side_check={side_check}"
-                )
-                logging.debug(
-                    f"[DEBUG MATCH] So sánh với: symbol_check={symbol_check}, side_check={side_check} "
-                    f"vs pos_symbol={pos_symbol}, pos_side={pos_side}, margin_mode={margin_mode}, size={pos_size}"
-                )
-                if (
-                    pos_symbol == symbol_check and
-                    pos_side == side_check and
-                    margin_mode == 'isolated' and
-                    float(pos_size) > 0
-                ):
-                    logging.info(f"✅ [Position] Tìm thấy vị thế phù hợp để đặt TP/SL cho {symbol_check}")
-            
-            # 🔄 Chuẩn hóa instId để gọi API Algo
-            symbol_instId = f"{symbol_raw.strip().upper()}-SWAP"
-            
-            # Lấy lot size từ thị trường
-            market = exchange.market(symbol_check)
-            lot_size = market['limits']['amount']['min'] or 0.001
-            
-            # Làm tròn size về đúng bội số
-            adjusted_size = math.ceil(pos_size / lot_size) * lot_size
-            adjusted_size = float(f"{adjusted_size:.6f}")
-
-            # 📈 Tính giá TP/SL
-            if side_check == 'long':
-                tp_price = market_price * 1.04
-                sl_price = market_price * 0.98
-                opposite_side = 'sell'
-            elif side_check == 'short':
-                tp_price = market_price * 0.96
-                sl_price = market_price * 1.02
-                opposite_side = 'buy'
-            else:
-                logging.error(f"❌ SIDE không hợp lệ: {side_check}")
-                continue
-            
-            # ✅ Đặt TP
-            # Đặt TP
-            if tp_price:
-                try:
-                    tp_order = exchange.private_post_trade_order_algo({
-                        "instId": symbol_instId,
-                        "tdMode": "isolated",
-                        "side": opposite_side,
-                        "ordType": "trigger",
-                        "triggerPx": str(round(tp_price, 6)),
-                        "orderPx": "-1",
-                        "triggerPxType": "last",  # BỔ SUNG DÒNG NÀY
-                        "sz": str(adjusted_size),
-                    })
-                    logging.info(f"✅ TP Order Response: {tp_order}")
-                except Exception as e:
-                    logging.error(f"❌ Lỗi đặt TP: {e}")
-                    
-            # ✅ Đặt SL
-            if tp_price:
+                logging.error(f"❌ Lỗi xử lý dòng: {e}")
+                status, ctx = ("retry" if isinstance(e, ccxt.NetworkError) else "error"), None
+        if status == "retry":
+            ledger.release(row_hash)
+        elif status != "ready":
+            ledger.finish(row_hash, status)
+        if status == "ready":
+            ctx["trace"] = trace
+        else:
+            metrics.finish_trace(trace, status)
+        return ctx
+
+    def _protect(result):
+        ctx, order = result
+        status = "error"
+        with metrics.bind(ctx["trace"]):
+            if order is not None:
+                metrics.mark("fill", at=ctx.get("filled_at"))
                 try:
-                    tp_order = exchange.private_post_trade_order_algo({
-                        "instId": symbol_instId,
-                        "tdMode": "isolated",
-                        "side": opposite_side,
-                        "ordType": "trigger",
-                        "triggerPx": str(round(sl_price, 6)),
-                        "orderPx": "-1",
-                        "triggerPxType": "last",  # BỔ SUNG DÒNG NÀY
-                        "sz": str(adjusted_size),
-                    })
-                    logging.info(f"✅ SL Order Response: {tp_order}")
+                    status = protect_position(ctx, order)
                 except Exception as e:
-                    logging.error(f"❌ Lỗi đặt SL: {e}")
-
-            # Gọi hàm huỷ nếu vị thế đã đóng
-            # ✅ Chuẩn hoá thành COIN-USDT-SWAP
-            symbol_check = symbol_raw.strip().upper().replace("/", "-").replace(":USDT", "-") + "-SWAP"  # FXS-USDT-SWAP
-            # ✅ Duyệt vị thế hiện tại
-            logging.debug(f"[CHECK] ↪ pos = {pos}")
-            def fetch_algo_orders_retry(symbol_instId, retries=5, delay=2):
-                for i in range(retries):
-                    try:
-                        result = exchange.private_get_trade_orders_pending({
-                            "instId": symbol_instId,
-                            "algoType": "conditional"
-                        })
-                        data = result.get("data", [])
-                        logging.debug(f"[CANCEL TP/SL] ↪ Attempt {i+1}/{retries}, Orders returned: {data}")
-                        if data:
-                            return data
-                        else:
-                            time.sleep(delay)
-                    except Exception as e:
-                        logging.warning(f"[CANCEL TP/SL] ❌ Lỗi khi fetch TP/SL lần {i+1}: {e}")
-                        time.sleep(5)
-                return []
-            try:
-                all_positions = exchange.fetch_positions()
-                for pos in all_positions:
-                    pos_symbol_check = pos.get("symbol", "").upper().replace("/", "-").replace(":USDT", "") + "-SWAP"
-                    contracts = float(pos.get("contracts", 0))
-                    margin_mode = pos.get("marginMode", "").lower()
-                
-                    logging.debug(f"[CHECK] ↪ symbol_check={symbol_check}, pos_symbol_check={pos_symbol_check}")
-  
-                
-                    if pos_symbol_check == symbol_check and contracts <= 0.0000001 and margin_mode in ["isolated", "cross"]:
-                        logging.warning(f"⚠️ Vị thế {symbol_check} đã đóng → huỷ TP/SL nếu còn treo")
-                
-                        symbol_instId = pos.get("instId")
-                        if not symbol_instId:
-                            symbol_instId = symbol_check.replace("/", "-")
-                            if not symbol_instId.endswith("-SWAP"):
-                                symbol_instId += "-SWAP"
-                
-                        # fetch TP/SL pending
-                        tp_sl_orders = fetch_algo_orders_retry(symbol_instId)
-                        ...
-                
-                        # ✅ Fetch TP/SL đang chờ theo instId
-                        def fetch_algo_orders_retry(symbol_instId, retries=5, delay=2):
-                            for i in range(retries):
-                                try:
-                                    res = exchange.private_get_trade_orders_pending({
-                                        "instId": symbol_instId,
-                                        "algoType": "conditional"
-                                    })
-                                    data = res.get("data", [])
-                                    if data:
-                                        return data
-                                except Exception as e:
-                                    logging.warning(f"❌ Lỗi khi fetch TP/SL lần {i+1}: {e}")
-                                time.sleep(delay)
-                            return []
-                
-                        orders_to_cancel = fetch_algo_orders_retry(symbol_instId)
-                
-                        if not orders_to_cancel:
-                            # ✅ Fallback nếu không fetch được theo instId
-                            fallback_orders = exchange.private_get_trade_orders_pending({
-                                "algoType": "conditional"
-                            })
-                            all_data = fallback_orders.get("data", [])
-                            for o in all_data:
-                                if o.get("instId") == symbol_instId and o.get("type") == "stop-market":
-                                        orders_to_cancel.append(o)
-                
-                            # ✅ Huỷ từng lệnh TP/SL
-                            for order in orders_to_cancel:
-                                algo_id = order.get("algoId")
-                                try:
-                                    result = exchange.private_post_trade_cancel_algos({
-                                        "algos": [algo_id]
-                                    })
-                                    logging.info(f"✅ Đã huỷ TP/SL: {algo_id}")
-                                except Exception as e:
-                                    logging.warning(f"❌ Lỗi huỷ TP/SL {algo_id}: {e}")
-                        continue  # Qua symbol khác
-            except Exception as e:
-                logging.error(f"❌ Lỗi kiểm tra vị thế để huỷ TP/SL: {e}")
+                    logging.error(f"❌ Lỗi đặt TP/SL cho {ctx['symbol']}: {e}")
+                    status = "placed"
+        ledger.finish(ctx["row_hash"], status)
+        metrics.finish_trace(ctx["trace"], status)
+
+    with ThreadPoolExecutor(max_workers=max(1, EXEC_WORKERS), thread_name_prefix="signal") as pool:
+        ctxs = [ctx for ctx in pool.map(_prepare, sigs) if ctx]
+        ready = size_entries(ctxs)
+        for ctx in ctxs:
+            if "sizing_error" in ctx:
+                ledger.finish(ctx["row_hash"], "skipped")
+                metrics.finish_trace(ctx["trace"], "skipped")
+        if ready:
+            list(pool.map(_protect, submit_entries_batch(ready)))
+    for sig in deferred:
+        execute_signal(sig, now, ledger)
+
+
+def execute_signal(sig, now, ledger=None):
+    ledger = ledger or signal_ledger
+    row, row_hash = sig["row"], sig["row_hash"]
+    if not ledger.claim(row_hash, row):
+        logging.debug("⏭ Tín hiệu đã xử lý trước đó: %s", row)
+        return "duplicate"
+    trace = metrics.start_trace(row_hash, row[0] if row else "")
+    with metrics.bind(trace):
+        status = process_signal(sig, now)
+    metrics.finish_trace(trace, status)
+    if status == "retry":
+        ledger.release(row_hash)
+    else:
+        ledger.finish(row_hash, status)
+    return status
+
+def run_bot(rows=None):
+    now = datetime.utcnow()
+    if rows is None:
+        rows = fetch_sheet()
+        if not rows:
+            return
+        rows = rows[1:]
+
+    # ✅ Chưa có danh mục instrument (sàn lỗi, chưa có cache) ➝ không loại dòng nào vào ledger, để lượt sau
+    instrument_catalog.ensure_fresh()
+    if not instrument_catalog.instruments:
+        logging.error(f"❌ Chưa có danh mục instrument SWAP ➝ hoãn {len(rows)} dòng sang lượt sau")
+        return
+
+    # ✅ Lọc hàng loạt trước khi gọi sàn, chỉ tín hiệu hợp lệ mới đi tiếp
+    signals, rejects = parse_signals(rows, now)
+    if len(rejects):
+        for reject in rejects[["symbol", "signal", "reason"]].itertuples(index=False):
+            logging.debug("⏭ Bỏ qua %s %s: %s", reject.symbol, reject.signal, reject.reason)
+        # Dòng trùng hash với tín hiệu còn lại thì để ledger ghi khi xử lý tín hiệu đó
+        recorded = rejects[~rejects["row_hash"].isin(signals["row_hash"])].drop_duplicates("row_hash")
+        signal_ledger.record_many(zip(recorded["row_hash"], recorded["row"], recorded["reason"]))
+        logging.info(f"🧮 {len(signals)} tín hiệu hợp lệ, loại {len(rejects)}: {rejects['reason'].value_counts().to_dict()}")
+    if signals.empty:
+        return
+
+    # ✅ Pre-warm instrument mới thấy lần đầu (đòn bẩy, ticker WS, template lệnh) trước khi xử lý từng dòng
+    try:
+        with metrics.stage("prewarm"):
+            execution_contexts.warm(signals["instId"].dropna().unique().tolist())
+    except Exception as e:
+        logging.error(f"❌ Lỗi pre-warm: {e}")
+
+    # ✅ 1 snapshot giá chung cho cả batch (bỏ qua nếu giá WS của mọi instrument còn mới)
+    if not all(ticker_snapshot.fresh(inst_id) for inst_id in signals["instId"]):
+        try:
+            with metrics.stage("ticker_snapshot"):
+                ticker_snapshot.ensure_fresh()
         except Exception as e:
-            logging.error(f"❌ Lỗi xử lý dòng: {e}")
-if __name__ == "__main__":
-    logging.info("🚀 Bắt đầu chạy script main.py")
+            logging.error(f"❌ Không thể fetch snapshot giá SWAP: {e}")
+
+    # ✅ Nhiều tín hiệu cùng lúc ➝ gom vào batch-orders
+    if BATCH_ORDERS and len(signals) > 1:
+        run_batch(signals, now)
+        logging.debug("[LEVERAGE] ↪ cache %s, pre-warm %s", leverage_cache.stats(), execution_contexts.stats())
+        logging.debug("[CONFIRM] ↪ %s", confirmations.stats())
+        return
+
+    sigs = signals.to_dict("records")
+    if EXEC_WORKERS <= 1:
+        for sig in sigs:
+            execute_signal(sig, now)
+        logging.debug("[LEVERAGE] ↪ cache %s, pre-warm %s", leverage_cache.stats(), execution_contexts.stats())
+        logging.debug("[CONFIRM] ↪ %s", confirmations.stats())
+        return
+
+    # ✅ Gom theo symbol: symbol khác nhau chạy song song, cùng symbol vẫn chạy tuần tự
+    groups = {}
+    for sig in sigs:
+        groups.setdefault(sig["symbol"], []).append(sig)
+
+    def _run_group(group_sigs):
+        for sig in group_sigs:
+            execute_signal(sig, now)
+
+    with ThreadPoolExecutor(max_workers=EXEC_WORKERS, thread_name_prefix="signal") as pool:
+        list(pool.map(_run_group, groups.values()))
+    logging.debug("[LEVERAGE] ↪ cache %s, pre-warm %s", leverage_cache.stats(), execution_contexts.stats())
+    logging.debug("[CONFIRM] ↪ %s", confirmations.stats())
+
+
+def collect_new_rows(pollers, ledger):
+    new_rows = {}
+    for poller in pollers:
+        rows = poller.poll()
+        if rows is not None:
+            fresh = {signal_hash(row): row for row in rows[1:] if not ledger.seen(signal_hash(row))}
+            logging.info(f"📥 Sheet thay đổi: {len(rows) - 1} dòng, {len(fresh)} tín hiệu mới")
+        elif poller.rows:
+            # Sheet không đổi ➝ chỉ còn dòng đã trả lại ledger (lỗi mạng / sàn bận) cần chạy lại
+            fresh = {signal_hash(row): row for row in poller.rows[1:] if not ledger.seen(signal_hash(row))}
+            if fresh:
+                logging.info(f"🔁 Sheet không đổi, thử lại {len(fresh)} tín hiệu")
+        else:
+            continue
+        new_rows.update(fresh)
+    return new_rows
+
+
+# ✅ Vòng đọc sheet liên tục: chỉ xử lý khi sheet thay đổi và chỉ các dòng chưa có trong ledger
+# Nhiều sheet cùng tài khoản ➝ gom tín hiệu mới của mọi sheet vào 1 lần run_bot (chung batch)
+def ingest_loop(pollers=None, ledger=None, poll_seconds=SHEET_POLL_SECONDS):
+    pollers = pollers or [sheet_poller]
+    ledger = ledger or signal_ledger
+    while True:
+        started_at = time.time()
+        try:
+            new_rows = collect_new_rows(pollers, ledger)
+            if new_rows:
+                run_bot(list(new_rows.values()))
+        except Exception as e:
+            logging.error(f"❌ Lỗi vòng đọc Google Sheet: {e}")
+        time.sleep(max(0, poll_seconds - (time.time() - started_at)))
+
+
+def run_forever(pollers=None):
+    # ✅ Endpoint /metrics (Prometheus) cho thời gian từng stage / endpoint
+    if METRICS_PORT:
+        metrics.serve()
+
+    # ✅ Nạp danh mục instrument (từ cache nếu có) và tự làm mới nền theo TTL
+    instrument_catalog.start_background_refresh()
+
+    # ✅ Nạp sẵn đòn bẩy isolated của các instrument USDT-M để khỏi set-leverage lặp lại
+    instrument_catalog.ensure_fresh()
+    leverage_cache.load(
+        inst["instId"] for inst in instrument_catalog.instruments
+        if inst["settleCcy"] == "USDT" and inst["ctType"] in ["linear", None]
+    )
+
+    # ✅ Giá cập nhật liên tục qua WebSocket tickers (mặc định lấy snapshot REST mỗi batch)
+    if TICKER_SOURCE == "ws":
+        ticker_snapshot.start_stream([
+            inst["instId"] for inst in instrument_catalog.instruments
+            if inst["settleCcy"] == "USDT" and inst["state"] in ["live", ""]
+        ])
+
+    # ✅ Pre-warm các symbol theo dõi sẵn (WATCH_LIST) + markets của ccxt trước khi có tín hiệu đầu tiên
+    execution_contexts.warm(WATCH_LIST)
 
     # ✅ Khởi động thread trước
-    threading.Thread(target=auto_tp_sl_watcher, daemon=True).start()
+    threading.Thread(target=auto_tp_sl_watcher, daemon=True, name="auto_tp_sl_watcher").start()
     logging.info("✅ Đã tạo thread auto_tp_sl_watcher")
-    # ✅ Gọi bot xử lý sheet
-    run_bot()
+    # ✅ Đọc sheet liên tục, chỉ xử lý tín hiệu mới (giữ chương trình sống luôn)
+    ingest_loop(pollers)
 
-    # ✅ Giữ chương trình sống (để thread không bị kill)
-    while True:
-        time.sleep(60)
+
+if __name__ == "__main__":
+    logging.info("🚀 Bắt đầu chạy script main.py")
+    run_forever()
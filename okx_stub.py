@@ -0,0 +1,533 @@
+import argparse
+import asyncio
+import csv
+import hashlib
+import io
+import itertools
+import json
+import logging
+import random
+import sys
+import time
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+
+from aiohttp import web
+
+# Sàn OKX giả lập chạy local (không cần API key thật / Google Sheet):
+# - REST /api/v5/... các endpoint main.py dùng: instruments, tickers, ticker, positions, leverage, order, batch-orders,
+#   order-algo, cancel-algos, orders-algo-pending; có độ trễ, rate limit (50011) và tỉ lệ khớp lệnh tuỳ chỉnh
+# - WebSocket /ws/v5/private|public: phát lại fixture JSONL và đẩy trực tiếp positions / orders-algo khi state đổi,
+#   tickers theo instId đã subscribe (ngay khi subscribe + mỗi TICKER_PUSH_SECONDS)
+# - Google Sheet giả: GET /sheet/export?format=csv (có ETag), POST /stub/sheet để thay nội dung
+# Mỗi dòng fixture WS: {"delay": 0.05, "arg": {"channel": "positions", ...}, "data": [...]}
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    stream=sys.stdout
+)
+
+# Hạn mức theo tài liệu OKX (số request / 2 giây) cho từng endpoint
+OKX_RATE_LIMITS = {
+    "public/instruments": 20,
+    "market/tickers": 20,
+    "market/ticker": 20,
+    "account/positions": 10,
+    "account/leverage-info": 20,
+    "account/set-leverage": 20,
+    "trade/order": 60,
+    "trade/batch-orders": 300,
+    "trade/order-algo": 20,
+    "trade/cancel-algos": 20,
+    "trade/orders-algo-pending": 20,
+    "trade/orders-pending": 60,
+}
+TICKER_PUSH_SECONDS = 1.0
+DEFAULT_BASES = ["BTC", "ETH", "SOL", "XRP", "DOGE", "ADA", "AVAX", "LINK", "DOT", "LTC"]
+# Quy cách hợp đồng xoay vòng giữa các instrument (ctVal, lotSz, minSz, tickSz) để bot phải tính đúng theo từng mã
+CONTRACT_SPECS = [
+    ("0.01", "0.1", "0.1", "0.0001"),
+    ("1", "0.01", "0.01", "0.001"),
+    ("0.1", "1", "1", "0.00001"),
+]
+
+
+def load_fixture(path):
+    frames = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                frames.append(json.loads(line))
+    return frames
+
+
+def make_instruments(count=len(DEFAULT_BASES)):
+    bases = DEFAULT_BASES + [f"SYN{i}" for i in range(max(0, count - len(DEFAULT_BASES)))]
+    instruments = []
+    for i, base in enumerate(bases[:count]):
+        price = round(100.0 / (1 + i % 50) + 0.5, 4)
+        ct_val, lot_sz, min_sz, tick_sz = CONTRACT_SPECS[i % len(CONTRACT_SPECS)]
+        instruments.append({
+            "instType": "SWAP",
+            "instId": f"{base}-USDT-SWAP",
+            "uly": f"{base}-USDT",
+            "instFamily": f"{base}-USDT",
+            "baseCcy": "",
+            "quoteCcy": "",
+            "settleCcy": "USDT",
+            "ctValCcy": base,
+            "ctType": "linear",
+            "ctVal": ct_val,
+            "ctMult": "1",
+            "lotSz": lot_sz,
+            "minSz": min_sz,
+            "tickSz": tick_sz,
+            "maxMktSz": "100000",
+            "maxLmtSz": "1000000",
+            "lever": "50",
+            "state": "live",
+            "listTime": "1600000000000",
+            "expTime": "",
+            "_px": price,
+        })
+    return instruments
+
+
+# ✅ Token bucket theo cửa sổ 2 giây của OKX (vượt hạn mức ➝ HTTP 429, code 50011)
+class StubRateLimiter:
+    def __init__(self, limits, scale=1.0):
+        self.limits = {path: limit * scale for path, limit in limits.items()}
+        self.tokens = dict(self.limits)
+        self.updated_at = {path: time.monotonic() for path in limits}
+
+    def allow(self, path):
+        limit = self.limits.get(path)
+        if not limit:
+            return True
+        now = time.monotonic()
+        self.tokens[path] = min(limit, self.tokens[path] + (now - self.updated_at[path]) * limit / 2)
+        self.updated_at[path] = now
+        if self.tokens[path] < 1:
+            return False
+        self.tokens[path] -= 1
+        return True
+
+
+# ✅ Trạng thái sàn giả: giá, vị thế, lệnh TP/SL, đòn bẩy; mọi thay đổi được đẩy qua WS cho client đã subscribe
+class StubState:
+    def __init__(self, instruments, fill_rate=1.0, fill_delay=0.0, seed=None):
+        self.instruments = instruments
+        self.by_inst_id = {inst["instId"]: inst for inst in instruments}
+        self.fill_rate = fill_rate
+        self.fill_delay = fill_delay
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.clients = []           # [(ws, channels đã subscribe)]
+        self.reset()
+
+    def reset(self):
+        self.positions = {}         # instId -> vị thế (posSide net, isolated)
+        self.algos = {}             # algoId -> lệnh TP/SL
+        self.leverage = {}          # (instId, mgnMode) -> lever
+        self.orders = []
+
+    def next_id(self):
+        return str(600000000000 + next(self.ids))
+
+    def price(self, inst_id):
+        return self.by_inst_id[inst_id]["_px"]
+
+    def ticker(self, inst):
+        px = inst["_px"] * (1 + self.random.uniform(-0.001, 0.001))
+        ts = str(int(time.time() * 1000))
+        return {
+            "instType": "SWAP", "instId": inst["instId"], "last": f"{px:.4f}",
+            "askPx": f"{px * 1.0002:.4f}", "bidPx": f"{px * 0.9998:.4f}", "ts": ts,
+        }
+
+    def position_view(self, pos):
+        return {
+            "instType": "SWAP", "instId": pos["instId"], "mgnMode": "isolated", "posSide": "net",
+            "pos": str(pos["pos"]), "avgPx": str(pos["avgPx"]), "markPx": str(self.price(pos["instId"])),
+            "lever": str(pos["lever"]), "margin": "30", "upl": "0", "notionalUsd": "120",
+            "ccy": "USDT", "posId": pos["posId"], "cTime": pos["cTime"], "uTime": str(int(time.time() * 1000)),
+        }
+
+    # --- Lệnh vào ---
+    def place_order(self, req):
+        inst_id = req.get("instId", "")
+        inst = self.by_inst_id.get(inst_id)
+        if not inst:
+            return {"ordId": "", "clOrdId": req.get("clOrdId", ""), "sCode": "51001", "sMsg": "Instrument ID does not exist"}
+        try:
+            sz_dec = Decimal(req.get("sz") or "0")
+        except InvalidOperation:
+            sz_dec = Decimal(0)
+        if sz_dec < Decimal(inst["minSz"]):
+            return {"ordId": "", "clOrdId": req.get("clOrdId", ""), "sCode": "51008", "sMsg": "Order failed. Insufficient size"}
+        # Như sàn thật: sz phải là bội số lotSz và không vượt maxMktSz với lệnh market
+        if sz_dec % Decimal(inst["lotSz"]) != 0:
+            return {"ordId": "", "clOrdId": req.get("clOrdId", ""), "sCode": "51121", "sMsg": f"Order quantity must be a multiple of the lot size {inst['lotSz']}"}
+        if req.get("ordType", "market") == "market" and sz_dec > Decimal(inst["maxMktSz"]):
+            return {"ordId": "", "clOrdId": req.get("clOrdId", ""), "sCode": "51202", "sMsg": "Market order amount exceeds the maximum amount"}
+        sz = float(sz_dec)
+        ord_id = self.next_id()
+        order = {"ordId": ord_id, "instId": inst_id, "side": req.get("side"), "sz": sz, "attach": req.get("attachAlgoOrds") or []}
+        self.orders.append(order)
+        if self.random.random() < self.fill_rate:
+            if self.fill_delay > 0:
+                asyncio.get_running_loop().call_later(self.fill_delay, self.fill, order)
+            else:
+                self.fill(order)
+        return {"ordId": ord_id, "clOrdId": req.get("clOrdId", ""), "tag": "", "sCode": "0", "sMsg": "Order placed"}
+
+    def fill(self, order):
+        inst_id = order["instId"]
+        signed = order["sz"] if order["side"] == "buy" else -order["sz"]
+        pos = self.positions.get(inst_id)
+        if pos is None or pos["pos"] == 0:
+            pos = self.positions[inst_id] = {
+                "instId": inst_id, "pos": 0.0, "avgPx": self.price(inst_id), "posId": self.next_id(),
+                "lever": self.leverage.get((inst_id, "isolated"), 1), "cTime": str(int(time.time() * 1000)),
+            }
+        pos["pos"] = round(pos["pos"] + signed, 8)
+        self.push("positions", [self.position_view(pos)])
+        opposite = "sell" if order["side"] == "buy" else "buy"
+        for attach in order["attach"]:
+            self.add_algo({
+                "instId": inst_id, "side": opposite, "ordType": "oco", "sz": str(order["sz"]),
+                "tpTriggerPx": attach.get("tpTriggerPx", ""), "slTriggerPx": attach.get("slTriggerPx", ""),
+            })
+
+    # --- Lệnh TP/SL ---
+    def add_algo(self, req):
+        algo_id = self.next_id()
+        algo = {
+            "algoId": algo_id, "instType": "SWAP", "instId": req.get("instId", ""), "side": req.get("side", ""),
+            "ordType": req.get("ordType", "trigger"), "sz": req.get("sz", ""), "state": "live",
+            "triggerPx": req.get("triggerPx", ""), "tpTriggerPx": req.get("tpTriggerPx", ""),
+            "slTriggerPx": req.get("slTriggerPx", ""), "cTime": str(int(time.time() * 1000)),
+        }
+        self.algos[algo_id] = algo
+        self.push("orders-algo", [algo])
+        return algo
+
+    def cancel_algo(self, req):
+        algo = self.algos.pop(req.get("algoId"), None)
+        if algo is None:
+            return {"algoId": req.get("algoId", ""), "sCode": "51400", "sMsg": "Cancellation failed as the order has been filled, canceled or does not exist"}
+        self.push("orders-algo", [dict(algo, state="canceled")])
+        return {"algoId": algo["algoId"], "sCode": "0", "sMsg": ""}
+
+    # --- Điều khiển từ benchmark ---
+    def close_positions(self, inst_ids):
+        closed = []
+        for inst_id in inst_ids:
+            pos = self.positions.get(inst_id)
+            if not pos or pos["pos"] == 0:
+                continue
+            pos["pos"] = 0.0
+            self.push("positions", [self.position_view(pos)])
+            closed.append(inst_id)
+        return closed
+
+    def push(self, channel, data):
+        for ws, channels in list(self.clients):
+            if channel in channels and not ws.closed:
+                asyncio.ensure_future(ws.send_json({"arg": {"channel": channel, "instType": "SWAP"}, "data": data}))
+
+
+def ok(data=None):
+    return web.json_response({"code": "0", "msg": "", "data": data or []})
+
+
+def _batch_response(results):
+    # OKX: tất cả thành công ➝ code 0, thành công 1 phần ➝ code 2, thất bại hết ➝ code 1
+    success = sum(1 for r in results if r.get("sCode") == "0")
+    code = "0" if success == len(results) else "2" if success else "1"
+    return web.json_response({"code": code, "msg": "" if code == "0" else "Operation failed.", "data": results})
+
+
+async def _body(request):
+    if not request.can_read_body:
+        return {}
+    return await request.json()
+
+
+# ✅ Middleware cho REST: độ trễ giả, đếm request theo endpoint, trả 429 khi vượt hạn mức
+@web.middleware
+async def rest_middleware(request, handler):
+    app = request.app
+    if not request.path.startswith("/api/v5/"):
+        return await handler(request)
+    path = request.path[len("/api/v5/"):]
+    app["calls"][path] += 1
+    latency = app["latency"] + random.uniform(0, app["jitter"])
+    if latency > 0:
+        await asyncio.sleep(latency)
+    if app["rate_limiter"] and not app["rate_limiter"].allow(path):
+        app["rate_limited"][path] += 1
+        return web.json_response({"code": "50011", "msg": "Too Many Requests", "data": []}, status=429)
+    return await handler(request)
+
+
+async def instruments_handler(request):
+    if request.query.get("instType", "SWAP") != "SWAP":
+        return ok([])
+    return ok([{k: v for k, v in inst.items() if not k.startswith("_")} for inst in request.app["state"].instruments])
+
+
+async def tickers_handler(request):
+    state = request.app["state"]
+    return ok([state.ticker(inst) for inst in state.instruments])
+
+
+async def ticker_handler(request):
+    state = request.app["state"]
+    inst = state.by_inst_id.get(request.query.get("instId", ""))
+    if not inst:
+        return web.json_response({"code": "51001", "msg": "Instrument ID does not exist", "data": []})
+    return ok([state.ticker(inst)])
+
+
+async def positions_handler(request):
+    state = request.app["state"]
+    inst_ids = request.query.get("instId")
+    wanted = set(inst_ids.split(",")) if inst_ids else None
+    return ok([
+        state.position_view(pos) for pos in state.positions.values()
+        if pos["pos"] != 0 and (wanted is None or pos["instId"] in wanted)
+    ])
+
+
+async def leverage_info_handler(request):
+    state = request.app["state"]
+    mgn_mode = request.query.get("mgnMode", "isolated")
+    return ok([
+        {"instId": inst_id, "mgnMode": mgn_mode, "posSide": "net", "lever": str(state.leverage.get((inst_id, mgn_mode), 1))}
+        for inst_id in request.query.get("instId", "").split(",") if inst_id
+    ])
+
+
+async def set_leverage_handler(request):
+    state = request.app["state"]
+    body = await _body(request)
+    state.leverage[(body.get("instId"), body.get("mgnMode", "isolated"))] = float(body.get("lever") or 1)
+    return ok([{"instId": body.get("instId"), "lever": body.get("lever"), "mgnMode": body.get("mgnMode"), "posSide": body.get("posSide", "net")}])
+
+
+async def order_handler(request):
+    result = request.app["state"].place_order(await _body(request))
+    if result["sCode"] != "0":
+        return web.json_response({"code": "1", "msg": "Operation failed.", "data": [result]})
+    return ok([result])
+
+
+async def batch_orders_handler(request):
+    body = await _body(request)
+    state = request.app["state"]
+    return _batch_response([state.place_order(req) for req in body[:20]])
+
+
+async def order_algo_handler(request):
+    body = await _body(request)
+    algo = request.app["state"].add_algo(body)
+    return ok([{"algoId": algo["algoId"], "clOrdId": "", "sCode": "0", "sMsg": ""}])
+
+
+async def cancel_algos_handler(request):
+    body = await _body(request)
+    state = request.app["state"]
+    return _batch_response([state.cancel_algo(req) for req in body[:10]])
+
+
+async def algos_pending_handler(request):
+    state = request.app["state"]
+    if not request.query.get("ordType"):
+        return web.json_response({"code": "50014", "msg": "Parameter ordType can not be empty.", "data": []})
+    ord_types = set(request.query["ordType"].split(","))
+    inst_id = request.query.get("instId")
+    return ok([
+        algo for algo in state.algos.values()
+        if algo["ordType"] in ord_types and (not inst_id or algo["instId"] == inst_id)
+    ])
+
+
+async def empty_handler(request):
+    return ok([])
+
+
+# --- Google Sheet giả ---
+async def sheet_handler(request):
+    content = request.app["sheet"].encode("utf-8")
+    etag = '"' + hashlib.sha256(content).hexdigest()[:16] + '"'
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304)
+    return web.Response(body=content, content_type="text/csv", headers={"ETag": etag})
+
+
+def rows_to_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue()
+
+
+# --- Điều khiển / thống kê cho benchmark ---
+async def stub_sheet_handler(request):
+    request.app["sheet"] = await request.text()
+    return ok()
+
+
+async def stub_close_handler(request):
+    body = await _body(request)
+    return ok(request.app["state"].close_positions(body.get("instIds", [])))
+
+
+async def stub_reset_handler(request):
+    app = request.app
+    # keep_leverage=1: chỉ xoá lệnh / vị thế / bộ đếm, giữ đòn bẩy đã đặt (benchmark đo sau khi pre-warm)
+    leverage = dict(app["state"].leverage)
+    app["state"].reset()
+    if request.query.get("keep_leverage") == "1":
+        app["state"].leverage = leverage
+    app["calls"].clear()
+    app["rate_limited"].clear()
+    return ok()
+
+
+async def stub_stats_handler(request):
+    app = request.app
+    state = app["state"]
+    return web.json_response({
+        "calls": dict(app["calls"]),
+        "rate_limited": dict(app["rate_limited"]),
+        "orders": len(state.orders),
+        "positions": sum(1 for pos in state.positions.values() if pos["pos"] != 0),
+        "algos": len(state.algos),
+        "orphans": sorted({
+            algo["instId"] for algo in state.algos.values()
+            if state.positions.get(algo["instId"], {}).get("pos", 0) == 0
+        }),
+    })
+
+
+async def ws_handler(request):
+    app = request.app
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    subscribed = set()
+    tickers = set()             # instId đã subscribe kênh tickers
+    client = (ws, subscribed)
+    app["state"].clients.append(client)
+    replay_task = None
+    ticker_task = None
+
+    async def push_tickers():
+        # Như OKX: đẩy giá ngay khi subscribe rồi cập nhật định kỳ
+        state = app["state"]
+        while not ws.closed:
+            data = [state.ticker(state.by_inst_id[inst_id]) for inst_id in list(tickers)]
+            if data:
+                await ws.send_json({"arg": {"channel": "tickers"}, "data": data})
+            await asyncio.sleep(TICKER_PUSH_SECONDS)
+
+    async def replay():
+        for frame in app["frames"]:
+            await asyncio.sleep(frame.get("delay", 0))
+            channel = frame.get("arg", {}).get("channel")
+            if channel not in subscribed:
+                continue
+            await ws.send_json({"arg": frame["arg"], "data": frame["data"]})
+            app["sent"].append(frame)
+        logging.info(f"📼 Đã phát lại {len(app['sent'])} message")
+
+    try:
+        async for msg in ws:
+            if msg.type != web.WSMsgType.TEXT:
+                break
+            if msg.data == "ping":
+                await ws.send_str("pong")
+                continue
+            payload = json.loads(msg.data)
+            app["received"].append(payload)
+            op = payload.get("op")
+            if op == "login":
+                await ws.send_json({"event": "login", "code": "0", "msg": ""})
+            elif op == "subscribe":
+                for arg in payload.get("args", []):
+                    subscribed.add(arg.get("channel"))
+                    await ws.send_json({"event": "subscribe", "arg": arg})
+                    if arg.get("channel") == "tickers" and arg.get("instId") in app["state"].by_inst_id:
+                        tickers.add(arg["instId"])
+                if tickers and ticker_task is None:
+                    ticker_task = asyncio.create_task(push_tickers())
+                if replay_task is None and app["frames"]:
+                    replay_task = asyncio.create_task(replay())
+    finally:
+        app["state"].clients.remove(client)
+        if replay_task:
+            replay_task.cancel()
+        if ticker_task:
+            ticker_task.cancel()
+    return ws
+
+
+def create_app(frames=None, instruments=None, latency=0.0, jitter=0.0, rate_scale=1.0,
+               fill_rate=1.0, fill_delay=0.0, sheet_rows=None, seed=None):
+    app = web.Application(middlewares=[rest_middleware])
+    app["frames"] = frames or []
+    app["sent"] = []
+    app["received"] = []
+    app["state"] = StubState(instruments or make_instruments(), fill_rate=fill_rate, fill_delay=fill_delay, seed=seed)
+    app["latency"] = latency
+    app["jitter"] = jitter
+    app["rate_limiter"] = StubRateLimiter(OKX_RATE_LIMITS, rate_scale) if rate_scale > 0 else None
+    app["calls"] = Counter()
+    app["rate_limited"] = Counter()
+    app["sheet"] = rows_to_csv(sheet_rows or [["symbol", "signal", "entry_price", "sl", "tp", "created_at", "interval"]])
+
+    app.router.add_get("/ws/v5/private", ws_handler)
+    app.router.add_get("/ws/v5/public", ws_handler)
+    app.router.add_get("/api/v5/public/instruments", instruments_handler)
+    app.router.add_get("/api/v5/market/tickers", tickers_handler)
+    app.router.add_get("/api/v5/market/ticker", ticker_handler)
+    app.router.add_get("/api/v5/account/positions", positions_handler)
+    app.router.add_get("/api/v5/account/leverage-info", leverage_info_handler)
+    app.router.add_post("/api/v5/account/set-leverage", set_leverage_handler)
+    app.router.add_post("/api/v5/trade/order", order_handler)
+    app.router.add_post("/api/v5/trade/batch-orders", batch_orders_handler)
+    app.router.add_post("/api/v5/trade/order-algo", order_algo_handler)
+    app.router.add_post("/api/v5/trade/cancel-algos", cancel_algos_handler)
+    app.router.add_get("/api/v5/trade/orders-algo-pending", algos_pending_handler)
+    app.router.add_get("/api/v5/trade/orders-pending", empty_handler)
+    app.router.add_get("/api/v5/asset/currencies", empty_handler)
+    app.router.add_get("/sheet/export", sheet_handler)
+    app.router.add_post("/stub/sheet", stub_sheet_handler)
+    app.router.add_post("/stub/close", stub_close_handler)
+    app.router.add_post("/stub/reset", stub_reset_handler)
+    app.router.add_get("/stub/stats", stub_stats_handler)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OKX giả lập chạy local")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ws-fixture", help="file JSONL chứa message WebSocket cần phát lại")
+    parser.add_argument("--instruments", type=int, default=len(DEFAULT_BASES), help="số instrument SWAP giả")
+    parser.add_argument("--latency", type=float, default=0.0, help="độ trễ mỗi request REST (giây)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="độ trễ ngẫu nhiên cộng thêm (giây)")
+    parser.add_argument("--rate-scale", type=float, default=1.0, help="nhân hạn mức OKX (0 = tắt rate limit)")
+    parser.add_argument("--fill-rate", type=float, default=1.0, help="tỉ lệ lệnh market được khớp")
+    parser.add_argument("--fill-delay", type=float, default=0.0, help="độ trễ từ lúc nhận lệnh tới khi có vị thế (giây)")
+    args = parser.parse_args()
+
+    frames = load_fixture(args.ws_fixture) if args.ws_fixture else []
+    app = create_app(
+        frames, make_instruments(args.instruments), latency=args.latency, jitter=args.jitter,
+        rate_scale=args.rate_scale, fill_rate=args.fill_rate, fill_delay=args.fill_delay,
+    )
+    logging.info(f"🚀 OKX stub tại http://{args.host}:{args.port} (REST /api/v5, WS /ws/v5/private, sheet /sheet/edit#gid=0, {len(frames)} message)")
+    web.run_app(app, host=args.host, port=args.port, print=None)
@@ -0,0 +1,391 @@
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue
+import re
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Chạy nhiều tài khoản OKX (sub-account) / nhiều Google Sheet trong 1 lệnh:
+# - mỗi tài khoản là 1 shard = 1 process riêng chạy main.run_forever() với key, ledger, journal và hạn mức private riêng
+# - các sheet cùng tài khoản chung 1 shard (gom tín hiệu mới vào 1 batch, chung snapshot vị thế / đòn bẩy)
+# - danh mục instrument + giá SWAP chỉ tải 1 lần ở process cha rồi chia sẻ qua file cho mọi shard
+# - shard gửi heartbeat về process cha ➝ /health (JSON) + /metrics, shard chết thì tự khởi động lại
+# Ví dụ: python runner.py --config accounts.json --state-dir runner_state --health-port 9200
+#
+# accounts.json:
+# {
+#   "accounts": {
+#     "sub1": {"api_key": "${SUB1_OKX_API_KEY}", "api_secret": "${SUB1_OKX_API_SECRET}", "passphrase": "${SUB1_OKX_API_PASSPHRASE}"},
+#     "sub2": {"api_key": "...", "api_secret": "...", "passphrase": "...", "env": {"ENTRY_MODE": "oco"}}
+#   },
+#   "sheets": [
+#     {"account": "sub1", "url": "https://docs.google.com/spreadsheets/d/.../edit#gid=0"},
+#     {"account": "sub1", "url": "https://docs.google.com/spreadsheets/d/.../edit#gid=123"},
+#     {"account": "sub2", "url": "https://docs.google.com/spreadsheets/d/.../edit#gid=0"}
+#   ]
+# }
+
+HEARTBEAT_SECONDS = float(os.environ.get("RUNNER_HEARTBEAT_SECONDS", "5"))
+RESTART_MAX_DELAY = 60
+CATALOG_GRACE_SECONDS = 60      # shard đọc lại cache instrument sau process cha một chút
+ENV_PLACEHOLDER = re.compile(r"^\$\{([A-Za-z_][A-Za-z0-9_]*)\}$")
+
+
+def _resolve_account(name, account):
+    # Giá trị đúng dạng ${BIẾN_MÔI_TRƯỜNG} ➝ lấy từ môi trường; giá trị khác (kể cả có "$") giữ nguyên
+    resolved = {}
+    for key, value in account.items():
+        match = ENV_PLACEHOLDER.match(value) if isinstance(value, str) else None
+        if match:
+            value = os.environ.get(match.group(1))
+            if not value:
+                raise ValueError(f"tài khoản {name}: biến môi trường {match.group(1)} ({key}) chưa được đặt")
+        resolved[key] = value
+    return resolved
+
+
+def load_config(path):
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    accounts = config.get("accounts", {})
+    shards = {}
+    for pair in config.get("sheets", []):
+        name, url = pair.get("account"), pair.get("url")
+        if name not in accounts:
+            raise ValueError(f"sheet {url} trỏ tới tài khoản không có trong config: {name}")
+        if not url:
+            raise ValueError(f"sheet của tài khoản {name} thiếu url")
+        shard = shards.get(name)
+        if shard is None:
+            # Cho phép ghi key dạng ${BIẾN_MÔI_TRƯỜNG} để không lưu secret trong file config
+            account = _resolve_account(name, accounts[name])
+            missing = [k for k in ["api_key", "api_secret", "passphrase"] if not account.get(k)]
+            if missing:
+                raise ValueError(f"tài khoản {name} thiếu {', '.join(missing)}")
+            shard = shards[name] = {"name": name, "account": account, "sheets": []}
+        if url not in shard["sheets"]:
+            shard["sheets"].append(url)
+    for name in accounts:
+        if name not in shards:
+            logging.warning(f"⚠️ Tài khoản {name} không có sheet nào ➝ bỏ qua")
+    return list(shards.values())
+
+
+def shard_env(shard, index, count, shared, bot):
+    account = shard["account"]
+    env = {
+        "OKX_API_KEY": account["api_key"],
+        "OKX_API_SECRET": account["api_secret"],
+        "OKX_API_PASSPHRASE": account["passphrase"],
+        "SPREADSHEET_URL": shard["sheets"][0],
+        # File riêng của tài khoản (đường dẫn tương đối trong thư mục shard)
+        "SIGNAL_LEDGER_DB": "signals.db",
+        "ORDER_JOURNAL_DB": "journal.db",
+        "METRICS_FILE": "metrics.jsonl",
+        "METRICS_PORT": str(shared["metrics_port"] + 1 + index) if shared["metrics_port"] else "0",
+        # Dữ liệu public dùng chung: process cha làm mới, shard chỉ đọc file
+        "INSTRUMENT_CACHE_FILE": shared["instruments_file"],
+        "INSTRUMENT_TTL": str(bot.INSTRUMENT_TTL + CATALOG_GRACE_SECONDS),
+        "TICKER_SHARED_FILE": shared["tickers_file"],
+        "TICKER_SOURCE": "rest",
+        "PREWARM_TICKERS": "0",
+        # Hạn mức public của OKX tính theo IP ➝ chia đều cho các shard; trade / account tính theo tài khoản nên giữ nguyên
+        "RATE_PUBLIC": str(bot.RATE_PUBLIC / count),
+    }
+    env.update({k: str(v) for k, v in account.get("env", {}).items()})
+    return env
+
+
+def shard_dir_name(name):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name)
+
+
+# ✅ Chạy trong process con: cấu hình môi trường trước khi import main (main đọc biến môi trường lúc import)
+def run_shard(shard, env, shard_dir, heartbeats):
+    os.environ.update(env)
+    os.makedirs(shard_dir, exist_ok=True)
+    os.chdir(shard_dir)
+    import main as bot
+
+    pollers = [bot.SheetPoller(url=bot._sheet_csv_url(url)) for url in shard["sheets"]]
+    threading.Thread(
+        target=heartbeat_loop, args=(bot, shard, pollers, heartbeats), daemon=True, name="heartbeat"
+    ).start()
+    logging.info(f"🚀 Shard {shard['name']}: {len(pollers)} sheet, pid {os.getpid()}")
+    bot.run_forever(pollers)
+
+
+def shard_health(bot, shard, pollers):
+    counters = dict(bot.metrics.counters)
+    return {
+        "shard": shard["name"],
+        "pid": os.getpid(),
+        "ts": time.time(),
+        "watcher_alive": any(t.name == "auto_tp_sl_watcher" and t.is_alive() for t in threading.enumerate()),
+        "sheets": [
+            {"url": p.url, "polled_at": p.polled_at, "last_ok_at": p.last_ok_at, "last_error": p.last_error}
+            for p in pollers
+        ],
+        "instruments": len(bot.instrument_catalog.instruments),
+        "catalog_loaded_at": bot.instrument_catalog.loaded_at,
+        "watch_queue": len(bot.watch_scheduler.entries),
+        "journal": bot.order_journal.stats(),
+        "leverage": bot.leverage_cache.stats(),
+        "rest_errors": sum(v for (name, _), v in counters.items() if name == "okx_rest_errors_total"),
+        "signals": {dict(labels)["status"]: v for (name, labels), v in counters.items() if name == "bot_signals_total"},
+    }
+
+
+def heartbeat_loop(bot, shard, pollers, heartbeats, interval=HEARTBEAT_SECONDS):
+    while True:
+        try:
+            heartbeats.put(shard_health(bot, shard, pollers))
+        except Exception as e:
+            logging.error(f"❌ Không gửi được heartbeat shard {shard['name']}: {e}")
+        time.sleep(interval)
+
+
+# ✅ Process cha: làm mới instrument + giá SWAP 1 lần cho mọi shard
+def public_feed(bot, tickers_file, interval):
+    bot.instrument_catalog.start_background_refresh()
+    if bot.TICKER_SOURCE == "ws":
+        bot.instrument_catalog.ensure_fresh()
+        bot.ticker_snapshot.start_stream([
+            inst["instId"] for inst in bot.instrument_catalog.instruments
+            if inst["settleCcy"] == "USDT" and inst["state"] in ["live", ""]
+        ])
+    while True:
+        try:
+            if bot.TICKER_SOURCE != "ws":
+                bot.ticker_snapshot.refresh()
+            count = bot.ticker_snapshot.publish(tickers_file)
+            bot.metrics.gauge("runner_shared_tickers", count)
+        except Exception as e:
+            logging.error(f"❌ Không làm mới được snapshot giá chung: {e}")
+        time.sleep(interval)
+
+
+class ShardSupervisor:
+    def __init__(self, shards, envs, state_dir, context, metrics, poll_seconds, heartbeat_seconds=HEARTBEAT_SECONDS):
+        self.shards = {shard["name"]: shard for shard in shards}
+        self.envs = envs
+        self.state_dir = state_dir
+        self.context = context
+        self.metrics = metrics
+        self.heartbeat_seconds = heartbeat_seconds
+        # Sheet không được poll lại quá lâu ➝ vòng đọc sheet của shard bị treo
+        self.stall_seconds = max(120, 3 * poll_seconds)
+        self.heartbeats = context.Queue()
+        self.processes = {}
+        self.states = {
+            name: {"status": "starting", "reason": None, "pid": None, "restarts": 0, "started_at": 0, "next_start": 0, "last": None}
+            for name in self.shards
+        }
+        self._lock = threading.Lock()
+
+    def start(self, name):
+        shard = self.shards[name]
+        process = self.context.Process(
+            target=run_shard,
+            args=(shard, self.envs[name], os.path.join(self.state_dir, shard_dir_name(name)), self.heartbeats),
+            name=f"shard-{name}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[name] = process
+        state = self.states[name]
+        state.update({"pid": process.pid, "started_at": time.time(), "last": None})
+        logging.info(f"▶️ Đã khởi động shard {name} (pid {process.pid}, {len(shard['sheets'])} sheet)")
+
+    def drain(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                beat = self.heartbeats.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                return
+            state = self.states.get(beat.get("shard"))
+            if state is not None and beat.get("pid") == state["pid"]:
+                with self._lock:
+                    state["last"] = beat
+
+    def evaluate(self, name, now):
+        state = self.states[name]
+        process = self.processes.get(name)
+        if process is None or not process.is_alive():
+            return "down", f"exit code {process.exitcode}" if process is not None else None
+        beat = state["last"]
+        if beat is None:
+            return "starting", None
+        if now - beat["ts"] > 3 * self.heartbeat_seconds:
+            return "stale", f"không có heartbeat {now - beat['ts']:.0f}s"
+        # Shard còn đang nạp catalog / đòn bẩy, chưa vào vòng đọc sheet
+        if not any(sheet["polled_at"] for sheet in beat["sheets"]):
+            if now - state["started_at"] > self.stall_seconds:
+                return "degraded", f"chưa đọc được sheet sau {now - state['started_at']:.0f}s"
+            return "starting", None
+        if not beat["watcher_alive"]:
+            return "degraded", "watcher TP/SL đã dừng"
+        for sheet in beat["sheets"]:
+            if sheet["last_error"]:
+                return "degraded", f"sheet lỗi: {sheet['last_error']}"
+            if now - (sheet["polled_at"] or state["started_at"]) > self.stall_seconds:
+                return "degraded", f"sheet không được đọc lại {now - (sheet['polled_at'] or state['started_at']):.0f}s"
+        return "ok", None
+
+    def tick(self):
+        now = time.time()
+        for name, state in self.states.items():
+            status, reason = self.evaluate(name, now)
+            if status != state["status"]:
+                if status == "ok":
+                    logging.info(f"✅ Shard {name}: {state['status']} ➝ ok")
+                elif status == "starting":
+                    logging.info(f"⏳ Shard {name}: {state['status']} ➝ starting")
+                else:
+                    logging.warning(f"⚠️ Shard {name}: {state['status']} ➝ {status} ({reason})")
+            with self._lock:
+                state["status"], state["reason"] = status, reason
+            self.metrics.gauge("runner_shard_up", 1 if status == "ok" else 0, shard=name)
+            if status != "down":
+                continue
+            # Khởi động lại với backoff tăng dần để shard lỗi cấu hình không chiếm hết CPU
+            if not state["next_start"]:
+                state["next_start"] = now + min(RESTART_MAX_DELAY, 2 ** state["restarts"])
+            elif now >= state["next_start"]:
+                state["restarts"] += 1
+                state["next_start"] = 0
+                self.metrics.inc("runner_shard_restarts_total", shard=name)
+                self.start(name)
+
+    def health(self):
+        with self._lock:
+            shards = {
+                name: {
+                    "status": state["status"],
+                    "reason": state["reason"],
+                    "pid": state["pid"],
+                    "restarts": state["restarts"],
+                    "sheets": len(self.shards[name]["sheets"]),
+                    "heartbeat": state["last"],
+                }
+                for name, state in self.states.items()
+            }
+        return {"ts": time.time(), "ok": all(s["status"] == "ok" for s in shards.values()), "shards": shards}
+
+    def write_health(self, path):
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.health(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, path)
+
+    def serve(self, host, port):
+        supervisor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/health":
+                    health = supervisor.health()
+                    body = json.dumps(health, ensure_ascii=False).encode("utf-8")
+                    self.send_response(200 if health["ok"] else 503)
+                    self.send_header("Content-Type", "application/json")
+                elif self.path == "/metrics":
+                    body = supervisor.metrics.render().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                else:
+                    self.send_error(404)
+                    return
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name="health").start()
+        logging.info(f"📊 Health tại http://{host}:{server.server_address[1]}/health")
+        return server
+
+    def run_forever(self):
+        for name in self.shards:
+            self.start(name)
+        health_file = os.path.join(self.state_dir, "health.json")
+        while True:
+            self.drain(self.heartbeat_seconds)
+            self.tick()
+            try:
+                self.write_health(health_file)
+            except Exception as e:
+                logging.warning(f"⚠️ Không ghi được {health_file}: {e}")
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=10)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chạy nhiều cặp (tài khoản OKX, Google Sheet), mỗi tài khoản 1 process")
+    parser.add_argument("--config", default=os.environ.get("RUNNER_CONFIG", "accounts.json"))
+    parser.add_argument("--state-dir", default=os.environ.get("RUNNER_STATE_DIR", "runner_state"),
+                        help="thư mục chứa ledger / journal / metrics của từng tài khoản và file dữ liệu chung")
+    parser.add_argument("--health-host", default="127.0.0.1")
+    parser.add_argument("--health-port", type=int, default=int(os.environ.get("RUNNER_HEALTH_PORT", "9200")),
+                        help="/health + /metrics của runner (0 = tắt); /metrics của shard thứ i ở cổng health-port + 1 + i")
+    parser.add_argument("--ticker-interval", type=float, default=None,
+                        help="giây giữa 2 lần làm mới giá chung (mặc định TICKER_MAX_AGE / 2)")
+    args = parser.parse_args()
+
+    state_dir = os.path.abspath(args.state_dir)
+    os.makedirs(state_dir, exist_ok=True)
+    shared = {
+        "instruments_file": os.path.join(state_dir, "instruments_cache.json"),
+        "tickers_file": os.path.join(state_dir, "tickers.json"),
+        "metrics_port": args.health_port,
+    }
+
+    # ✅ Process cha chỉ dùng phần public của main.py: không key, không ledger / journal trên đĩa
+    os.environ.update({
+        "INSTRUMENT_CACHE_FILE": shared["instruments_file"],
+        "TICKER_SHARED_FILE": "",
+        "SIGNAL_LEDGER_DB": ":memory:",
+        "ORDER_JOURNAL_DB": ":memory:",
+        "METRICS_FILE": "",
+        "METRICS_PORT": "0",
+    })
+    import main as bot
+
+    shards = load_config(args.config)
+    if not shards:
+        logging.error(f"❌ {args.config} không có cặp (tài khoản, sheet) nào")
+        sys.exit(1)
+    envs = {shard["name"]: shard_env(shard, i, len(shards), shared, bot) for i, shard in enumerate(shards)}
+    logging.info(f"🧩 {len(shards)} shard, {sum(len(s['sheets']) for s in shards)} sheet")
+
+    # Có danh mục instrument trên đĩa trước khi shard khởi động ➝ shard không tự gọi /public/instruments
+    bot.instrument_catalog.ensure_fresh()
+    interval = args.ticker_interval or bot.TICKER_MAX_AGE / 2
+    threading.Thread(target=public_feed, args=(bot, shared["tickers_file"], interval), daemon=True, name="public-feed").start()
+
+    # spawn: process con import main từ đầu với biến môi trường của tài khoản
+    supervisor = ShardSupervisor(shards, envs, state_dir, mp.get_context("spawn"), bot.metrics, bot.SHEET_POLL_SECONDS)
+    if args.health_port:
+        supervisor.serve(args.health_host, args.health_port)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        supervisor.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info("🛑 Dừng các shard")
+        supervisor.stop()
@@ -0,0 +1,77 @@
+import os
+import sys
+import tempfile
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import okx_stub
+from benchmark import start_stub
+
+# Test chạy trên okx_stub trong process (không cần OKX / Google Sheet thật); main.py đọc cấu hình lúc import
+WORKDIR = tempfile.mkdtemp(prefix="okx-tests-")
+STUB_APP = okx_stub.create_app(instruments=okx_stub.make_instruments(), rate_scale=0, seed=1)
+BASE_URL = start_stub(STUB_APP)
+
+os.environ.update({
+    "OKX_REST_URL": BASE_URL,
+    "OKX_WS_PRIVATE_URL": BASE_URL.replace("http", "ws") + "/ws/v5/private",
+    "OKX_WS_PUBLIC_URL": BASE_URL.replace("http", "ws") + "/ws/v5/public",
+    "SPREADSHEET_URL": f"{BASE_URL}/sheet/edit#gid=0",
+    "OKX_API_KEY": "test", "OKX_API_SECRET": "test", "OKX_API_PASSPHRASE": "test",
+    "INSTRUMENT_CACHE_FILE": os.path.join(WORKDIR, "instruments_cache.json"),
+    "SIGNAL_LEDGER_DB": os.path.join(WORKDIR, "signals.db"),
+    "ORDER_JOURNAL_DB": os.path.join(WORKDIR, "journal.db"),
+    "METRICS_FILE": "",
+    "METRICS_PORT": "0",
+    "LOG_LEVEL": "WARNING",
+    "LOG_FORMAT": "text",
+})
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def stub():
+    requests.post(f"{BASE_URL}/stub/reset").raise_for_status()
+    STUB_APP["frames"].clear()
+    STUB_APP["sent"].clear()
+    STUB_APP["received"].clear()
+    return STUB_APP
+
+
+@pytest.fixture
+def base_url():
+    return BASE_URL
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return main.OrderJournal(str(tmp_path / "journal.db"))
+
+
+@pytest.fixture
+def snapshot():
+    return main.PositionSnapshot(main.exchange)
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = main.InstrumentCatalog(cache_file=str(tmp_path / "instruments_cache.json"))
+    assert catalog.refresh()
+    return catalog
+
+
+@pytest.fixture
+def seed_algo():
+    # TP/SL đang treo trên stub: oco (TP + SL chung 1 algo) hoặc trigger (TP / SL riêng lẻ)
+    def _seed(state, algo_id, inst_id, side="sell", ord_type="oco"):
+        oco = ord_type == "oco"
+        state.algos[algo_id] = {
+            "algoId": algo_id, "instType": "SWAP", "instId": inst_id, "side": side, "ordType": ord_type,
+            "sz": "1", "state": "live", "triggerPx": "" if oco else "1",
+            "tpTriggerPx": "1" if oco else "", "slTriggerPx": "1" if oco else "", "cTime": "0",
+        }
+    return _seed
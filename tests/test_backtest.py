@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+import backtest
+
+T0 = pd.Timestamp("2026-01-01")
+
+
+def make_candles(closes):
+    closes = np.asarray(closes, dtype=float)
+    opens = np.r_[closes[0], closes[:-1]]
+    return {
+        "ts": (T0 + pd.to_timedelta(np.arange(len(closes)), unit="m")).values.astype("datetime64[ns]").astype(np.int64),
+        "open": opens, "high": np.maximum(opens, closes), "low": np.minimum(opens, closes), "close": closes,
+    }
+
+
+def make_signals(rows):
+    signals = pd.DataFrame(rows, columns=["symbol", "signal", "created_at", "interval"])
+    signals["direction"] = np.where(signals["signal"] == "LONG", 1, -1)
+    return signals
+
+
+def test_simulate_outcomes_across_chunks(monkeypatch):
+    # Mỗi khối chỉ 1 tín hiệu ➝ cửa sổ nến dựng lại theo từng khối vẫn cho cùng kết quả
+    monkeypatch.setattr(backtest, "CHUNK_CELLS", 1)
+    candles = {
+        "UP-USDT": make_candles([100, 101, 102, 103, 105, 106]),
+        "DOWN-USDT": make_candles([100, 99, 98, 97, 96, 95]),
+    }
+    signals = make_signals([
+        ["UP-USDT", "LONG", T0, 60],
+        ["DOWN-USDT", "LONG", T0, 60],
+        ["UP-USDT", "SHORT", T0, 60],
+        ["FLAT-USDT", "LONG", T0, 60],
+        ["UP-USDT", "LONG", T0 + pd.Timedelta(hours=2), 1],
+    ])
+
+    prepared = backtest.prepare(signals, candles, max_hold_minutes=10, entry_delay_seconds=0)
+    outcomes = backtest.simulate(prepared, tp_pct=0.04, sl_pct=0.02, leverage=4, skip_open_positions=False)
+
+    assert "high" not in prepared and prepared["width"] == 6
+    assert outcomes["outcome"].tolist() == ["tp", "sl", "sl", "no_data", "expired"]
+    assert outcomes.loc[0, "exit_price"] == 104.0
+    assert outcomes.loc[0, "exit_time"] == T0 + pd.Timedelta(minutes=4)
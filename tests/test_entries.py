@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import ccxt
+
+import main
+import okx_stub
+
+
+def ready_ctx(symbol="BTC-USDT"):
+    now = datetime.utcnow()
+    created = (now + timedelta(hours=main.SHEET_UTC_OFFSET_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+    signals, _ = main.parse_signals([[symbol, "LONG", "100", "2%", "4%", created, "60"]], now)
+    status, ctx = main.prepare_signal(signals.to_dict("records")[0], now)
+    assert status == "ready" and main.size_entries([ctx]) == [ctx]
+    ctx["entry_mode"] = "attach"
+    return ctx
+
+
+def test_submit_entry_does_not_fall_back_on_order_errors(stub):
+    ctx = ready_ctx()
+    ctx["sz"] += Decimal("0.05")        # không còn là bội số lotSz ➝ 51121
+
+    assert main._submit_entry(ctx) is None
+    assert ctx["entry_mode"] == "attach"
+    assert stub["calls"]["trade/order"] == 1
+    assert stub["state"].orders == []
+
+
+def test_submit_entry_falls_back_to_oco_when_attach_rejected(stub, monkeypatch):
+    ctx = ready_ctx()
+    place_order = main._place_order
+
+    def _reject_attach(ctx):
+        if "attachAlgoOrds" in ctx["order_params"]:
+            raise ccxt.InvalidOrder('okx {"code":"1","msg":"","data":[{"sCode":"51277","sMsg":"TP trigger price error"}]}')
+        return place_order(ctx)
+
+    monkeypatch.setattr(main, "_place_order", _reject_attach)
+
+    order = main._submit_entry(ctx)
+
+    assert order is not None
+    assert ctx["entry_mode"] == "oco"
+    assert len(stub["state"].orders) == 1 and stub["state"].orders[0]["attach"] == []
+
+
+def test_prewarm_with_rest_tickers_does_not_open_ws(stub, catalog):
+    # TICKER_SOURCE=rest (mặc định) ➝ pre-warm chỉ đặt đòn bẩy / dựng template, không subscribe WS tickers
+    tickers = main.TickerSnapshot(main.exchange)
+    contexts = main.ExecutionContexts(main.exchange, catalog, main.LeverageCache(main.exchange), tickers)
+
+    contexts.warm(["BTC-USDT"])
+
+    assert contexts.get("BTC-USDT-SWAP") is not None
+    assert tickers.stream is None
+
+
+def sheet_rows(symbols, side="LONG"):
+    created = (datetime.utcnow() + timedelta(hours=main.SHEET_UTC_OFFSET_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+    return [[symbol, side, "100", "2%", "4%", created, "60"] for symbol in symbols]
+
+
+def test_batch_records_create_order_stage_per_signal(stub, tmp_path, monkeypatch):
+    records = []
+    monkeypatch.setattr(main, "signal_ledger", main.SignalLedger(str(tmp_path / "signals.db")))
+    monkeypatch.setattr(main.metrics, "write", records.append)
+    main.position_snapshot.fetched_at = 0
+
+    main.run_bot(sheet_rows(["BTC-USDT", "ETH-USDT", "SOL-USDT"]))
+
+    signals = [r for r in records if r["type"] == "signal"]
+    assert stub["calls"]["trade/batch-orders"] == 1
+    assert sorted(r["status"] for r in signals) == ["placed"] * 3
+    for record in signals:
+        # batch-orders dùng chung ➝ mỗi tín hiệu đều có stage create_order và được tính 1 request
+        assert "create_order" in record["stages"]
+        assert record["rest_calls"] >= 1
+
+
+def test_batch_maps_results_by_cl_ord_id(stub, monkeypatch):
+    ctxs = [ready_ctx(symbol) for symbol in ["BTC-USDT", "ETH-USDT", "SOL-USDT"]]
+    batch_orders = main.exchange.private_post_trade_batch_orders
+
+    def _reversed(payload):
+        # OKX không hứa giữ thứ tự kết quả ➝ bot phải map theo clOrdId
+        response = batch_orders(payload)
+        return dict(response, data=response["data"][::-1])
+
+    monkeypatch.setattr(main.exchange, "private_post_trade_batch_orders", _reversed)
+
+    results = main.submit_entries_batch(ctxs)
+
+    ord_ids = {order["instId"]: order["ordId"] for order in stub["state"].orders}
+    assert stub["calls"]["trade/batch-orders"] == 1
+    assert [ctx for ctx, _ in results] == ctxs
+    for ctx, order in results:
+        assert order["clientOrderId"] == ctx["clOrdId"]
+        assert order["id"] == ord_ids[ctx["inst"]["instId"]]
+
+
+def test_batch_partial_failure_keeps_successful_orders(stub):
+    ctxs = [ready_ctx(symbol) for symbol in ["ETH-USDT", "BTC-USDT", "SOL-USDT"]]
+    ctxs[1]["sz"] += Decimal("0.05")    # không còn là bội số lotSz ➝ sCode 51121, batch trả code 2
+
+    results = dict((ctx["inst"]["instId"], order) for ctx, order in main.submit_entries_batch(ctxs))
+
+    assert results["BTC-USDT-SWAP"] is None
+    assert results["ETH-USDT-SWAP"] is not None and results["SOL-USDT-SWAP"] is not None
+    assert sorted(order["instId"] for order in stub["state"].orders) == ["ETH-USDT-SWAP", "SOL-USDT-SWAP"]
+    # Lỗi từng lệnh không phải lỗi gắn TP/SL ➝ không gửi lại riêng
+    assert stub["calls"]["trade/order"] == 0
+
+
+def test_batch_falls_back_to_oco_when_attach_rejected(stub, monkeypatch):
+    ctxs = [ready_ctx(symbol) for symbol in ["BTC-USDT", "ETH-USDT"]]
+    state = stub["state"]
+    place_order = state.place_order
+
+    def _reject_attach(req):
+        if req["instId"] == "ETH-USDT-SWAP" and req.get("attachAlgoOrds"):
+            return {"ordId": "", "clOrdId": req.get("clOrdId", ""), "sCode": "51277", "sMsg": "TP trigger price error"}
+        return place_order(req)
+
+    monkeypatch.setattr(state, "place_order", _reject_attach)
+
+    results = dict((ctx["inst"]["instId"], (ctx, order)) for ctx, order in main.submit_entries_batch(ctxs))
+
+    eth_ctx, eth_order = results["ETH-USDT-SWAP"]
+    assert eth_order is not None and eth_ctx["entry_mode"] == "oco"
+    assert results["BTC-USDT-SWAP"][0]["entry_mode"] == "attach"
+    assert stub["calls"]["trade/batch-orders"] == 1 and stub["calls"]["trade/order"] == 1
+    attach = {order["instId"]: order["attach"] for order in state.orders}
+    assert attach["BTC-USDT-SWAP"] != [] and attach["ETH-USDT-SWAP"] == []
+
+
+def test_every_called_endpoint_has_a_bucket():
+    # Mọi endpoint bot gọi (theo stub) đều có bucket riêng đúng hạn mức OKX / 2 giây
+    called = set(okx_stub.OKX_RATE_LIMITS) - {"trade/orders-pending"}
+    for path in called:
+        assert main.endpoint_buckets[path].capacity == okx_stub.OKX_RATE_LIMITS[path], path
@@ -0,0 +1,27 @@
+import requests
+
+import main
+import okx_stub
+
+ROWS = [
+    ["symbol", "signal", "entry_price", "sl", "tp", "created_at", "interval"],
+    ["BTC-USDT", "LONG", "100", "2%", "4%", "2026-01-01 00:00:00", "60"],
+    ["ETH-USDT", "SHORT", "50", "2%", "4%", "2026-01-01 00:00:00", "60"],
+]
+
+
+def test_unchanged_sheet_reruns_released_rows(stub, base_url, tmp_path):
+    requests.post(f"{base_url}/stub/sheet", data=okx_stub.rows_to_csv(ROWS)).raise_for_status()
+    ledger = main.SignalLedger(str(tmp_path / "signals.db"))
+    poller = main.SheetPoller(url=f"{base_url}/sheet/export?format=csv&gid=0")
+
+    first = main.collect_new_rows([poller], ledger)
+    assert list(first.values()) == ROWS[1:]
+    for row_hash, row in first.items():
+        ledger.claim(row_hash, row)
+    # Lỗi mạng khi xử lý ➝ dòng được trả lại ledger, sheet vẫn không đổi (304)
+    ledger.release(main.signal_hash(ROWS[2]))
+
+    assert list(main.collect_new_rows([poller], ledger).values()) == [ROWS[2]]
+    ledger.claim(main.signal_hash(ROWS[2]), ROWS[2])
+    assert main.collect_new_rows([poller], ledger) == {}
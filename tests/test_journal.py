@@ -0,0 +1,70 @@
+import ccxt
+
+import main
+
+
+def test_reconcile_closes_entry_missing_from_snapshot(stub, journal, snapshot, seed_algo):
+    state = stub["state"]
+    journal.record_entry("1", "ETH-USDT-SWAP", "buy", 1, "attach")
+    seed_algo(state, "a1", "ETH-USDT-SWAP")
+
+    report = main.reconcile_dirty(main.exchange, journal, snapshot)
+
+    assert [res["algoId"] for res in report["cancelled"]] == ["a1"]
+    assert journal.stats() == {"closed": 1}
+    assert state.algos == {}
+
+
+def test_reconcile_keeps_entry_newer_than_snapshot(stub, journal, snapshot, seed_algo):
+    state = stub["state"]
+    snapshot.get(force=True)
+    # Lệnh vào (TP/SL gắn kèm) ghi sau lúc lấy snapshot ➝ snapshot chưa thấy vị thế
+    journal.record_entry("1", "ETH-USDT-SWAP", "buy", 1, "attach")
+    seed_algo(state, "a1", "ETH-USDT-SWAP")
+
+    assert main.reconcile_dirty(main.exchange, journal, snapshot, max_age=60) is None
+    assert journal.stats() == {"open": 1}
+    assert "a1" in state.algos
+
+
+def test_reconcile_defers_dirty_instrument_with_newer_entry(stub, journal, snapshot, seed_algo):
+    state = stub["state"]
+    journal.record_entry("1", "ETH-USDT-SWAP", "buy", 1, "attach")
+    snapshot.get(force=True)
+    journal.record_entry("2", "ETH-USDT-SWAP", "buy", 1, "attach")
+    seed_algo(state, "a2", "ETH-USDT-SWAP")
+
+    report = main.reconcile_dirty(main.exchange, journal, snapshot, max_age=60)
+
+    # Lệnh cũ dirty nhưng instrument có lệnh mới chưa có trong snapshot ➝ chưa huỷ TP/SL, để vòng sau
+    assert report["cancelled"] == []
+    assert journal.stats() == {"dirty": 1, "open": 1}
+    assert "a2" in state.algos
+
+
+def test_mark_dirty_before_ignores_newer_entries(journal):
+    journal.record_entry("1", "ETH-USDT-SWAP", "buy", 1, "attach")
+    journal.record_entry("2", "ETH-USDT-SWAP", "buy", 1, "attach")
+    journal.conn.execute("UPDATE entries SET created_at = CAST(ord_id AS REAL) * 100")
+
+    journal.mark_dirty("ETH-USDT-SWAP", "closed", before=150)
+
+    assert journal.stats() == {"dirty": 1, "open": 1}
+
+
+def test_reconcile_keeps_entry_dirty_when_tp_sl_query_fails(stub, journal, snapshot, seed_algo, monkeypatch):
+    state = stub["state"]
+    journal.record_entry("1", "ETH-USDT-SWAP", "buy", 1, "attach")
+    seed_algo(state, "a1", "ETH-USDT-SWAP")
+
+    def _fail(exchange, inst_id=None):
+        raise ccxt.RateLimitExceeded("okx 50011 Too Many Requests")
+
+    monkeypatch.setattr(main, "fetch_pending_tp_sl", _fail)
+
+    report = main.reconcile_dirty(main.exchange, journal, snapshot)
+
+    # Không biết TP/SL còn treo hay không ➝ không đóng entry, báo retry để vòng sau kiểm tra lại
+    assert [res["instId"] for res in report["retry"]] == ["ETH-USDT-SWAP"]
+    assert journal.stats() == {"dirty": 1}
+    assert "a1" in state.algos
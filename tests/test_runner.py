@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+import runner
+
+
+def write_config(tmp_path, account):
+    path = tmp_path / "accounts.json"
+    path.write_text(json.dumps({
+        "accounts": {"a": account},
+        "sheets": [{"account": "a", "url": "https://example.com/sheet/edit#gid=0"}],
+    }))
+    return str(path)
+
+
+def test_load_config_keeps_literal_dollar_in_credentials(tmp_path, monkeypatch):
+    monkeypatch.setenv("OKX_SECRET_A", "s3cret")
+    path = write_config(tmp_path, {"api_key": "k$1", "api_secret": "${OKX_SECRET_A}", "passphrase": "p$ss"})
+
+    account = runner.load_config(path)[0]["account"]
+
+    assert account == {"api_key": "k$1", "api_secret": "s3cret", "passphrase": "p$ss"}
+
+
+def test_load_config_names_unset_placeholder(tmp_path, monkeypatch):
+    monkeypatch.delenv("OKX_PASSPHRASE_A", raising=False)
+    path = write_config(tmp_path, {"api_key": "k", "api_secret": "s", "passphrase": "${OKX_PASSPHRASE_A}"})
+
+    with pytest.raises(ValueError, match="OKX_PASSPHRASE_A"):
+        runner.load_config(path)
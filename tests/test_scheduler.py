@@ -0,0 +1,55 @@
+import ccxt
+
+import main
+
+
+def test_run_due_charges_cancel_requests_to_budget(stub, journal, snapshot, seed_algo):
+    state = stub["state"]
+    seed_algo(state, "a1", "ETH-USDT-SWAP")
+    journal.record_entry("1", "ETH-USDT-SWAP", "buy", 1, "attach")
+    main.exchange.load_markets()
+    scheduler = main.WatchScheduler(budget=1e-6)
+    scheduler.track("ETH-USDT-SWAP", (1,))
+    scheduler.wake("position", "ETH-USDT-SWAP")
+    calls_before = sum(stub["calls"].values())
+
+    report = scheduler.run_due(main.exchange, snapshot, journal)
+
+    calls = sum(stub["calls"].values()) - calls_before
+    assert [res["algoId"] for res in report["cancelled"]] == ["a1"]
+    assert stub["calls"]["trade/cancel-algos"] == 1
+    # Request huỷ chạy trên thread của _cancel_pool vẫn bị trừ vào hạn mức của watcher
+    assert round(scheduler.capacity - scheduler.tokens) == calls
+    assert "ETH-USDT-SWAP" not in scheduler.entries
+
+
+def test_run_due_keeps_tracking_when_tp_sl_query_fails(stub, journal, snapshot, monkeypatch):
+    journal.record_entry("1", "ETH-USDT-SWAP", "buy", 1, "attach")
+    scheduler = main.WatchScheduler()
+    scheduler.track("XRP-USDT-SWAP", (1,))
+    scheduler.track("ETH-USDT-SWAP", (1,))
+    scheduler.wake("position", "XRP-USDT-SWAP")
+    scheduler.wake("position", "ETH-USDT-SWAP")
+
+    def _fail(exchange, inst_id=None):
+        raise ccxt.RateLimitExceeded("okx 50011 Too Many Requests")
+
+    monkeypatch.setattr(main, "fetch_pending_tp_sl", _fail)
+
+    report = scheduler.run_due(main.exchange, snapshot, journal)
+
+    assert sorted(res["instId"] for res in report["retry"]) == ["ETH-USDT-SWAP", "XRP-USDT-SWAP"]
+    assert set(scheduler.entries) == {"ETH-USDT-SWAP", "XRP-USDT-SWAP"}
+    assert journal.stats() == {"dirty": 1}
+
+
+def test_track_wakes_watcher_for_new_instrument():
+    scheduler = main.WatchScheduler(near_interval=5, far_interval=180)
+    assert scheduler.next_due_in() == 180
+    scheduler.track("ETH-USDT-SWAP", (1,))
+    # Watcher đang ngủ theo next_due_in() cũ phải dậy để tính lại hạn mới
+    assert scheduler.wakeup.is_set()
+    assert scheduler.next_due_in() <= 5
+    scheduler.wakeup.clear()
+    scheduler.track("ETH-USDT-SWAP", (2,))
+    assert not scheduler.wakeup.is_set()
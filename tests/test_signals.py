@@ -0,0 +1,108 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import main
+
+HEADER = ["symbol", "signal", "entry_price", "sl", "tp", "created_at", "interval"]
+
+
+def sheet_time(dt):
+    return (dt + timedelta(hours=main.SHEET_UTC_OFFSET_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def test_parse_signals_rejection_reasons(catalog):
+    catalog._index(
+        [inst["info"] for inst in catalog.instruments]
+        + [{"instId": "BTC-USD-SWAP", "uly": "BTC-USD", "settleCcy": "BTC", "ctType": "inverse", "state": "live"}],
+        time.time(),
+    )
+    now = datetime(2026, 1, 1, 0, 30)
+    created = sheet_time(datetime(2026, 1, 1))
+    rows = [
+        ["BTC-USDT", "LONG", "100", "2%", "4%", created, "60"],
+        ["ETH-USDT", "LONG"],
+        ["ETH-USDT", "LONG", "abc", "2%", "4%", created, "60"],
+        ["ETH-USDT", "HOLD", "100", "2%", "4%", created, "60"],
+        ["ETH-USDT", "LONG", "100", "2%", "4%", created, "10"],
+        ["FOO-USDT", "LONG", "100", "2%", "4%", created, "60"],
+        ["BTC-USD", "LONG", "100", "2%", "4%", created, "60"],
+        ["SOL-USDT", "SHORT", "100", "2%", "4%", sheet_time(datetime(2026, 1, 1, 0, 10)), "60"],
+        ["SOL-USDT", "SHORT", "100", "2%", "4%", created, "60"],
+    ]
+
+    signals, rejects = main.parse_signals(rows, now, catalog)
+
+    assert signals["row"].tolist() == [rows[0], rows[7]]
+    assert dict(zip(rejects.index, rejects["reason"])) == {
+        1: "malformed",
+        2: "malformed",
+        3: "invalid_signal",
+        4: "expired",
+        5: "unknown_instrument",
+        6: "unsupported_instrument",
+        8: "duplicate",
+    }
+
+
+def test_parse_signals_keeps_typed_values(catalog):
+    now = datetime(2026, 1, 1, 0, 30)
+    rows = [[" btc-usdt ", "long", "100.5", "2%", "4.5%", sheet_time(datetime(2026, 1, 1)), "30.0"]]
+
+    signals, rejects = main.parse_signals(rows, now, catalog)
+
+    sig = signals.to_dict("records")[0]
+    assert rejects.empty
+    assert (sig["symbol"], sig["signal"], sig["instId"]) == ("BTC-USDT", "LONG", "BTC-USDT-SWAP")
+    assert (sig["entry_price"], sig["sl_pct"], sig["tp_pct"], sig["interval"]) == (100.5, 0.02, 0.045, 30)
+    assert sig["expires_at"] == datetime(2026, 1, 1, 0, 30)
+
+
+def test_prepare_signal_uses_parsed_values(stub):
+    # "30.0" phút qua được parse_signals thì prepare_signal cũng không được lỗi vì parse lại bằng int()
+    now = datetime.utcnow()
+    rows = [["BTC-USDT", "LONG", "100", "2%", "4%", sheet_time(now), "30.0"]]
+    signals, _ = main.parse_signals(rows, now)
+
+    status, ctx = main.prepare_signal(signals.to_dict("records")[0], now)
+
+    assert status == "ready"
+    assert (ctx["symbol_instId"], ctx["side"], ctx["row_hash"]) == ("BTC-USDT-SWAP", "buy", main.signal_hash(rows[0]))
+
+
+def test_run_bot_skips_when_catalog_empty(stub, tmp_path, monkeypatch):
+    empty = main.InstrumentCatalog(cache_file=str(tmp_path / "missing.json"))
+
+    def _unreachable():
+        raise ConnectionError("OKX unreachable")
+
+    monkeypatch.setattr(empty, "_fetch", _unreachable)
+    monkeypatch.setattr(main, "instrument_catalog", empty)
+    ledger = main.SignalLedger(str(tmp_path / "signals.db"))
+    monkeypatch.setattr(main, "signal_ledger", ledger)
+
+    main.run_bot([["BTC-USDT", "LONG", "100", "2%", "4%", sheet_time(datetime.utcnow()), "60"]])
+
+    # Không có dòng nào bị ghi "unknown_instrument" vĩnh viễn ➝ lượt sau còn xử lý được
+    assert ledger.known == set()
+    assert stub["state"].orders == []
+
+
+def test_concurrent_get_fetches_instruments_once(stub, tmp_path, monkeypatch):
+    catalog = main.InstrumentCatalog(cache_file=str(tmp_path / "instruments_cache.json"))
+    fetch = catalog._fetch
+
+    def _slow_fetch():
+        time.sleep(0.2)
+        return fetch()
+
+    monkeypatch.setattr(catalog, "_fetch", _slow_fetch)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(catalog.get("BTC-USDT"))) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert stub["calls"]["public/instruments"] == 1
+    assert [inst["instId"] for inst in results] == ["BTC-USDT-SWAP"] * 6
@@ -0,0 +1,52 @@
+from decimal import Decimal
+
+import main
+
+
+def make_table():
+    raw = [
+        {"instId": "BTC-USDT-SWAP", "uly": "BTC-USDT", "settleCcy": "USDT", "ctType": "linear",
+         "ctVal": "0.01", "lotSz": "0.1", "minSz": "0.1", "tickSz": "0.1", "maxMktSz": "1000"},
+        {"instId": "ETH-USDT-SWAP", "uly": "ETH-USDT", "settleCcy": "USDT", "ctType": "linear",
+         "ctVal": "1", "lotSz": "1", "minSz": "1", "tickSz": "0.0001", "maxMktSz": ""},
+        {"instId": "DOGE-USDT-SWAP", "uly": "DOGE-USDT", "settleCcy": "USDT", "ctType": "linear",
+         "ctVal": "1000", "lotSz": "1", "minSz": "1", "tickSz": "0.5", "maxMktSz": "0"},
+    ]
+    return main.SizingTable([main._instrument_entry(item) for item in raw])
+
+
+def test_contracts_rounds_down_to_lot_size():
+    table = make_table()
+
+    sz, reason = table.contracts("BTC-USDT-SWAP", 120, 100.5)
+    assert (sz, reason) == (Decimal("119.4"), None)
+    assert str(sz) == "119.4"       # Decimal chính xác, không có sai số float khi gửi sàn
+    assert table.contracts("BTC-USDT-SWAP", 120, 0.1) == (Decimal("1000"), None)     # chặn maxMktSz
+    assert table.contracts("ETH-USDT-SWAP", 120, 7)[0] == Decimal("17")
+    assert table.contracts("DOGE-USDT-SWAP", 120, 0.1) == (Decimal("1"), None)
+
+
+def test_contracts_rejection_reasons():
+    table = make_table()
+
+    assert table.contracts("XRP-USDT-SWAP", 120, 1) == (None, "no_contract_spec")
+    assert table.contracts("BTC-USDT-SWAP", 120, 0) == (None, "no_price")
+    assert table.contracts("BTC-USDT-SWAP", 120, None) == (None, "no_price")
+    assert table.contracts("ETH-USDT-SWAP", 120, 200) == (None, "below_min_size")
+
+
+def test_round_price_to_tick_size():
+    table = make_table()
+
+    assert table.round_price("ETH-USDT-SWAP", 1.23456) == Decimal("1.2346")
+    assert table.round_price("ETH-USDT-SWAP", "1.23455") == Decimal("1.2346")
+    assert table.round_price("ETH-USDT-SWAP", "1.23454") == Decimal("1.2345")
+    assert table.round_price("DOGE-USDT-SWAP", "100.26") == Decimal("100.5")
+    assert table.round_price("XRP-USDT-SWAP", "0.51234") == Decimal("0.51234")
+
+
+def test_tp_sl_from_reference_price():
+    table = make_table()
+
+    assert table.tp_sl("BTC-USDT-SWAP", "long", 100) == (Decimal("104.0"), Decimal("98.0"), "sell")
+    assert table.tp_sl("BTC-USDT-SWAP", "short", 100) == (Decimal("96.0"), Decimal("102.0"), "buy")
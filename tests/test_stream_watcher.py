@@ -0,0 +1,96 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+import requests
+
+import main
+import okx_stub
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fixtures")
+
+
+def wait_for(predicate, timeout=5, interval=0.01):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def seed_position(state, inst_id, pos):
+    state.positions[inst_id] = {
+        "instId": inst_id, "pos": float(pos), "avgPx": state.price(inst_id), "posId": state.next_id(),
+        "lever": 1, "cTime": "0",
+    }
+
+
+@pytest.fixture
+def stream_watcher(stub):
+    main.exchange.load_markets()
+    watcher = main.TpSlStreamWatcher(main.exchange, main.PositionSnapshot(main.exchange), reconcile_seconds=3600)
+    thread = threading.Thread(target=watcher.run_forever, daemon=True)
+
+    def start():
+        thread.start()
+        assert watcher.stream.connected.wait(5)
+        return watcher
+
+    yield start
+    watcher.stream.stop()
+    if watcher.stream.loop and watcher.stream.ws is not None:
+        asyncio.run_coroutine_threadsafe(watcher.stream.ws.close(), watcher.stream.loop).result(5)
+    thread.join(5)
+
+
+def test_net_position_closed_after_reconcile_cancels_tp_sl(stub, stream_watcher, seed_algo):
+    # Vị thế net đã mở lúc đối soát (REST) ➝ sự kiện WS đóng vị thế phải trúng cùng khoá và huỷ TP/SL
+    state = stub["state"]
+    seed_position(state, "ETH-USDT-SWAP", 10)
+    seed_algo(state, "tp-2", "ETH-USDT-SWAP", ord_type="trigger")
+    seed_algo(state, "sl-2", "ETH-USDT-SWAP", ord_type="trigger")
+    stub["frames"].extend(okx_stub.load_fixture(os.path.join(FIXTURES, "ws_position_closed.jsonl")))
+
+    watcher = stream_watcher()
+
+    assert wait_for(lambda: not state.algos)
+    assert watcher.open_positions == {}
+    assert stub["calls"]["trade/cancel-algos"] >= 1
+
+
+def test_tp_triggered_cancels_sibling_sl(stub, stream_watcher, seed_algo):
+    state = stub["state"]
+    seed_position(state, "BTC-USDT-SWAP", 3)
+    seed_algo(state, "sl-1", "BTC-USDT-SWAP", ord_type="trigger")
+    stub["frames"].extend(okx_stub.load_fixture(os.path.join(FIXTURES, "ws_tp_triggered.jsonl")))
+
+    stream_watcher()
+
+    assert wait_for(lambda: "sl-1" not in state.algos)
+
+
+def test_position_closed_on_exchange_cancels_only_its_tp_sl(stub, base_url, stream_watcher, seed_algo):
+    state = stub["state"]
+    seed_position(state, "ETH-USDT-SWAP", 10)
+    seed_position(state, "SOL-USDT-SWAP", 5)
+    seed_algo(state, "eth-tp", "ETH-USDT-SWAP", ord_type="trigger")
+    seed_algo(state, "sol-tp", "SOL-USDT-SWAP", ord_type="trigger")
+    watcher = stream_watcher()
+    assert wait_for(lambda: len(watcher.algos) == 2)
+
+    requests.post(f"{base_url}/stub/close", json={"instIds": ["ETH-USDT-SWAP"]}).raise_for_status()
+
+    assert wait_for(lambda: "eth-tp" not in state.algos)
+    assert "sol-tp" in state.algos
+
+
+def test_orphan_tp_sl_cancelled_on_reconcile(stub, stream_watcher, seed_algo):
+    state = stub["state"]
+    seed_algo(state, "orphan", "XRP-USDT-SWAP", ord_type="trigger")
+
+    stream_watcher()
+
+    assert wait_for(lambda: "orphan" not in state.algos)
@@ -0,0 +1,25 @@
+import json
+import time
+
+import main
+
+
+def test_shared_snapshot_falls_back_to_rest_for_stale_quote(stub, tmp_path):
+    now = time.time()
+    shared_file = tmp_path / "tickers.json"
+    quotes = {
+        "BTC-USDT-SWAP": {"last": 100.0, "ask": 100.1, "bid": 99.9, "ts": 0, "received_at": now},
+        # WS của process cha không còn đẩy giá instrument này ➝ giá trong file đã cũ
+        "ETH-USDT-SWAP": {"last": 1.0, "ask": 1.0, "bid": 1.0, "ts": 0, "received_at": now - 60},
+    }
+    shared_file.write_text(json.dumps({"fetched_at": now, "quotes": quotes}))
+    snapshot = main.TickerSnapshot(main.exchange, max_age=5, shared_file=str(shared_file))
+
+    assert snapshot.get("BTC-USDT-SWAP")["ask"] == 100.1
+    assert stub["calls"] == {}
+
+    quote = snapshot.get("ETH-USDT-SWAP")
+
+    assert quote is not None and quote["ask"] != 1.0
+    assert time.time() - quote["received_at"] < 5
+    assert stub["calls"] == {"market/ticker": 1}